@@ -0,0 +1,239 @@
+import os
+import uuid
+import asyncio
+import logging
+
+import aiohttp
+
+from neorpc.Settings import SettingsHolder
+
+from neoaddress import address_to_script_hash, is_valid_address
+from redisclient import get_async_redis, run_forever_async
+from wireformat import encode_command, response_from_entry
+
+
+logger = logging.getLogger(__name__)
+
+
+class RPCError(Exception):
+    pass
+
+
+class AsyncNEOInterface():
+    """
+    asyncio variant of NEOInterface.
+
+    RPC calls go over a shared aiohttp session and Redis I/O over a
+    redis.asyncio client of redisclient, for the same server as NEOInterface.
+    Every RPC call has a timeout and a bounded number of retries instead of
+    spinning until it returns something, and a semaphore limits the number
+    of RPC calls in flight so one process can serve many concurrent checks.
+    The reply listener survives Redis restarts like the NEOInterface one.
+
+    Requires aiohttp and redis >= 4.2.
+
+    Usage:
+
+        neo = AsyncNEOInterface()
+        await neo.start()
+        ok = await neo.check_funds(address, amount, asset)
+        reply = await (await neo.add_milestone(...))
+        await neo.close()
+    """
+
+    # Approximate number of commands kept in the neo-cmd stream
+    cmd_stream_maxlen = 100000
+
+    def __init__(self, use_privnet=True, max_concurrency=100, rpc_timeout=10,
+                 rpc_retries=3, rpc_endpoints=None):
+
+        if rpc_endpoints:
+            self.rpc_endpoints = list(rpc_endpoints)
+
+        elif use_privnet:
+            self.rpc_endpoints = [
+                "http://private_net:20332"
+            ]
+
+        else:
+            settings = SettingsHolder()
+            settings.setup_mainnet()
+            self.rpc_endpoints = list(settings.RPC_LIST)
+
+        self.rpc_timeout = rpc_timeout
+        self.rpc_retries = rpc_retries
+        self.nm_auth_token = os.environ.get('NM_AUTH_TOKEN', None)
+
+        self.reply_stream = 'neo-response:%s' % uuid.uuid4()
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending = {}  # cmd_id -> asyncio.Future
+        self._session = None
+        self._rds = None
+        self._reply_task = None
+        self._reply_last_id = '0'
+
+    async def start(self):
+        self._session = aiohttp.ClientSession()
+        self._rds = get_async_redis()
+        self._reply_task = asyncio.ensure_future(
+            run_forever_async(self._reply_listener, 'AsyncNEOInterface reply listener'))
+
+    async def close(self):
+        if self._reply_task:
+            self._reply_task.cancel()
+            try:
+                await self._reply_task
+            except asyncio.CancelledError:
+                pass
+        if self._session:
+            await self._session.close()
+        if self._rds:
+            await self._rds.aclose()
+
+    async def _rpc(self, method, params):
+        """ Call an RPC method, retrying on timeouts and connection errors """
+        payload = {
+            'jsonrpc': '2.0',
+            'id': 1,
+            'method': method,
+            'params': params
+        }
+        last_error = None
+
+        for attempt in range(self.rpc_retries):
+            endpoint = self.rpc_endpoints[attempt % len(self.rpc_endpoints)]
+
+            try:
+                async with self._semaphore:
+                    response = await asyncio.wait_for(
+                        self._session.post(endpoint, json=payload), self.rpc_timeout)
+                    async with response:
+                        body = await response.json(content_type=None)
+
+                if 'error' in body:
+                    raise RPCError(body['error'].get('message', body['error']))
+
+                return body['result']
+
+            except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+                last_error = e
+                await asyncio.sleep(min(0.1 * 2 ** attempt, 2))
+
+        raise RPCError("%s failed after %s attempts: %s" % (method, self.rpc_retries, last_error))
+
+    async def check_funds(self, address, amount, asset):
+
+        account = await self._rpc('getaccountstate', [address])
+
+        for i in account['balances']:
+            if i['asset'] == asset:
+                if int(i['value']) >= amount:
+                    return True
+
+        return False
+
+    async def check_transaction(self, sender, receiver, amount, asset, min_conf):
+
+        height = await self._rpc('getblockcount', [])
+        block = await self._rpc('getblock', [height - 1, 1])
+
+        confirmations = int(block['confirmations'])
+        if confirmations < int(min_conf):
+            return False
+
+        txids = [i['txid'] for i in block['tx'] if i['type'] == 'ContractTransaction']
+        transactions = await asyncio.gather(*[self._rpc('getrawtransaction', [txid, 1]) for txid in txids])
+
+        for transaction in transactions:
+            vout = transaction['vout']
+            if len(vout) < 2:
+                continue
+            if vout[0]['address'] == receiver and vout[1]['address'] == sender:
+                if int(vout[0]['value']) == int(amount) and vout[0]['asset'] == asset:
+                    return True
+
+        return False
+
+    async def validate_addr(self, address):
+
+        return {'address': address, 'isvalid': is_valid_address(address)}
+
+    async def address_to_hash(self, address):
+
+        return address_to_script_hash(address)
+
+    async def add_milestone(self, dapp_script_hash, milestone_key, agreement,
+                            neo_address_customer, neo_address_assignee, platform,
+                            timestamp, utc_offset, neo_address_oracle, pay_out,
+                            asset, threshold):
+
+        params = {}
+        params['milestone_key'] = milestone_key
+        params['agreement'] = agreement
+        params['customer'] = address_to_script_hash(neo_address_customer)
+        params['assignee'] = address_to_script_hash(neo_address_assignee)
+        params['platform'] = platform
+        params['timestamp'] = timestamp
+        params['utc_offset'] = utc_offset
+        params['oracle'] = address_to_script_hash(neo_address_oracle)
+        params['pay_out'] = pay_out
+        params['asset'] = asset
+        params['threshold'] = threshold
+
+        return await self._send_command('milestone', params)
+
+    async def review_milestone(self, dapp_script_hash, milestone_key, score):
+
+        params = {}
+        params['milestone_key'] = milestone_key
+        params['score'] = score
+
+        return await self._send_command('review', params)
+
+    async def refund_milestone(self, dapp_script_hash, milestone_key, fee_refund=False):
+
+        params = {}
+        params['milestone_key'] = milestone_key
+        params['fee_refund'] = fee_refund
+
+        return await self._send_command('refund', params)
+
+    async def _send_command(self, operation, params):
+        """
+        Append a command to the neo-cmd stream. Returns a Future that
+        resolves with the middleware response.
+        """
+        cmd_id = str(uuid.uuid4())
+        future = asyncio.get_event_loop().create_future()
+        self._pending[cmd_id] = future
+
+        msg = encode_command(cmd_id, operation, params, self.nm_auth_token, self.reply_stream)
+
+        try:
+            await self._rds.xadd('neo-cmd', {'msg': msg}, maxlen=self.cmd_stream_maxlen)
+        except Exception:
+            del self._pending[cmd_id]
+            raise
+
+        return future
+
+    async def _reply_listener(self):
+        """ Resolve pending futures with the responses on our reply stream """
+        result = await self._rds.xread({self.reply_stream: self._reply_last_id}, block=5000)
+
+        for _stream, entries in result:
+            for entry_id, fields in entries:
+                self._reply_last_id = entry_id
+                try:
+                    response = response_from_entry(fields)
+                except (KeyError, ValueError) as e:
+                    logger.error("Skipping malformed reply %s: %s", entry_id, e)
+                    await self._rds.xdel(self.reply_stream, entry_id)
+                    continue
+
+                future = self._pending.pop(response['cmd_id'], None)
+                if future is not None and not future.done():
+                    future.set_result(response)
+
+                await self._rds.xdel(self.reply_stream, entry_id)
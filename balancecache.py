@@ -0,0 +1,78 @@
+import threading
+
+
+class BalanceCache:
+    """
+    Caches account balances, fed from the BlockFeed.
+
+    Balances are fetched once per address with `fetch(address)` (the RPC
+    get_account call) and kept until a persisted block touches the address,
+    either by paying to it or by spending from it. A cache shared by clients
+    of different nodes can take the fetch with each call instead.
+    """
+
+    def __init__(self, fetch=None):
+        self.fetch = fetch
+        self._balances = {}  # address -> {asset: value}
+        self._fetching = {}  # address -> [fetches in flight, invalidations since the first started]
+        self._lock = threading.Lock()
+
+    def on_block(self, block):
+        touched = set()
+        for tx in block['txs']:
+            touched.update(tx['senders'])
+            touched.update(output['address'] for output in tx['vout'])
+
+        with self._lock:
+            for address in touched:
+                self._invalidate(address)
+
+    def invalidate(self, address):
+        with self._lock:
+            self._invalidate(address)
+
+    def _invalidate(self, address):
+        self._balances.pop(address, None)
+        if address in self._fetching:
+            self._fetching[address][1] += 1
+
+    def get(self, address, fetch=None):
+        """ Return the balances of address as a dict of asset -> value """
+        with self._lock:
+            balances = self._balances.get(address)
+            if balances is not None:
+                return balances
+
+            fetching = self._fetching.setdefault(address, [0, 0])
+            fetching[0] += 1
+            generation = fetching[1]
+
+        try:
+            account = (fetch or self.fetch)(address)
+            balances = dict((i['asset'], i['value']) for i in account['balances'])
+
+        finally:
+            with self._lock:
+                # Do not cache a balance that a block changed while we fetched it
+                if balances is not None and fetching[1] == generation:
+                    self._balances[address] = balances
+
+                fetching[0] -= 1
+                if not fetching[0]:
+                    del self._fetching[address]
+
+        return balances
+
+    def get_many(self, addresses, executor=None, fetch=None):
+        """
+        Return a dict of address -> balances. The addresses missing from the
+        cache are fetched together, concurrently when an executor is given.
+        """
+        with self._lock:
+            result = dict((address, self._balances[address]) for address in addresses
+                          if address in self._balances)
+
+        misses = [address for address in set(addresses) if address not in result]
+        fetched = (executor.map if executor else map)(lambda address: self.get(address, fetch), misses)
+        result.update(zip(misses, fetched))
+        return result
@@ -0,0 +1,68 @@
+"""
+Compare resolving an address to its script hash locally with the
+get_account RPC call that NEOInterface used before.
+
+Run from the repository root:
+
+    python benchmarks/bench_address_to_hash.py [rpc_endpoint]
+
+Without an endpoint only the local decoder is measured.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from neoaddress import address_to_script_hash  # noqa: E402
+
+
+ADDRESSES = [
+    'AXAmGd22VaF7w8c5wd5t43HJs9p9WwymMv',
+    'AVTENjYfJDhtYyNTtmqSxKPx5watyFRqz4',
+    'AQ2CAEAmXzCm3yB4ZfwRAuNA6973S2Ehv3',
+]
+
+
+def report(name, number, seconds):
+    print("%-24s %8d calls  %10.2f us/call" % (name, number, seconds / number * 1e6))
+
+
+def bench_local(number=100000):
+
+    def uncached():
+        address_to_script_hash.cache_clear()
+        for address in ADDRESSES:
+            address_to_script_hash(address)
+
+    def cached():
+        for address in ADDRESSES:
+            address_to_script_hash(address)
+
+    report("local (uncached)", number * 3, timeit.timeit(uncached, number=number))
+    report("local (cached)", number * 3, timeit.timeit(cached, number=number))
+
+
+def bench_rpc(endpoint, number=100):
+    from neorpc.Client import RPCClient
+    from neorpc.Settings import SettingsHolder
+
+    settings = SettingsHolder()
+    settings.setup([endpoint])
+    client = RPCClient(settings)
+
+    for address in ADDRESSES:
+        assert client.get_account(address)['script_hash'] == address_to_script_hash(address)
+
+    def rpc():
+        for address in ADDRESSES:
+            client.get_account(address)['script_hash']
+
+    report("rpc get_account", number * 3, timeit.timeit(rpc, number=number))
+
+
+if __name__ == '__main__':
+    bench_local()
+
+    if len(sys.argv) > 1:
+        bench_rpc(sys.argv[1])
@@ -0,0 +1,85 @@
+"""
+Compare the msgpack wire format of commands and responses with the JSON
+messages and hexlified contract arguments used before.
+
+Run from the repository root:
+
+    python benchmarks/bench_wire_format.py
+"""
+import binascii
+import json
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wireformat import decode_command, encode_command, decode_response, encode_response  # noqa: E402
+
+
+CMD_ID = str(uuid.uuid4())
+
+PARAMS = {
+    'milestone_key': 'agreement-0001:milestone-01',
+    'agreement': 'agreement-0001',
+    'customer': '0x23ba2703c53263e8d6e522dc32203339dcd8eee9',
+    'assignee': '0x8f8a9bc4b3bfb3a2b4c3f0a1ad4e2f8f3c1a2b3c',
+    'platform': 'platform',
+    'timestamp': 1546300800,
+    'utc_offset': 1,
+    'oracle': '0x4c3a2b1a9d8e7f6a5b4c3d2e1f0a9b8c7d6e5f4a',
+    'pay_out': 100000000,
+    'asset': 'NEO',
+    'threshold': 75
+}
+
+FIELDS = {
+    'tx_hash': '0x' + '5f' * 32,
+    'block': 3210123,
+    'result': True,
+    'auth_token': 'secret'
+}
+
+
+def report(name, number, seconds, size=None):
+    size = " %6d bytes" % size if size is not None else ""
+    print("%-24s %8d calls  %10.2f us/call%s" % (name, number, seconds / number * 1e6, size))
+
+
+def json_command():
+    return json.dumps({'cmd_id': CMD_ID, 'operation': 'milestone', 'params': PARAMS,
+                       'auth_token': 'secret', 'reply_to': 'neo-reply:client'})
+
+
+def hexlify_args(params):
+    """ The contract arguments as the handler built them from JSON params """
+    return [binascii.hexlify(str(params[name]).encode()) for name in sorted(params)]
+
+
+def bench_command(number=50000):
+    data = json_command()
+    msg = encode_command(CMD_ID, 'milestone', PARAMS, 'secret', 'neo-reply:client')
+
+    report("json encode", number, timeit.timeit(json_command, number=number), len(data))
+    report("msgpack encode", number, timeit.timeit(
+        lambda: encode_command(CMD_ID, 'milestone', PARAMS, 'secret', 'neo-reply:client'), number=number), len(msg))
+
+    report("json decode + hexlify", number, timeit.timeit(
+        lambda: hexlify_args(json.loads(data)['params']), number=number))
+    report("msgpack decode", number, timeit.timeit(lambda: decode_command(msg), number=number))
+
+
+def bench_response(number=50000):
+    data = json.dumps(dict(FIELDS, cmd_id=CMD_ID, status='confirmed'))
+    msg = encode_response(CMD_ID, 'confirmed', FIELDS)
+
+    report("json response", number, timeit.timeit(
+        lambda: json.loads(json.dumps(dict(FIELDS, cmd_id=CMD_ID, status='confirmed'))), number=number), len(data))
+    report("msgpack response", number, timeit.timeit(
+        lambda: decode_response(encode_response(CMD_ID, 'confirmed', FIELDS)), number=number), len(msg))
+
+
+if __name__ == '__main__':
+    bench_command()
+    bench_response()
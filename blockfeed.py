@@ -0,0 +1,86 @@
+import json
+import logging
+import threading
+
+from redisclient import retry_on_disconnect, run_forever
+
+
+logger = logging.getLogger(__name__)
+
+
+BLOCK_STREAM = 'neo-blocks'
+
+
+class BlockFeed(threading.Thread):
+    """
+    Follows the neo-blocks stream published by the middleware and hands
+    every block summary to its subscribers, oldest first.
+
+    `height` is the latest block seen. `caught_up` is set once the feed has
+    processed every block that was in the stream when it started, from then
+    on the subscribers reflect the chain as far as the stream retains it.
+    With a `history` the feed starts that many blocks behind the newest one
+    instead of replaying the whole stream.
+    """
+    rds = None
+    stream = None
+    height = None
+
+    def __init__(self, rds, stream=BLOCK_STREAM, batch_size=1000, history=None):
+        super(BlockFeed, self).__init__()
+        self.daemon = True
+
+        self.rds = rds
+        self.stream = stream
+        self.batch_size = batch_size
+        self.history = history
+        self.height = -1
+        self.caught_up = threading.Event()
+        self._subscribers = []
+
+    def subscribe(self, subscriber):
+        """ subscriber.on_block(block) is called for every block summary """
+        self._subscribers.append(subscriber)
+
+    def run(self):
+        self._last_id = '0'
+
+        newest = retry_on_disconnect(lambda: self.rds.xrevrange(self.stream, count=1), 'BlockFeed')
+        self._newest_id = newest[0][0] if newest else None
+        if self._newest_id is None:
+            self.caught_up.set()
+        elif self.history is not None:
+            # Entry ids are <height>-1, so the ids before a height are <height>-0
+            newest_height = int(self._newest_id.split(b'-')[0])
+            self._last_id = '%d-0' % max(newest_height - self.history + 1, 0)
+
+        # Resumes from the last block seen when Redis comes back
+        run_forever(self._poll, 'BlockFeed')
+
+    def _poll(self):
+        result = self.rds.xread({self.stream: self._last_id}, count=self.batch_size, block=5000)
+
+        for _stream, entries in result or []:
+            for entry_id, fields in entries:
+                self._last_id = entry_id
+                try:
+                    block = json.loads(fields[b'data'].decode('utf-8'))
+                except (KeyError, ValueError) as e:
+                    logger.error("Skipping malformed block %s: %s", entry_id, e)
+                else:
+                    self._dispatch(block)
+
+                if entry_id == self._newest_id:
+                    self.caught_up.set()
+
+        if not result:
+            self.caught_up.set()
+
+    def _dispatch(self, block):
+        self.height = max(self.height, block['height'])
+
+        for subscriber in self._subscribers:
+            try:
+                subscriber.on_block(block)
+            except Exception as e:
+                logger.exception(e)
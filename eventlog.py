@@ -0,0 +1,85 @@
+import logging
+import threading
+
+from redisclient import run_forever
+from wireformat import event_from_entry
+
+
+logger = logging.getLogger(__name__)
+
+
+EVENT_STREAM = 'neo-events'
+
+
+def height_position(height):
+    """ The stream position just before the first event of a block """
+    return '%d-0' % height
+
+
+class EventLog(threading.Thread):
+    """
+    Replays the contract events logged by the middleware in the neo-events
+    stream and hands them to its subscribers, oldest first.
+
+    The log starts at block `from_height`, or right after the event with id
+    `after_id` when given. Ids are "<height>-<seq>", a consumer that keeps
+    the id of the last event it processed can resume exactly there. Logged
+    events are read in batches of `batch_size` until the end of the log,
+    then `caught_up` is set and new events are followed as they come in.
+
+    The middleware keeps a bounded number of events and drops those of
+    deleted milestones, only their delete event remains. Older history has
+    to be rescanned from the chain.
+    """
+    rds = None
+    stream = None
+    last_id = None  # id of the last event handed to the subscribers
+
+    def __init__(self, rds, from_height=0, after_id=None, stream=EVENT_STREAM, batch_size=1000):
+        super(EventLog, self).__init__()
+        self.daemon = True
+
+        self.rds = rds
+        self.stream = stream
+        self.batch_size = batch_size
+        self.last_id = after_id or height_position(from_height)
+        self.caught_up = threading.Event()
+        self._subscribers = []
+
+    def subscribe(self, subscriber):
+        """ subscriber.on_event(event) is called for every event record """
+        self._subscribers.append(subscriber)
+
+    def run(self):
+        # Resumes from the last event seen when Redis comes back
+        run_forever(self._poll, 'EventLog')
+
+    def _poll(self):
+        # Catch up without blocking, then wait for new events
+        block = 5000 if self.caught_up.is_set() else None
+        result = self.rds.xread({self.stream: self.last_id}, count=self.batch_size, block=block)
+
+        read = 0
+        for _stream, entries in result or []:
+            for entry_id, fields in entries:
+                read += 1
+                self.last_id = entry_id.decode('utf-8')
+                self._dispatch(self.last_id, fields)
+
+        if read < self.batch_size:
+            self.caught_up.set()
+
+    def _dispatch(self, entry_id, fields):
+        try:
+            event = event_from_entry(fields)
+        except (KeyError, ValueError) as e:
+            logger.error("Skipping event %s: %s", entry_id, e)
+            return
+
+        event['id'] = entry_id
+
+        for subscriber in self._subscribers:
+            try:
+                subscriber.on_event(event)
+            except Exception as e:
+                logger.exception(e)
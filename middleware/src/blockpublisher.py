@@ -0,0 +1,109 @@
+import json
+import threading
+
+from queue import Queue
+from logzero import logger
+from redis.exceptions import ResponseError
+
+from neo.Core.Blockchain import Blockchain
+
+from redisclient import retry_on_disconnect
+
+
+BLOCK_STREAM = 'neo-blocks'
+
+
+def block_entry_id(height):
+    return '%d-1' % height
+
+
+class BlockPublisher(threading.Thread):
+    """
+    Publishes a summary of every persisted block to the neo-blocks stream.
+
+    For each transaction the summary lists its outputs (address, asset,
+    value) and the addresses of the outputs it spends, so clients can keep
+    payment indexes and balance caches up to date without RPC calls.
+    Summaries are built on the reactor thread and written to Redis from
+    this thread so block persistence never waits on Redis.
+
+    Entry ids are derived from the block height, so clients can resume from
+    a height and a block published by another middleware node is rejected
+    by Redis instead of being added twice.
+    """
+    rds = None
+    stream = None
+    maxlen = None
+
+    def __init__(self, rds, stream=BLOCK_STREAM, maxlen=500000):
+        super(BlockPublisher, self).__init__()
+        self.daemon = True
+
+        self.rds = rds
+        self.stream = stream
+        self.maxlen = maxlen
+        self._queue = Queue()
+
+    def attach(self):
+        """ Hook into block persistence, requires a registered blockchain """
+        Blockchain.Default().PersistCompleted.on_change += self.on_persist_completed
+
+    def on_persist_completed(self, block):
+        try:
+            self._queue.put(self.summarize(block))
+        except Exception as e:
+            logger.error("Could not summarize block %s: %s", block.Index, e)
+
+    @staticmethod
+    def summarize(block):
+        txs = []
+
+        for tx in block.FullTransactions:
+            vout = []
+            for n, output in enumerate(tx.outputs):
+                vout.append({
+                    'n': n,
+                    'address': output.Address,
+                    'asset': '0x%s' % output.AssetId.ToString(),
+                    'value': output.Value.ToNeoJsonString()
+                })
+
+            senders = []
+            if tx.inputs:
+                for output in tx.References.values():
+                    if output.Address not in senders:
+                        senders.append(output.Address)
+
+            txs.append({
+                'txid': tx.Hash.ToString(),
+                'type': type(tx).__name__,
+                'vout': vout,
+                'senders': senders
+            })
+
+        return {
+            'height': block.Index,
+            'hash': block.Hash.ToString(),
+            'time': block.Timestamp,
+            'txs': txs
+        }
+
+    def run(self):
+        while True:
+            summary = self._queue.get()
+            try:
+                # Clients would miss the payments of a dropped block, retry until Redis is back
+                retry_on_disconnect(lambda: self._publish(summary), 'BlockPublisher')
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _publish(self, summary):
+        try:
+            self.rds.xadd(self.stream, {'data': json.dumps(summary)},
+                          id=block_entry_id(summary['height']), maxlen=self.maxlen)
+        except ResponseError as e:
+            # An id that is not above the last one was published by another node
+            if 'equal or smaller' not in str(e):
+                raise
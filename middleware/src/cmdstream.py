@@ -0,0 +1,182 @@
+import threading
+import time
+
+from logzero import logger
+from redis.exceptions import ResponseError
+
+
+CMD_STREAM = 'neo-cmd'
+CMD_GROUP = 'middleware'
+
+
+def next_entry_id(entry_id):
+    """ The smallest stream id after entry_id """
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+    ms, seq = entry_id.split('-')
+    return '%s-%d' % (ms, int(seq) + 1)
+
+
+class CommandStream:
+    """
+    Consumer side of the durable neo-cmd command log (a Redis Stream).
+
+    Every middleware node reads through the same consumer group, so commands
+    are shared between nodes. An entry stays pending until it is acked, which
+    happens once its invoke reached a final state. Entries that were left
+    pending by a node that died are claimed by another node after
+    `claim_idle` seconds, giving at-least-once delivery. Entries that are
+    still being worked on are touched regularly so they are not reclaimed,
+    entries this node released after an error are reclaimed like others.
+    """
+    rds = None
+    stream = None
+    group = None
+    consumer = None
+
+    claim_idle = None
+    claim_interval = None
+    page_size = 100  # pending entries inspected per XPENDING call when reclaiming
+
+    def __init__(self, rds, consumer, stream=CMD_STREAM, group=CMD_GROUP,
+                 claim_idle=900, claim_interval=60):
+        self.rds = rds
+        self.consumer = consumer
+        self.stream = stream
+        self.group = group
+        self.claim_idle = claim_idle
+        self.claim_interval = claim_interval
+
+        self._in_progress = set()
+        self._outstanding = {}  # entry_id -> number of commands left in a batch entry
+        self._released = set()  # batch entries to deliver again once their queued commands are done
+        self._lock = threading.Lock()
+        self._recover_from = '0'
+        self._recovered = False
+        self._last_maintenance = 0
+
+    def setup(self):
+        """ Create the stream and consumer group if they do not exist yet """
+        try:
+            self.rds.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+            logger.info("Created consumer group %s on %s", self.group, self.stream)
+        except ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def read(self, count=10, block=5000):
+        """
+        Return a list of (entry_id, fields) to process.
+
+        After a restart the entries this consumer never acked are returned
+        first, then stale entries of other consumers, then new entries.
+        """
+        if not self._recovered:
+            result = self._read_group(self._recover_from, count, None, keep_empty=True)
+            if result:
+                self._recover_from = result[-1][0]
+                entries = [(eid, fields) for eid, fields in result if fields]
+                logger.info("Recovered %s unacked commands", len(entries))
+                return self._track(entries)
+            self._recovered = True
+
+        if time.time() - self._last_maintenance > self.claim_interval:
+            self._last_maintenance = time.time()
+            self.touch()
+            entries = self.reclaim(count)
+            if entries:
+                return self._track(entries)
+
+        return self._track(self._read_group('>', count, block))
+
+    def expect(self, entry_id, count):
+        """ The entry holds `count` commands, ack it after the last one """
+        with self._lock:
+            self._outstanding[entry_id] = count
+
+    def release(self, entry_id, undispatched=0):
+        """
+        Stop touching an entry without acking it, so it gets reclaimed and
+        handled again. `undispatched` commands of a batch entry were never
+        queued, the entry is released once its queued commands are done.
+        """
+        with self._lock:
+            if entry_id in self._outstanding:
+                self._outstanding[entry_id] -= undispatched
+                if self._outstanding[entry_id] > 0:
+                    self._released.add(entry_id)
+                    return
+                del self._outstanding[entry_id]
+
+            self._released.discard(entry_id)
+            self._in_progress.discard(entry_id)
+
+    def ack(self, entry_id):
+        if entry_id is None:
+            return
+
+        with self._lock:
+            if entry_id in self._outstanding:
+                self._outstanding[entry_id] -= 1
+                if self._outstanding[entry_id] > 0:
+                    return
+                del self._outstanding[entry_id]
+
+                if entry_id in self._released:
+                    # The rest of the batch is handled when the entry is delivered again
+                    self._released.discard(entry_id)
+                    self._in_progress.discard(entry_id)
+                    return
+
+        self.rds.xack(self.stream, self.group, entry_id)
+        with self._lock:
+            self._in_progress.discard(entry_id)
+
+    def touch(self):
+        """ Reset the idle time of entries we are still working on """
+        with self._lock:
+            entry_ids = list(self._in_progress)
+        if entry_ids:
+            self.rds.xclaim(self.stream, self.group, self.consumer, 0, entry_ids, justid=True)
+
+    def reclaim(self, count):
+        """ Claim entries left pending for too long, by other consumers or released by us """
+        idle_ms = self.claim_idle * 1000
+        with self._lock:
+            in_progress = set(self._in_progress)
+
+        # Our own long running entries may head the pending list, page past them
+        stale = []
+        start = '-'
+        while len(stale) < count:
+            pending = self.rds.xpending_range(self.stream, self.group, start, '+', self.page_size)
+            stale.extend(p['message_id'] for p in pending
+                         if p['time_since_delivered'] >= idle_ms and p['message_id'] not in in_progress)
+
+            if len(pending) < self.page_size:
+                break
+            start = next_entry_id(pending[-1]['message_id'])
+
+        if not stale:
+            return []
+
+        entries = self.rds.xclaim(self.stream, self.group, self.consumer, idle_ms, stale[:count])
+        logger.info("Reclaimed %s stale commands", len(entries))
+        return entries
+
+    def _read_group(self, entry_id, count, block, keep_empty=False):
+        result = self.rds.xreadgroup(self.group, self.consumer, {self.stream: entry_id},
+                                     count=count, block=block)
+        if not result:
+            return []
+        _stream, entries = result[0]
+        if keep_empty:
+            return entries
+        # Pending entries that were deleted from the stream come back without fields
+        return [(eid, fields) for eid, fields in entries if fields]
+
+    def _track(self, entries):
+        with self._lock:
+            for entry_id, _fields in entries:
+                self._in_progress.add(entry_id)
+        return entries
@@ -0,0 +1,139 @@
+import json
+
+from logzero import logger
+
+from responses import publish_response
+
+
+DEDUP_PREFIX = 'neo-cmd-dedup'
+
+
+class CommandDedup:
+    """
+    Drops commands that were already received, e.g. because a client
+    re-published them after a timeout.
+
+    Every command claims its cmd_id in Redis, milestone creations also
+    claim their milestone_key. Claims expire after `ttl` seconds and are
+    shared by all middleware nodes. A duplicate is answered with the result
+    of the original command, or gets it as soon as the original is done.
+    When a milestone creation fails its milestone_key is released, so it
+    can be created with a new command.
+
+    The neo-cmd stream entry of a claim is remembered, so an entry that is
+    delivered again after a node crashed is not mistaken for a duplicate.
+    """
+    rds = None
+    ttl = None
+
+    duplicates = 0
+
+    def __init__(self, rds, ttl=86400):
+        self.rds = rds
+        self.ttl = ttl
+        self.duplicates = 0
+
+    @staticmethod
+    def _cmd_key(cmd_id):
+        return '%s:cmd:%s' % (DEDUP_PREFIX, cmd_id)
+
+    @staticmethod
+    def _milestone_key(milestone_key):
+        return '%s:milestone:%s' % (DEDUP_PREFIX, milestone_key)
+
+    @staticmethod
+    def _waiters_key(cmd_id):
+        return '%s:waiters:%s' % (DEDUP_PREFIX, cmd_id)
+
+    def check(self, cmd_id, operation, params, reply_to, entry_id=None):
+        """
+        Claim a command. Returns False for a new command, True for a
+        duplicate, which is answered here and must not be handled again.
+        """
+        if isinstance(entry_id, bytes):
+            entry_id = entry_id.decode('utf-8')
+
+        record = {'status': 'pending', 'entry_id': entry_id}
+        milestone_key = params.get('milestone_key') if operation == 'milestone' else None
+        if milestone_key:
+            record['milestone_key'] = milestone_key
+
+        cmd_key = self._cmd_key(cmd_id)
+        if not self.rds.set(cmd_key, json.dumps(record), nx=True, ex=self.ttl):
+            return self._duplicate(cmd_id, cmd_id, reply_to, entry_id)
+
+        if milestone_key and not self.rds.set(self._milestone_key(milestone_key), cmd_id, nx=True, ex=self.ttl):
+            original = self.rds.get(self._milestone_key(milestone_key))
+            if original is not None and original.decode('utf-8') != cmd_id:
+                self.rds.delete(cmd_key)
+                return self._duplicate(original.decode('utf-8'), cmd_id, reply_to, entry_id)
+
+        return False
+
+    def _duplicate(self, original_id, cmd_id, reply_to, entry_id):
+        data = self.rds.get(self._cmd_key(original_id))
+        record = json.loads(data.decode('utf-8')) if data else None
+
+        if record and record['status'] == 'pending' and entry_id and record.get('entry_id') == entry_id:
+            # Redelivery of the same stream entry, it still has to be handled
+            return False
+
+        self.duplicates += 1
+        logger.info("Dropping duplicate command %s of %s", cmd_id, original_id)
+
+        if record is None:
+            # The original expired just now, there is no result to return
+            publish_response(self.rds, reply_to, cmd_id, 'failed', error='Duplicate command',
+                             duplicate_of=original_id)
+            return True
+
+        if record['status'] == 'pending':
+            # Answered by complete() together with the original
+            waiter = json.dumps([reply_to, cmd_id])
+            waiters_key = self._waiters_key(original_id)
+            pipe = self.rds.pipeline()
+            pipe.sadd(waiters_key, waiter)
+            pipe.expire(waiters_key, self.ttl)
+            pipe.get(self._cmd_key(original_id))
+            _added, _expire, data = pipe.execute()
+
+            # The original may have completed in the meantime
+            record = json.loads(data.decode('utf-8')) if data else record
+            if record['status'] == 'pending' or not self.rds.srem(waiters_key, waiter):
+                return True
+
+        publish_response(self.rds, reply_to, cmd_id, record['status'], duplicate_of=original_id,
+                         **record.get('fields', {}))
+        return True
+
+    def complete(self, cmd_id, status, fields):
+        """ Store the result of a claimed command and answer the duplicates waiting for it """
+        if not cmd_id:
+            return
+
+        cmd_key = self._cmd_key(cmd_id)
+        data = self.rds.get(cmd_key)
+        if not data:
+            # Never claimed, e.g. an unauthorized command, or expired
+            return
+
+        record = json.loads(data.decode('utf-8'))
+        record['status'] = status
+        record['fields'] = fields
+
+        waiters_key = self._waiters_key(cmd_id)
+        pipe = self.rds.pipeline()
+        pipe.set(cmd_key, json.dumps(record), ex=self.ttl, xx=True)
+        pipe.smembers(waiters_key)
+        pipe.delete(waiters_key)
+        _set, waiters, _deleted = pipe.execute()
+
+        milestone_key = record.get('milestone_key')
+        if status == 'failed' and milestone_key:
+            key = self._milestone_key(milestone_key)
+            if self.rds.get(key) == cmd_id.encode('utf-8'):
+                self.rds.delete(key)
+
+        for waiter in waiters:
+            reply_to, duplicate_id = json.loads(waiter.decode('utf-8'))
+            publish_response(self.rds, reply_to, duplicate_id, status, duplicate_of=cmd_id, **fields)
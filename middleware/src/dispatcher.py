@@ -0,0 +1,163 @@
+import threading
+import time
+
+from queue import Queue
+from logzero import logger
+
+from neo.Core.Blockchain import Blockchain
+
+from handler import CommandHandler
+from wireformat import command_from_entry
+
+
+STAGES = ('read', 'parsed', 'malformed', 'unauthorized', 'duplicate', 'dispatched')
+
+
+class CommandDispatcher:
+    """
+    Hands commands read from the neo-cmd stream to a pool of threads that
+    parse, authenticate, deduplicate and dispatch them.
+
+    Backpressure is explicit on both sides: `submit` blocks the stream
+    reader while `max_pending` commands wait for a pool thread, and pool
+    threads wait while the invoke queue holds `max_queued` tasks. Commands
+    that are not read yet stay in the stream, where another middleware node
+    can pick them up.
+
+    Every stage counts the commands that passed it, see `stats`.
+    """
+    smart_contract = None
+    command_stream = None
+    dedup = None
+    auth_token = None
+
+    pool_size = None
+    max_queued = None
+
+    def __init__(self, smart_contract, command_stream, dedup, auth_token,
+                 pool_size=4, max_pending=100, max_queued=1000):
+        self.smart_contract = smart_contract
+        self.command_stream = command_stream
+        self.dedup = dedup
+        self.auth_token = auth_token
+        self.pool_size = pool_size
+        self.max_queued = max_queued
+
+        self._pending = Queue(maxsize=max_pending)
+        self._counters = dict((stage, 0) for stage in STAGES)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._blocked = 0.0  # seconds the reader and pool spent waiting on backpressure
+
+    def start(self):
+        for i in range(self.pool_size):
+            thread = threading.Thread(target=self._work, name="dispatcher-%s" % i)
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, entry_id, fields):
+        """ Queue a stream entry for the pool, blocks while the pool is saturated """
+        self._count('read')
+        if self._pending.full():
+            start = time.time()
+            self._pending.put((entry_id, fields))
+            self._waited(time.time() - start)
+        else:
+            self._pending.put((entry_id, fields))
+
+    def stats(self):
+        """ Commands per stage, their rate per second and the backpressure state """
+        elapsed = max(time.time() - self._started, 1e-6)
+        with self._lock:
+            counters = dict(self._counters)
+            blocked = self._blocked
+
+        return {
+            'counters': counters,
+            'rates': dict((stage, count / elapsed) for stage, count in counters.items()),
+            'pending': self._pending.qsize(),
+            'invoke_queue': self.smart_contract.invoke_queue.qsize(),
+            'blocked_seconds': blocked
+        }
+
+    def _count(self, stage, amount=1):
+        with self._lock:
+            self._counters[stage] += amount
+
+    def _waited(self, seconds):
+        with self._lock:
+            self._blocked += seconds
+
+    def _work(self):
+        while True:
+            entry_id, fields = self._pending.get()
+            try:
+                self._handle(entry_id, fields)
+            except Exception as e:
+                # Leave the entry pending, it is reclaimed and retried later
+                logger.exception("Dispatching %s failed: %s", entry_id, e)
+                self.command_stream.release(entry_id)
+
+    def _handle(self, entry_id, fields):
+        try:
+            data = command_from_entry(fields)
+            cmd_id = data['cmd_id']
+            operation = data['operation']
+            params = data['params']
+            auth_token = data['auth_token']
+            reply_to = data.get('reply_to', None)
+
+        except (ValueError, KeyError) as e:
+            # A malformed command will never succeed, drop it
+            logger.error("Dropping malformed command %s: %s", entry_id, e)
+            self._count('malformed')
+            self.command_stream.ack(entry_id)
+            return
+
+        self._count('parsed')
+
+        if auth_token != self.auth_token:
+            logger.error("Unauthorized %s command %s", operation, cmd_id)
+            self._count('unauthorized')
+            self.smart_contract.reject(cmd_id, reply_to, entry_id, 'Unauthorized')
+            return
+
+        try:
+            if operation == 'batch':
+                commands = params['commands']
+                params['commands'] = [command for command in commands
+                                      if not self.dedup.check(command['cmd_id'], command['operation'],
+                                                              command['params'], reply_to, entry_id)]
+                self._count('duplicate', len(commands) - len(params['commands']))
+
+            elif self.dedup.check(cmd_id, operation, params, reply_to, entry_id):
+                self._count('duplicate')
+                self.command_stream.ack(entry_id)
+                return
+
+        except (TypeError, KeyError) as e:
+            logger.error("Dropping malformed command %s: %s", entry_id, e)
+            self._count('malformed')
+            self.command_stream.ack(entry_id)
+            return
+
+        # Do not let the invoke queue grow without bounds
+        waited = self.smart_contract.invoke_queue.wait_for_space(self.max_queued)
+        if waited:
+            self._waited(waited)
+
+        logger.info("Block %s / %s  - dispatching %s command",
+                    str(Blockchain.Default().Height),
+                    str(Blockchain.Default().HeaderHeight), operation)
+
+        try:
+            CommandHandler(self.smart_contract, cmd_id, operation, params, reply_to, entry_id)
+
+        except (ValueError, KeyError, TypeError) as e:
+            # The client waits for an answer, reject answers it and acks the entry
+            logger.error("Rejecting malformed command %s: %s", entry_id, e)
+            self._count('malformed')
+            self.smart_contract.reject(cmd_id, reply_to, entry_id, 'Invalid command')
+            return
+
+        self._count('dispatched')
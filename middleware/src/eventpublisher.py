@@ -0,0 +1,182 @@
+import binascii
+import json
+import threading
+
+from queue import Queue
+from logzero import logger
+from redis.exceptions import ResponseError
+
+from neo.Core.Blockchain import Blockchain
+
+from redisclient import retry_on_disconnect
+from validator import key_from_event
+from wireformat import encode_event, script_hash_str
+
+
+EVENT_CHANNEL = 'neo-event'
+EVENT_STREAM = 'neo-events'
+
+
+def event_entry_id(height, seq):
+    """ Event log ids are the block height and the position of the event in the block """
+    return '%d-%d' % (height, seq)
+
+
+def _int(value):
+    """ Integers are little-endian signed byte arrays on the VM stack """
+    if isinstance(value, int):
+        return value
+    return int.from_bytes(value, 'little', signed=True)
+
+
+def _script_hash(value):
+    if len(value) == 20:
+        return script_hash_str(value)
+    return binascii.hexlify(value).decode('utf-8')
+
+
+# The arguments of every RegisterAction event of the contract, by event name
+DECODERS = {
+    'fee': (('fee', _int),),
+    'milestone': (('milestone_key', key_from_event),),
+    'review': (('milestone_key', key_from_event), ('review_score', _int)),
+    'transfer': (('from', _script_hash), ('to', _script_hash), ('amount', _int)),
+    'refund': (('milestone_key', key_from_event),),
+    'delete': (('milestone_key', key_from_event),),
+}
+
+
+def decode_event(event_payload):
+    """
+    The typed record of a Runtime.Notify payload (name, args...). Plain
+    Notify messages and unknown events keep their args hexlified.
+    """
+    name = event_payload[0]
+    try:
+        name = name.decode('utf-8')
+    except (AttributeError, UnicodeDecodeError):
+        name = binascii.hexlify(name).decode('utf-8')
+
+    record = {'event': name}
+    args = event_payload[1:]
+    decoders = DECODERS.get(name)
+
+    if decoders and len(args) == len(decoders):
+        try:
+            for (field, decode), value in zip(decoders, args):
+                record[field] = decode(value)
+            return record
+        except (TypeError, ValueError, binascii.Error) as e:
+            logger.warning("Could not decode %s event: %s", name, e)
+            record = {'event': name}
+
+    if args:
+        record['args'] = [binascii.hexlify(value).decode('utf-8') if isinstance(value, bytes) else value
+                          for value in args]
+    return record
+
+
+class ContractEventPublisher(threading.Thread):
+    """
+    Publishes the contract events of persisted blocks as typed records.
+
+    Events are collected per block on the reactor thread while the block is
+    persisted. Once it is, its events are written from this thread in one
+    pipeline, each tagged with the block height and tx hash. Events of test
+    invokes are not published.
+
+    Besides the neo-event channel, events are appended to the neo-events
+    stream with ids derived from the block height, which clients replay
+    from any height (see EventLog). An event already appended by another
+    middleware node is rejected by Redis. The stream keeps about `maxlen`
+    events. When a milestone is deleted its earlier events are removed from
+    the stream, only the delete event stays.
+    """
+    rds = None
+    channel = None
+    stream = None
+    maxlen = None
+    index_ttl = None  # seconds the event ids of a milestone are kept for compaction
+
+    def __init__(self, rds, channel=EVENT_CHANNEL, stream=EVENT_STREAM, maxlen=1000000,
+                 index_ttl=90 * 86400):
+        super(ContractEventPublisher, self).__init__()
+        self.daemon = True
+
+        self.rds = rds
+        self.channel = channel
+        self.stream = stream
+        self.maxlen = maxlen
+        self.index_ttl = index_ttl
+        self._blocks = {}  # height -> records of the block being persisted
+        self._lock = threading.Lock()
+        self._queue = Queue()
+
+    def attach(self):
+        """ Hook into block persistence, requires a registered blockchain """
+        Blockchain.Default().PersistCompleted.on_change += self.on_persist_completed
+
+    def on_event(self, event):
+        if event.test_mode or not len(event.event_payload):
+            return
+
+        record = decode_event(event.event_payload)
+        record['height'] = event.block_number
+        record['tx_hash'] = event.tx_hash.ToString() if event.tx_hash else None
+
+        with self._lock:
+            self._blocks.setdefault(event.block_number, []).append(record)
+
+    def on_persist_completed(self, block):
+        with self._lock:
+            heights = sorted(height for height in self._blocks if height <= block.Index)
+            blocks = [(height, self._blocks.pop(height)) for height in heights]
+
+        for height, records in blocks:
+            self._queue.put((height, records))
+
+    def run(self):
+        while True:
+            height, records = self._queue.get()
+            try:
+                retry_on_disconnect(lambda: self._flush(height, records), 'ContractEventPublisher')
+                retry_on_disconnect(lambda: self._compact(records), 'ContractEventPublisher')
+            except Exception as e:
+                logger.exception("Publishing the events of block %s failed: %s", height, e)
+
+    def _index_key(self, milestone_key):
+        return '%s:milestone:%s' % (self.stream, milestone_key)
+
+    def _flush(self, height, records):
+        pipe = self.rds.pipeline(transaction=False)
+        for seq, record in enumerate(records, 1):
+            entry_id = event_entry_id(height, seq)
+            pipe.xadd(self.stream, {'msg': encode_event(record)}, id=entry_id, maxlen=self.maxlen)
+
+            milestone_key = record.get('milestone_key')
+            if milestone_key is not None and record['event'] != 'delete':
+                pipe.sadd(self._index_key(milestone_key), entry_id)
+                pipe.expire(self._index_key(milestone_key), self.index_ttl)
+
+            pipe.publish(self.channel, json.dumps(record))
+
+        results = pipe.execute(raise_on_error=False)
+
+        for result in results:
+            # An id that is not above the last one was appended by another node
+            if isinstance(result, ResponseError) and 'equal or smaller' not in str(result):
+                logger.error("Appending events of block %s failed: %s", height, result)
+
+        logger.debug("Published %s events of block %s", len(records), height)
+
+    def _compact(self, records):
+        """ Remove the logged events of deleted milestones """
+        for record in records:
+            if record['event'] != 'delete' or record.get('milestone_key') is None:
+                continue
+
+            index_key = self._index_key(record['milestone_key'])
+            entry_ids = self.rds.smembers(index_key)
+            if entry_ids:
+                self.rds.xdel(self.stream, *entry_ids)
+            self.rds.delete(index_key)
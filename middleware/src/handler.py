@@ -1,16 +1,16 @@
-import os
 import binascii
-import json
-from redis import Redis
 from logzero import logger
 
+from validator import ValidationError
+from wireformat import script_hash_bytes
+
 
 class CommandHandler():
 
-    def __init__(self, smart_contract, cmd_id, operation, params):
-        self.smart_contract
-        self.rds = Redis(host='redis', port=6379, db=0)
-        redis_auth_token = os.environ.get('REDIS_AUTH_TOKEN', None)
+    def __init__(self, smart_contract, cmd_id, operation, params, reply_to=None, entry_id=None):
+        self.smart_contract = smart_contract
+        self.reply_to = reply_to
+        self.entry_id = entry_id
 
         if operation == 'milestone':
             self.milestone(cmd_id, params)
@@ -18,40 +18,134 @@ class CommandHandler():
         elif operation == 'review':
             self.review(cmd_id, params)
 
+        elif operation == 'refund':
+            self.refund(cmd_id, params)
+
+        elif operation == 'batch':
+            self.batch(cmd_id, params)
+
         else:
             logger.error('Invalid command time %s', operation)
-            response = {
-                'cmd_id': cmd_id,
-                'auth_token': redis_auth_token,
-                'status': 'failed'
-            }
 
-            response = json.dumps(response)
+            # Nothing was queued, so the command is done
+            self.smart_contract.reject(cmd_id, reply_to, entry_id, 'Invalid operation %s' % operation)
 
-            self.rds.publish('neo-response', response)
+    def batch(self, cmd_id, params):
 
-    def milestone(self, cmd_id, params):
+        commands = params['commands']
 
-        milestone_key = binascii.hexlify(params['milestone_key'].encode())
-        agreement = binascii.hexlify(params['agreement'].encode())
-        customer = binascii.hexlify(params['customer'].encode())
-        assignee = binascii.hexlify(params['assignee'].encode())
-        platform = binascii.hexlify(params['platform'].encode())
-        timestamp = binascii.hexlify(params['timestamp'].encode())
-        utc_offset = binascii.hexlify(params['utc_offset'].encode())
-        oracle = binascii.hexlify(params['oracle'].encode())
-        pay_out = binascii.hexlify(params['pay_out'].encode())
-        asset = binascii.hexlify(params['asset'].encode())
-        threshold = binascii.hexlify(params['threshold'].encode())
-
-        self.smart_contract.add_invoke(
-            "milestone", milestone_key, agreement, customer, assignee,
-            platform, timestamp, utc_offset, oracle, pay_out, asset, threshold
+        if not commands:
+            self.smart_contract.ack(self.entry_id)
+            return
+
+        # The stream entry is acked once every command in it is done
+        self.smart_contract.expect(self.entry_id, len(commands))
+
+        for i, command in enumerate(commands):
+            try:
+                self._dispatch(cmd_id, command)
+
+            except Exception:
+                # The queued commands finish as usual, the rest is handled on redelivery
+                self.smart_contract.release_entry(self.entry_id, len(commands) - i)
+                raise
+
+    def _dispatch(self, batch_id, command):
+        """ Handle one command of a batch, an invalid one is rejected on its own """
+        try:
+            if command['operation'] == 'batch':
+                raise ValueError("nested batch")
+
+            CommandHandler(self.smart_contract, command['cmd_id'], command['operation'],
+                           command['params'], self.reply_to, self.entry_id)
+
+        except (ValueError, KeyError, TypeError) as e:
+            logger.error("Invalid command in batch %s: %s", batch_id, e)
+            cmd_id = command.get('cmd_id') if isinstance(command, dict) else None
+            self.smart_contract.reject(cmd_id, self.reply_to, self.entry_id, 'Invalid command')
+
+    def _validate(self, cmd_id, check, params):
+        """ Reject a command the contract would reject anyway, returns whether it is valid """
+        try:
+            check(params)
+            return True
+
+        except ValidationError as e:
+            logger.info("Rejecting command %s: %s", cmd_id, e)
+            self.smart_contract.reject(cmd_id, self.reply_to, self.entry_id, str(e))
+            return False
+
+    @staticmethod
+    def _milestone_args(params):
+        """ The contract arguments of a milestone command, raises on invalid params """
+        # Byte arrays are passed hexlified (ScriptBuilder.push unhexlifies them),
+        # numbers as ints and addresses as their script hash
+        return (
+            binascii.hexlify(params['milestone_key'].encode()),
+            binascii.hexlify(params['agreement'].encode()),
+            binascii.hexlify(script_hash_bytes(params['customer'])),
+            binascii.hexlify(script_hash_bytes(params['assignee'])),
+            binascii.hexlify(params['platform'].encode()),
+            int(params['timestamp']),
+            int(params['utc_offset']),
+            binascii.hexlify(script_hash_bytes(params['oracle'])),
+            int(params['pay_out']),
+            binascii.hexlify(params['asset'].encode()),
+            int(params['threshold'])
         )
 
+    def milestone(self, cmd_id, params):
+
+        # Convert the params first, a command that fails after claiming its key would keep it claimed
+        try:
+            args = self._milestone_args(params)
+
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            logger.info("Rejecting command %s: invalid params (%s)", cmd_id, e)
+            self.smart_contract.reject(cmd_id, self.reply_to, self.entry_id, 'Invalid milestone params')
+            return
+
+        if not self._validate(cmd_id, self.smart_contract.validator.check_milestone, params):
+            return
+
+        # Reviews and refunds of the milestone are scheduled in the lane of its customer
+        customer = args[2]
+        self.smart_contract.validator.set_owner(params['milestone_key'], customer, params['agreement'])
+
+        try:
+            self.smart_contract.add_invoke(
+                "milestone", *args,
+                cmd_id=cmd_id, reply_to=self.reply_to, entry_id=self.entry_id,
+                customer=customer, agreement=params['agreement']
+            )
+
+        except Exception as e:
+            logger.exception("Queueing command %s failed: %s", cmd_id, e)
+            self.smart_contract.reject(cmd_id, self.reply_to, self.entry_id, 'Could not queue the milestone',
+                                       milestone_key=params['milestone_key'])
+
     def review(self, cmd_id, params):
 
+        if not self._validate(cmd_id, self.smart_contract.validator.check_review, params):
+            return
+
+        milestone_key = binascii.hexlify(params['milestone_key'].encode())
+        score = int(params['score'])
+        customer, agreement = self.smart_contract.validator.owner(params['milestone_key'])
+
+        self.smart_contract.add_invoke("review", milestone_key, score,
+                                       cmd_id=cmd_id, reply_to=self.reply_to, entry_id=self.entry_id,
+                                       customer=customer, agreement=agreement)
+
+    def refund(self, cmd_id, params):
+
+        if not self._validate(cmd_id, self.smart_contract.validator.check_refund, params):
+            return
+
         milestone_key = binascii.hexlify(params['milestone_key'].encode())
-        score = binascii.hexlify(params['score'].encode())
+        fee_refund = 1 if params.get('fee_refund') else 0
+        customer, agreement = self.smart_contract.validator.owner(params['milestone_key'])
 
-        self.smart_contract.add_invoke("review", milestone_key, score)
+        self.smart_contract.add_invoke("refund", milestone_key, fee_refund,
+                                       cmd_id=cmd_id, reply_to=self.reply_to, entry_id=self.entry_id,
+                                       customer=customer, agreement=agreement)
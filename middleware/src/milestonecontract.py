@@ -1,17 +1,55 @@
-import time
+import itertools
+import os
 import threading
+import uuid
 
-from queue import Queue
-from redis import Redis
 from logzero import logger
-from twisted.internet import task
 
-from neo.Implementations.Wallets.peewee.UserWallet import UserWallet
-from neo.Prompt.Commands.Invoke import InvokeContract, TestInvokeContract, test_invoke
 from neo.Settings import settings
-from neo.Core.Blockchain import Blockchain
 
 from contrib.smartcontract import SmartContract
+from eventpublisher import ContractEventPublisher
+from redisclient import get_redis
+from responses import publish_response
+from retry import RetryScheduler
+from scheduler import InvokeScheduler
+from txtracker import TxConfirmationTracker
+from validator import CommandValidator, ValidationError, key_from_arg
+from worker import InvokeWorker
+from workerprocess import WorkerProcess
+
+
+class InvokeTask:
+    """ A queued smart contract invoke """
+    method_name = None
+    args = None
+    cmd_id = None
+    reply_to = None  # stream the client waits on for the outcome
+    entry_id = None  # neo-cmd stream entry to ack once the task is finished
+    customer = None  # fairness lanes of the invoke scheduler
+    agreement = None
+    queued_at = None
+    attempts = 0
+
+    def __init__(self, method_name, args, cmd_id=None, reply_to=None, entry_id=None,
+                 customer=None, agreement=None):
+        self.method_name = method_name
+        self.args = args
+        self.cmd_id = cmd_id
+        self.reply_to = reply_to
+        self.entry_id = entry_id
+        self.customer = customer
+        self.agreement = agreement
+        self.attempts = 0
+
+    @property
+    def milestone_key(self):
+        """ Every contract method takes the hexlified milestone_key first """
+        return self.args[0] if self.args else None
+
+    def __repr__(self):
+        return "InvokeTask(%s, %s)" % (self.method_name, str(self.args))
+
 
 # Setup the blockchain task queue
 class MilestoneSmartContract(threading.Thread):
@@ -20,35 +58,83 @@ class MilestoneSmartContract(threading.Thread):
 
     Eg. many api calls want to initiate a smart contract methods, they add them
     to this queue, and they get processed as they can (eg. if gas is available)
-    """
-    smart_contract = None
-    contract_hash = None
 
-    wallet_path = None
-    wallet_pass = None
+    The queue is shared by one InvokeWorker per wallet. This thread assigns
+    every task to the least loaded worker that still has GAS. Tasks leave
+    the queue by priority class, and fairly per customer and agreement
+    within a class (see InvokeScheduler).
 
-    tx_in_progress = None
+    neo-python keeps one wallet database per process, so with several
+    wallets every worker runs in a process of its own (see WorkerProcess).
+    A single wallet is invoked from a thread of this process.
 
-    invoke_queue = None  # Queue items are always a tuple (method_name, args)
-    wallet = None
-    _walletdb_loop = None
+    Reviews and refunds of a milestone whose creation is still pending are
+    held back until the milestone is created or has failed.
+    """
+    smart_contract = None
+    contract_hash = None
 
-    def __init__(self, contract_hash, wallet_path, wallet_pass):
+    workers = None
+    tx_tracker = None
+    validator = None
+    event_publisher = None
+
+    sync_timeout = None
+
+    max_batch_calls = None  # max number of queued calls coalesced in one tx
+    max_batch_gas = None  # max GAS a coalesced tx may consume
+
+    max_in_flight = None  # max unconfirmed txs per worker
+    max_prepared = None  # max test invoked txs waiting for a relay slot per worker
+    min_coins = None  # split a coin when a wallet has fewer GAS coins
+    split_count = None
+    split_value = None
+
+    invoke_queue = None  # InvokeScheduler of InvokeTasks
+    retry_scheduler = None
+    command_stream = None
+    dedup = None
+
+    def __init__(self, contract_hash, wallets, sync_timeout=300, max_attempts=5,
+                 max_batch_calls=10, max_batch_gas=10, max_in_flight=4,
+                 min_coins=10, split_count=20, split_value=1, max_prepared=2, rds=None, chain_dir=None):
+        """
+        wallets is a list of (wallet_path, wallet_pass), one worker is started
+        per wallet. The worker processes of several wallets keep their copy of
+        the chain in chain_dir.
+        """
         super(MilestoneSmartContract, self).__init__()
         self.daemon = True
 
         self.contract_hash = contract_hash
-        self.wallet_path = wallet_path
-        self.wallet_pass = wallet_pass
+        self.max_in_flight = max_in_flight
+        self.max_prepared = max_prepared
+        self.min_coins = min_coins
+        self.split_count = split_count
+        self.split_value = split_value
+        if len(wallets) == 1:
+            self.workers = [InvokeWorker("worker-0", self, *wallets[0])]
+        else:
+            chain_dir = chain_dir or '%s-workers' % settings.LEVELDB_PATH
+            self.workers = [WorkerProcess("worker-%s" % i, self, wallet_path, wallet_pass,
+                                          os.path.join(chain_dir, "worker-%s" % i))
+                            for i, (wallet_path, wallet_pass) in enumerate(wallets)]
+        self._worker_freed = threading.Condition()
+        self.tx_tracker = TxConfirmationTracker()
+        self.validator = CommandValidator()
+        self.sync_timeout = sync_timeout
+        self.max_batch_calls = max_batch_calls
+        self.max_batch_gas = max_batch_gas
 
         self.smart_contract = SmartContract(contract_hash)
-        self.invoke_queue = Queue()
+        self.invoke_queue = InvokeScheduler()
+        self.retry_scheduler = RetryScheduler(self.invoke_queue.put, max_attempts=max_attempts)
+        self._held = {}  # milestone_key -> tasks waiting for the milestone to be created
+        self._held_lock = threading.Lock()
 
-        # Setup redis
-        self.rds = Redis(host='redis', port=6379, db=0)
-
-        self.tx_in_progress = None
-        self.wallet = None
+        # Setup redis on the shared connection pool
+        self.rds = rds or get_redis()
+        self.event_publisher = ContractEventPublisher(self.rds)
 
         settings.set_log_smart_contract_events(False)
 
@@ -63,134 +149,211 @@ class MilestoneSmartContract(threading.Thread):
             if not len(event.event_payload):
                 return
 
-            # The event payload list has at least one element. As developer of the smart contract
-            # you should know what data-type is in the bytes, and how to decode it. In this example,
-            # it's just a string, so we decode it with utf-8:
-            msg = event.event_payload[0].decode("utf-8")
-            self.rds.publish('neo-event', msg)
+            # Test invokes change nothing on chain
+            if event.test_mode:
+                return
+
+            # Keep the known milestone keys and statuses up to date
+            milestone_key = self.validator.on_event(event.event_payload)
+            if milestone_key is not None:
+                self._release(milestone_key)
+
+            # Publish the decoded event once its block is persisted
+            self.event_publisher.on_event(event)
 
-    def add_invoke(self, method_name, *args):
+    def add_invoke(self, method_name, *args, cmd_id=None, reply_to=None, entry_id=None,
+                   customer=None, agreement=None):
         logger.info("SmartContractInvokeQueue add_invoke %s %s" % (method_name, str(args)))
         logger.info("- queue size: %s", self.invoke_queue.qsize())
-        self.invoke_queue.put((method_name, args))
+        self.invoke_queue.put(InvokeTask(method_name, args, cmd_id, reply_to, entry_id,
+                                         customer, agreement))
+
+    def ack(self, entry_id):
+        """ Acknowledge a neo-cmd stream entry that needs no further work """
+        if self.command_stream:
+            self.command_stream.ack(entry_id)
+
+    def expect(self, entry_id, count):
+        """ A batch entry is acknowledged once all its `count` commands are done """
+        if self.command_stream:
+            self.command_stream.expect(entry_id, count)
+
+    def release_entry(self, entry_id, undispatched):
+        """ `undispatched` commands of a batch entry were never queued, have it delivered again """
+        if self.command_stream:
+            self.command_stream.release(entry_id, undispatched)
+
+    def reject(self, cmd_id, reply_to, entry_id, error, milestone_key=None):
+        """
+        Fail a command that never made it to the invoke queue. A milestone
+        command that claimed its key passes milestone_key to free it again.
+        """
+        if milestone_key is not None:
+            self.validator.forget(milestone_key)
+            self._release(milestone_key)
+
+        if self.dedup:
+            self.dedup.complete(cmd_id, 'failed', {'error': error})
+        publish_response(self.rds, reply_to, cmd_id, 'failed', error=error)
+        self.ack(entry_id)
+
+    def _complete(self, task, status, **fields):
+        """ Called once a task reached a final state, replies to the client """
+        if task.method_name == 'milestone':
+            # A created milestone is initialized by its event before the tx
+            # confirms, a key that is still pending was never created
+            milestone_key = key_from_arg(task.milestone_key)
+            self.validator.forget(milestone_key)
+            self._release(milestone_key)
+
+        if self.dedup:
+            self.dedup.complete(task.cmd_id, status, fields)
+        publish_response(self.rds, task.reply_to, task.cmd_id, status, **fields)
+        self.ack(task.entry_id)
+
+    def complete(self, task, outcome):
+        """ A worker invoked the task, outcome has the tx hash, result and confirmation """
+        status = 'confirmed' if outcome['confirmed'] else 'unconfirmed'
+        self._complete(task, status, **outcome)
+
+    def fail(self, task, error):
+        """ The task can never succeed, e.g. the contract rejected it """
+        self._complete(task, 'failed', error=str(error))
+
+    def retry(self, task, error):
+        """ A worker failed to invoke the task, retry later without blocking the other tasks """
+        if not self.retry_scheduler.schedule(task):
+            self.fail(task, error)
+
+    def rejected(self, task, error):
+        """ The contract rejected the call of a single task """
+        # The call may depend on a task for the same milestone that is still
+        # queued or confirming, otherwise it can never succeed
+        if self.has_related(task):
+            logger.info("%s rejected while a task for its milestone is pending, retrying later", task)
+            self.retry(task, error)
+        else:
+            logger.error("%s rejected: %s", task, error)
+            self.fail(task, error)
+
+    def has_related(self, task):
+        """ True while another task for the same milestone is queued, held, retried or invoking """
+        with self._held_lock:
+            held = [other for tasks in self._held.values() for other in tasks]
+
+        others = itertools.chain(self.invoke_queue.tasks(), self.retry_scheduler.pending(), held,
+                                 *(worker.pending_tasks() for worker in self.workers))
+        return any(other is not task and other.milestone_key == task.milestone_key for other in others)
+
+    def _hold(self, task):
+        """ Hold a review or refund while its milestone is not created yet, returns whether it was held """
+        if task.method_name not in ('review', 'refund'):
+            return False
+
+        milestone_key = key_from_arg(task.milestone_key)
+        with self._held_lock:
+            if self.validator.statuses.get(milestone_key) != 'pending':
+                return False
+            self._held.setdefault(milestone_key, []).append(task)
+
+        logger.info("Holding %s until milestone %s is created", task, milestone_key)
+        return True
+
+    def _release(self, milestone_key):
+        """ The milestone was created or is done trying, queue the tasks held for it """
+        with self._held_lock:
+            tasks = self._held.pop(milestone_key, [])
+
+        for task in tasks:
+            self.invoke_queue.put(task)
+
+    def dead_letters(self):
+        """ Tasks that ran out of retry attempts """
+        return self.retry_scheduler.dead_letters()
+
+    def replay_dead_letters(self):
+        """
+        Submit all dead-lettered tasks again. Their commands were answered
+        as failed already, so each goes in as a new command with a new
+        cmd_id and no client waiting for it. A milestone whose key was
+        claimed again in the meantime is skipped. Returns the number of
+        tasks replayed.
+        """
+        replayed = 0
+
+        for task in self.retry_scheduler.take_dead_letters():
+            cmd_id = str(uuid.uuid4())
+
+            if task.method_name == 'milestone':
+                milestone_key = key_from_arg(task.milestone_key)
+                if self.dedup and self.dedup.check(cmd_id, 'milestone', {'milestone_key': milestone_key}, None):
+                    logger.info("Not replaying %s, its milestone_key was claimed again", task)
+                    continue
+                try:
+                    self.validator.claim(milestone_key)
+                except ValidationError:
+                    logger.info("Not replaying %s, its milestone_key was claimed again", task)
+                    if self.dedup:
+                        self.dedup.complete(cmd_id, 'failed', {'error': 'milestone_key not unique'})
+                    continue
+
+            elif self.dedup:
+                self.dedup.check(cmd_id, task.method_name, {}, None)
+
+            logger.info("Replaying %s as command %s", task, cmd_id)
+            self.invoke_queue.put(InvokeTask(task.method_name, task.args, cmd_id,
+                                             customer=task.customer, agreement=task.agreement))
+            replayed += 1
+
+        return replayed
+
+    def queue_stats(self):
+        """ Depth and wait times of the invoke queue per priority class """
+        return self.invoke_queue.stats()
+
+    def worker_stats(self):
+        return [worker.stats() for worker in self.workers]
+
+    def worker_freed(self):
+        """ Called by a worker when it finished its current tasks """
+        with self._worker_freed:
+            self._worker_freed.notify()
+
+    def _select_worker(self):
+        """
+        The least loaded worker with GAS, or the least loaded one if none has
+        GAS. Waits while every worker already has a full batch assigned, so
+        tasks stay in the shared queue until a worker can take them.
+        """
+        with self._worker_freed:
+            while True:
+                available = [worker for worker in self.workers if worker.load() < self.max_batch_calls]
+                if available:
+                    funded = [worker for worker in available if worker.has_gas()]
+                    return min(funded or available, key=lambda worker: worker.load())
+                self._worker_freed.wait(1)
 
     def run(self):
-        while True:
-            task = self.invoke_queue.get()
-            logger.info("SmartContractInvokeQueue Task: %s", str(task))
-            method_name, args = task
-            logger.info("- method_name: %s, args: %s", method_name, task)
-            logger.info("- queue size: %s", self.invoke_queue.qsize())
-
-            try:
-                self.invoke_method(method_name, *args)
-
-            except Exception as e:
-                logger.exception(e)
-
-                # Wait a few seconds
-                logger.info("wait 60 seconds...")
-                time.sleep(60)
-
-                # Re-add the task to the queue
-                logger.info("Re-adding task to queue")
-                self.invoke_queue.put(task)
+        # Confirm relayed transactions from persisted blocks
+        self.tx_tracker.attach()
 
-            finally:
-                # Always mark task as done, because even on error it was done and re-added
-                self.invoke_queue.task_done()
+        # Publish contract events per persisted block
+        self.event_publisher.attach()
+        self.event_publisher.start()
 
-    def open_wallet(self):
-        """ Open a wallet. Needed for invoking contract methods. """
-        assert self.wallet is None
-        self.wallet = UserWallet.Open(self.wallet_path, self.wallet_pass)
-        self._walletdb_loop = task.LoopingCall(self.wallet.ProcessBlocks)
-        self._walletdb_loop.start(1)
+        # Failed tasks are retried from a separate thread after a backoff
+        self.retry_scheduler.start()
 
-    def close_wallet(self):
-        self._walletdb_loop.stop()
-        self._walletdb_loop = None
-        self.wallet = None
+        for worker in self.workers:
+            worker.start()
 
-    def wallet_has_gas(self):
-        # Make sure no tx is in progress and we have GAS
-        synced_balances = self.wallet.GetSyncedBalances()
-        for balance in synced_balances:
-            asset, amount = balance
-            logger.info("- balance %s: %s", asset, amount)
-            if asset == "NEOGas" and amount > 0:
-                return True
-
-        return False
-
-    def _wait_for_tx(self, tx, max_seconds=300):
-        """ Wait for tx to show up on blockchain """
-        sec_passed = 0
-        while sec_passed < max_seconds:
-            _tx, height = Blockchain.Default().GetTransaction(tx.Hash.ToString())
-            if height > -1:
-                return True
-            # logger.info("Waiting for tx {} to show up on blockchain...".format(tx.Hash.ToString()))
-            time.sleep(5)
-            sec_passed += 5
-
-        logger.error("Transaction was relayed but never accepted by consensus node")
-        return False
-
-    def invoke_method(self, method_name, *args):
-        """ invoke a method of the smart contract """
-
-        logger.info("invoke_method: method_name=%s, args=%s", method_name, args)
-        logger.info("Block %s / %s" % (str(Blockchain.Default().Height), str(Blockchain.Default().HeaderHeight)))
-
-        self.open_wallet()
-
-        if not self.wallet:
-            raise Exception("Open a wallet before invoking a smart contract method.")
-
-        if self.tx_in_progress:
-            raise Exception("Transaction already in progress (%s)" % self.tx_in_progress.Hash.ToString())
-
-        logger.info("making sure wallet is synced...")
-        time.sleep(3)
-
-        # Wait until wallet is synced:
         while True:
-            percent_synced = int(100 * self.wallet._current_height / Blockchain.Default().Height)
-            if percent_synced > 99:
-                break
-            logger.info("waiting for wallet sync... height: %s. percent synced: %s" % (self.wallet._current_height, percent_synced))
-            time.sleep(5)
-
-        time.sleep(3)
-        logger.info("wallet synced. checking if gas is available...")
-
-        if not self.wallet_has_gas():
-            raise Exception("Wallet has no gas.")
-
-        _args = [self.contract_hash, method_name, str(list(args))]
-        logger.info("TestInvokeContract args: %s", _args)
-        tx, fee, results, num_ops = TestInvokeContract(self.wallet, _args)
-        if not tx:
-            raise Exception("TestInvokeContract failed")
-
-        logger.info("TestInvokeContract done, calling InvokeContract now...")
-        sent_tx = InvokeContract(self.wallet, tx, fee)
-
-        if sent_tx:
-            logger.info("InvokeContract success, transaction underway: %s" % sent_tx.Hash.ToString())
-            self.tx_in_progress = sent_tx
-
-            found = self._wait_for_tx(sent_tx)
-            if found:
-                logger.info("✅ tansaction found! all done!")
-            else:
-                logger.error("=== TX not found!")
-
-            self.close_wallet()
+            task = self.invoke_queue.get()
+            if self._hold(task):
+                continue
 
-            self.tx_in_progress = None
-            logger.info("InvokeContract done, tx_in_progress freed.")
+            worker = self._select_worker()
+            logger.info("SmartContractInvokeQueue Task: %s -> %s", str(task), worker.name)
+            logger.info("- queue size: %s", self.invoke_queue.qsize())
 
-        else:
-            raise Exception("InvokeContract failed")
+            worker.assign(task)
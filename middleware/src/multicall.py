@@ -0,0 +1,42 @@
+from neo.Core.Blockchain import Blockchain
+from neo.Prompt.Utils import parse_param
+from neo.VM import OpCode
+from neo.VM.ScriptBuilder import ScriptBuilder
+
+
+def build_multicall_script(contract_hash, calls, wallet):
+    """
+    Build one invocation script that calls the contract once per
+    (method_name, args) in `calls`.
+
+    Each call is emitted exactly like TestInvokeContract does for a single
+    call, so every call leaves its return value on the evaluation stack in
+    call order.
+    """
+    contract = Blockchain.Default().GetContract(contract_hash)
+    if not contract:
+        raise Exception("Contract %s not found" % contract_hash)
+
+    script_hash = contract.Code.ScriptHash().Data
+    sb = ScriptBuilder()
+
+    for method_name, args in calls:
+        params = [method_name, str(list(args))]
+        params.reverse()
+
+        for p in params:
+            item = parse_param(p, wallet)
+
+            if type(item) is list:
+                item.reverse()
+                for listitem in item:
+                    sb.push(parse_param(listitem, wallet))
+                sb.push(len(item))
+                sb.Emit(OpCode.PACK)
+
+            else:
+                sb.push(item)
+
+        sb.EmitAppCall(script_hash)
+
+    return sb.ToArray()
@@ -0,0 +1,33 @@
+import json
+import os
+
+from redisclient import get_publisher
+from wireformat import encode_response
+
+
+# Commands without a reply_to still get their response on the old broadcast channel
+BROADCAST_CHANNEL = 'neo-response'
+
+# Replies are kept for clients that reconnect, but not forever
+REPLY_STREAM_MAXLEN = 1000
+REPLY_STREAM_TTL = 86400
+
+
+def publish_response(rds, reply_to, cmd_id, status, **fields):
+    """
+    Send the outcome of a command back to the client that sent it. The
+    write is queued on the shared publisher and pipelined with others.
+    """
+    fields = dict(fields)
+    fields['auth_token'] = os.environ.get('REDIS_AUTH_TOKEN', None)
+
+    publisher = get_publisher(rds)
+
+    if not reply_to:
+        # Subscribers of the broadcast channel still get JSON
+        response = dict(fields, cmd_id=cmd_id, status=status)
+        publisher.publish(BROADCAST_CHANNEL, json.dumps(response))
+        return
+
+    publisher.xadd(reply_to, {'msg': encode_response(cmd_id, status, fields)},
+                   maxlen=REPLY_STREAM_MAXLEN, ttl=REPLY_STREAM_TTL)
@@ -0,0 +1,93 @@
+import heapq
+import itertools
+import threading
+import time
+
+from logzero import logger
+
+
+class RetryScheduler(threading.Thread):
+    """
+    Re-queues failed invoke tasks after an exponential backoff delay.
+
+    Failed tasks wait in a heap ordered by due time, so the invoke worker
+    keeps processing other tasks meanwhile. Tasks that have used up their
+    attempts are moved to a dead-letter list that can be inspected and
+    taken for a replay.
+    """
+    requeue = None  # callable that puts a task back on the invoke queue
+
+    max_attempts = None
+    base_delay = None
+    max_delay = None
+
+    def __init__(self, requeue, max_attempts=5, base_delay=5, max_delay=300):
+        super(RetryScheduler, self).__init__()
+        self.daemon = True
+
+        self.requeue = requeue
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._heap = []
+        self._counter = itertools.count()
+        self._dead_letters = []
+        self._cond = threading.Condition()
+
+    def backoff(self, attempts):
+        """ Delay in seconds before retry number `attempts` """
+        return min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+
+    def schedule(self, task):
+        """
+        Schedule a failed task for retry. Returns False when the task was
+        dead-lettered instead.
+        """
+        task.attempts += 1
+
+        if task.attempts >= self.max_attempts:
+            logger.error("Task %s failed %s times, moving it to the dead-letter list", task, task.attempts)
+            with self._cond:
+                self._dead_letters.append(task)
+            return False
+
+        delay = self.backoff(task.attempts)
+        logger.info("Retrying task %s in %s seconds (attempt %s/%s)", task, delay, task.attempts + 1, self.max_attempts)
+
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._counter), task))
+            self._cond.notify()
+        return True
+
+    def pending(self):
+        with self._cond:
+            return [task for _due, _n, task in sorted(self._heap)]
+
+    def dead_letters(self):
+        with self._cond:
+            return list(self._dead_letters)
+
+    def take_dead_letters(self):
+        """ Remove and return all dead-lettered tasks """
+        with self._cond:
+            tasks = self._dead_letters
+            self._dead_letters = []
+        return tasks
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self._heap:
+                    self._cond.wait()
+
+                due, _n, task = self._heap[0]
+                delay = due - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+
+                heapq.heappop(self._heap)
+
+            logger.info("Re-adding task %s to queue", task)
+            self.requeue(task)
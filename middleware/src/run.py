@@ -6,9 +6,8 @@ and several more.
 More documentation is coming soon.
 """
 import os
+import socket
 import threading
-import json
-from redis import Redis
 from time import sleep
 
 from logzero import logger
@@ -19,8 +18,12 @@ from neo.Core.Blockchain import Blockchain
 from neo.Implementations.Blockchains.LevelDB.LevelDBBlockchain import LevelDBBlockchain
 from neo.Settings import settings
 
+from blockpublisher import BlockPublisher
+from cmdstream import CommandStream
+from dedup import CommandDedup
+from dispatcher import CommandDispatcher
 from milestonecontract import MilestoneSmartContract
-from handler import CommandHandler
+from redisclient import get_redis, run_forever
 
 # Use private net
 settings.setup_privnet()
@@ -29,19 +32,72 @@ settings.setup_privnet()
 # next line. This configures a logfile with max 10 MB and 3 rotations:
 settings.set_logfile("/tmp/logfile.log", max_bytes=1e7, backup_count=3)
 
-# Setup the smart contract instance
-script_hash = os.environ.get('SCRIPT_HASH', None)
-wallet_file = os.environ.get("WALLET_FILE", '/neo-python/neo-privnet.wallet')
-wallet_pwd = os.getenv("WALLET_PWD", "coz")
-smart_contract = MilestoneSmartContract(script_hash, wallet_file, wallet_pwd)
-
-# Setup Redis
-rds = Redis(host='redis', port=6379, db=0)
+# Setup Redis, one connection pool shared by all threads (see redisclient)
+rds = get_redis()
 redis_auth_token = os.environ.get('REDIS_AUTH_TOKEN', None)
 
 if not redis_auth_token:
     logger.error("REDIS_AUTH_TOKEN not set in secrets.env, aborting..")
 
+# Setup the smart contract instance
+script_hash = os.environ.get('SCRIPT_HASH', None)
+# WALLET_FILE and WALLET_PWD may list several wallets separated by commas,
+# an invoke worker is started for each wallet. With several wallets every
+# worker runs in its own process and syncs its own copy of the chain under
+# WORKER_CHAIN_DIR.
+wallet_files = os.environ.get("WALLET_FILE", '/neo-python/neo-privnet.wallet').split(',')
+wallet_pwds = os.getenv("WALLET_PWD", "coz").split(',')
+if len(wallet_pwds) == 1:
+    wallet_pwds = wallet_pwds * len(wallet_files)
+if len(wallet_pwds) != len(wallet_files):
+    logger.error("WALLET_FILE lists %s wallets but WALLET_PWD %s passwords, aborting..",
+                 len(wallet_files), len(wallet_pwds))
+    raise SystemExit(1)
+wallets = list(zip(wallet_files, wallet_pwds))
+wallet_sync_timeout = int(os.getenv("WALLET_SYNC_TIMEOUT", 300))
+invoke_max_attempts = int(os.getenv("INVOKE_MAX_ATTEMPTS", 5))
+invoke_batch_size = int(os.getenv("INVOKE_BATCH_SIZE", 10))
+invoke_batch_gas = float(os.getenv("INVOKE_BATCH_GAS", 10))
+# Unconfirmed txs per wallet, each spends its own GAS coins. Wallets with
+# fewer than UTXO_MIN_COINS coins split a large one into UTXO_SPLIT_COUNT
+# coins of UTXO_SPLIT_VALUE GAS.
+worker_max_in_flight = int(os.getenv("WORKER_MAX_IN_FLIGHT", 4))
+utxo_min_coins = int(os.getenv("UTXO_MIN_COINS", 10))
+utxo_split_count = int(os.getenv("UTXO_SPLIT_COUNT", 20))
+utxo_split_value = float(os.getenv("UTXO_SPLIT_VALUE", 1))
+# Test invoked txs per wallet waiting for a slot to be relayed
+invoke_pipeline_depth = int(os.getenv("INVOKE_PIPELINE_DEPTH", 2))
+smart_contract = MilestoneSmartContract(script_hash, wallets,
+                                        wallet_sync_timeout, invoke_max_attempts,
+                                        invoke_batch_size, invoke_batch_gas,
+                                        worker_max_in_flight, utxo_min_coins,
+                                        utxo_split_count, utxo_split_value,
+                                        invoke_pipeline_depth, rds=rds,
+                                        chain_dir=os.getenv("WORKER_CHAIN_DIR", None))
+
+# Contract events are kept in the neo-events stream for clients to replay
+smart_contract.event_publisher.maxlen = int(os.getenv("EVENT_LOG_MAXLEN", 1000000))
+
+# Commands are read from a Redis Stream shared by all middleware nodes
+node_id = os.environ.get('MIDDLEWARE_NODE_ID', socket.gethostname())
+command_stream = CommandStream(rds, node_id)
+smart_contract.command_stream = command_stream
+
+# Commands re-published by a client are answered with the original result
+dedup = CommandDedup(rds, int(os.getenv("CMD_DEDUP_TTL", 86400)))
+smart_contract.dedup = dedup
+
+# Commands are parsed and dispatched by a pool of threads. The reader blocks
+# while DISPATCH_MAX_PENDING commands are waiting for the pool, the pool
+# blocks while INVOKE_QUEUE_MAX tasks are waiting for a worker.
+dispatcher = CommandDispatcher(smart_contract, command_stream, dedup, redis_auth_token,
+                               int(os.getenv("DISPATCH_POOL_SIZE", 4)),
+                               int(os.getenv("DISPATCH_MAX_PENDING", 100)),
+                               int(os.getenv("INVOKE_QUEUE_MAX", 1000)))
+
+# Publish a summary of every persisted block for the NEOInterface indexes
+block_publisher = BlockPublisher(rds)
+
 def Listener():
 
     """ Custom code run in a background thread. This function is run in a
@@ -51,44 +107,14 @@ def Listener():
     (eg. with signals and events).
     """
 
-    channel = 'neo-cmd'
-    p = rds.pubsub()
-    p.subscribe(channel)
-
-    logger.info('Started monitoring channel {0}'.format(channel))
+    def consume():
+        for entry_id, fields in command_stream.read():
+            dispatcher.submit(entry_id, fields)
 
-    for msg in p.listen():
+    logger.info('Started consuming stream {0} as {1}'.format(command_stream.stream, node_id))
 
-        try:
-            data = json.loads(msg['data'])
-            cmd_id = data['cmd_id']
-            operation = data['operation']
-            params = data['params']
-            auth_token = data['auth_token']
-
-            if auth_token == redis_auth_token:
-                logger.info("Block %s / %s  - dispatching %s command",
-                            str(Blockchain.Default().Height),
-                            str(Blockchain.Default().HeaderHeight), operation)
-
-                CommandHandler(smart_contract, cmd_id, operation, params)
-
-            else:
-                logger.error("Block %s / %s  - unauthorized %s command",
-                            str(Blockchain.Default().Height),
-                            str(Blockchain.Default().HeaderHeight), operation)
-
-                response = {
-                    'cmd_id': cmd_id,
-                    'auth_token': redis_auth_token,
-                    'status': 'failed'
-                }
-                response = json.dumps(response)
-
-                rds.publish('neo-response', response)
-
-        except ValueError as e:
-            print (e)
+    # Keeps reading when Redis restarts, the consumer group is recreated if Redis lost it
+    run_forever(consume, 'Listener', setup=command_stream.setup)
 
 def main():
     # Setup the blockchain
@@ -98,10 +124,15 @@ def main():
     dbloop.start(.1)
     NodeLeader.Instance().Start()
 
+    # Start publishing persisted blocks
+    block_publisher.attach()
+    block_publisher.start()
+
     # Start smart contract thread
     smart_contract.start()
 
-    # Start a thread with listener for remote commands
+    # Start the command dispatcher and a thread with listener for remote commands
+    dispatcher.start()
     d = threading.Thread(target=Listener)
     d.setDaemon(True)
     d.start()
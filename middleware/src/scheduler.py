@@ -0,0 +1,159 @@
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+
+# Priority classes, highest first. Reviews and refunds release funds that
+# people are waiting for, so they go ahead of new milestones.
+PRIORITY_CLASSES = (
+    ('payout', ('review', 'refund')),
+    ('creation', ('milestone',)),
+)
+
+
+def priority_class(method_name):
+    for name, methods in PRIORITY_CLASSES:
+        if method_name in methods:
+            return name
+    return PRIORITY_CLASSES[-1][0]
+
+
+class ClassQueue:
+    """
+    The tasks of one priority class, with a fair share per customer and,
+    within a customer, per agreement.
+    """
+    name = None
+
+    def __init__(self, name):
+        self.name = name
+        self._customers = OrderedDict()  # customer -> OrderedDict(agreement -> deque of tasks)
+        self.depth = 0
+
+        self.enqueued = 0
+        self.dequeued = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def put(self, task):
+        agreements = self._customers.setdefault(task.customer, OrderedDict())
+        agreements.setdefault(task.agreement, deque()).append(task)
+        self.depth += 1
+        self.enqueued += 1
+
+    def get(self):
+        """ Round-robin over customers, then over the agreements of the customer """
+        customer, agreements = next(iter(self._customers.items()))
+        agreement, tasks = next(iter(agreements.items()))
+        task = tasks.popleft()
+
+        if tasks:
+            agreements.move_to_end(agreement)
+        else:
+            del agreements[agreement]
+
+        if agreements:
+            self._customers.move_to_end(customer)
+        else:
+            del self._customers[customer]
+
+        self.depth -= 1
+        self.dequeued += 1
+
+        waited = time.time() - task.queued_at
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+
+        return task
+
+    def tasks(self):
+        return [task for agreements in self._customers.values() for tasks in agreements.values() for task in tasks]
+
+    def oldest_wait(self):
+        """ Seconds the longest waiting task at the head of a lane has been queued """
+        now = time.time()
+        heads = [tasks[0].queued_at for agreements in self._customers.values() for tasks in agreements.values()]
+        return now - min(heads) if heads else 0.0
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'enqueued': self.enqueued,
+            'dequeued': self.dequeued,
+            'wait_avg': self.wait_total / self.dequeued if self.dequeued else 0.0,
+            'wait_max': self.wait_max,
+            'oldest_wait': self.oldest_wait()
+        }
+
+
+class InvokeScheduler:
+    """
+    Replaces the FIFO invoke queue. Has the put/get/qsize interface of a
+    Queue for InvokeTasks.
+
+    Tasks are served by priority class. To keep lower classes moving under
+    a steady stream of high priority tasks, one task of a lower class is
+    served after every `burst` tasks of a higher class. Within a class every
+    customer, and every agreement of a customer, gets its turn, so one bulk
+    import cannot starve the others.
+    """
+    burst = None
+
+    def __init__(self, burst=10):
+        self.burst = burst
+        self._classes = OrderedDict((name, ClassQueue(name)) for name, _methods in PRIORITY_CLASSES)
+        self._served_in_row = 0
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)  # a task was queued
+        self._space = threading.Condition(self._lock)  # a task was taken
+
+    def put(self, task):
+        task.queued_at = time.time()
+        with self._cond:
+            self._classes[priority_class(task.method_name)].put(task)
+            self._cond.notify()
+
+    def get(self):
+        """ Block until a task is queued and return the next one to invoke """
+        with self._cond:
+            while not self.qsize():
+                self._cond.wait()
+            self._space.notify_all()
+            return self._next().get()
+
+    def wait_for_space(self, max_depth):
+        """ Block while max_depth or more tasks are queued, returns the seconds waited """
+        start = time.time()
+        with self._lock:
+            while self.qsize() >= max_depth:
+                self._space.wait()
+        return time.time() - start
+
+    def _next(self):
+        waiting = [queue for queue in self._classes.values() if queue.depth]
+
+        if len(waiting) == 1:
+            self._served_in_row = 0
+            return waiting[0]
+
+        if self._served_in_row >= self.burst:
+            # Let the next class through
+            self._served_in_row = 0
+            return waiting[1]
+
+        self._served_in_row += 1
+        return waiting[0]
+
+    def qsize(self):
+        return sum(queue.depth for queue in self._classes.values())
+
+    def tasks(self):
+        """ A snapshot of the queued tasks """
+        with self._lock:
+            return [task for queue in self._classes.values() for task in queue.tasks()]
+
+    def stats(self):
+        """ Queue depth and wait times in seconds per priority class """
+        with self._cond:
+            return dict((name, queue.stats()) for name, queue in self._classes.items())
@@ -0,0 +1,75 @@
+import threading
+
+from concurrent.futures import Future
+from logzero import logger
+
+from neo.Core.Blockchain import Blockchain
+
+
+class TxConfirmationTracker:
+    """
+    Resolves futures for relayed transactions as soon as the block that
+    contains them is persisted.
+
+    Many hashes can be watched at once. Each persisted block is checked once
+    against the pending set instead of polling GetTransaction per tx.
+    """
+    _pending = None  # tx hash string -> list of futures
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._attached = False
+
+    def attach(self):
+        """ Hook into block persistence, requires a registered blockchain """
+        if self._attached:
+            return
+        Blockchain.Default().PersistCompleted.on_change += self.on_persist_completed
+        self._attached = True
+
+    def watch(self, tx_hash):
+        """ Return a future that resolves with the block height of tx_hash """
+        future = Future()
+
+        with self._lock:
+            self._pending.setdefault(tx_hash, []).append(future)
+
+        # The tx may already have been persisted before we started watching
+        _tx, height = Blockchain.Default().GetTransaction(tx_hash)
+        if height > -1:
+            self._resolve(tx_hash, height)
+
+        return future
+
+    def forget(self, tx_hash):
+        """ Stop watching tx_hash, e.g. after a timeout """
+        with self._lock:
+            futures = self._pending.pop(tx_hash, [])
+        for future in futures:
+            future.cancel()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def on_persist_completed(self, block):
+        with self._lock:
+            if not self._pending:
+                return
+
+        for tx in block.FullTransactions:
+            tx_hash = tx.Hash.ToString()
+            if tx_hash in self._pending:
+                self._resolve(tx_hash, block.Index)
+
+    def _resolve(self, tx_hash, height):
+        with self._lock:
+            futures = self._pending.pop(tx_hash, [])
+
+        if futures:
+            logger.info("tx %s confirmed in block %s", tx_hash, height)
+
+        for future in futures:
+            if not future.done():
+                future.set_result(height)
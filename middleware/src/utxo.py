@@ -0,0 +1,188 @@
+import threading
+
+from logzero import logger
+
+from neo.Core.Blockchain import Blockchain
+from neo.Core.TX.Transaction import ContractTransaction, TransactionOutput
+from neo.Network.NodeLeader import NodeLeader
+from neo.SmartContract.ContractParameterContext import ContractParametersContext
+from neocore.Fixed8 import Fixed8
+
+
+class InsufficientCoins(Exception):
+    pass
+
+
+def coin_key(reference):
+    return (reference.PrevHash.ToString(), reference.PrevIndex)
+
+
+class UtxoManager:
+    """
+    Reserves unspent GAS coins of one wallet for pending invokes.
+
+    Every transaction that is being built gets its own set of coins, so
+    several transactions of the same wallet can be in flight without
+    spending the same coin twice. Change outputs of relayed transactions are
+    tracked until they are confirmed and become spendable again.
+
+    `maintain` splits large coins into `split_count` coins of `split_value`
+    GAS when fewer than `min_coins` coins are available, so there are enough
+    coins to build transactions in parallel.
+    """
+    wallet_session = None
+
+    def __init__(self, wallet_session, min_coins=10, split_count=20, split_value=1):
+        self.wallet_session = wallet_session
+        self.min_coins = min_coins
+        self.split_count = split_count
+        self.split_value = Fixed8.FromDecimal(split_value)
+
+        self._reserved = {}  # coin key -> owner (a tx hash once relayed)
+        self._pending_change = {}  # tx hash -> change value
+        self._lock = threading.Lock()
+
+    @property
+    def wallet(self):
+        return self.wallet_session.wallet
+
+    def _unreserved(self, coins):
+        return sorted((coin for coin in coins if coin_key(coin.Reference) not in self._reserved),
+                      key=lambda coin: coin.Output.Value)
+
+    def available_coins(self):
+        """ Confirmed, unspent and unreserved GAS coins, smallest first """
+        coins = self.wallet.FindUnspentCoinsByAsset(Blockchain.SystemCoin().Hash)
+        with self._lock:
+            return self._unreserved(coins)
+
+    def reserve(self, owner, amount):
+        """ Reserve coins worth at least amount for owner, returns the coins """
+        if amount <= Fixed8.Zero():
+            return []
+
+        unspent = self.wallet.FindUnspentCoinsByAsset(Blockchain.SystemCoin().Hash)
+
+        # Select and mark in one go, the relay and worker threads reserve concurrently
+        with self._lock:
+            coins = self._unreserved(unspent)
+
+            # Prefer the smallest single coin that covers the amount
+            selected = None
+            for coin in coins:
+                if coin.Output.Value >= amount:
+                    selected = [coin]
+                    break
+
+            # Otherwise combine coins, largest first
+            if selected is None:
+                selected = []
+                total = Fixed8.Zero()
+                for coin in reversed(coins):
+                    selected.append(coin)
+                    total += coin.Output.Value
+                    if total >= amount:
+                        break
+                else:
+                    raise InsufficientCoins("%s GAS needed, %s GAS available" % (amount.ToString(), total.ToString()))
+
+            for coin in selected:
+                self._reserved[coin_key(coin.Reference)] = owner
+
+        return selected
+
+    def assign(self, owner, tx):
+        """ The coins of owner are now spent by the relayed tx """
+        tx_hash = tx.Hash.ToString()
+        change = Fixed8.Zero()
+        addresses = set(self.wallet.Addresses)
+
+        for output in tx.outputs:
+            if output.Address in addresses:
+                change += output.Value
+
+        with self._lock:
+            for key, coin_owner in self._reserved.items():
+                if coin_owner == owner:
+                    self._reserved[key] = tx_hash
+            if change > Fixed8.Zero():
+                self._pending_change[tx_hash] = change
+
+    def release(self, owner):
+        """ Free the coins of owner, after its tx was confirmed or never relayed """
+        with self._lock:
+            for key in [key for key, coin_owner in self._reserved.items() if coin_owner == owner]:
+                del self._reserved[key]
+            self._pending_change.pop(owner, None)
+
+    def stats(self):
+        with self._lock:
+            pending_change = sum((value for value in self._pending_change.values()), Fixed8.Zero())
+            return {
+                'reserved_coins': len(self._reserved),
+                'pending_change': pending_change.ToString()
+            }
+
+    def maintain(self):
+        """ Split a large coin when too few coins are available. Returns the split tx or None """
+        coins = self.available_coins()
+        if len(coins) >= self.min_coins:
+            return None
+
+        needed = Fixed8(self.split_value.value * self.split_count)
+        if not coins or coins[-1].Output.Value <= needed:
+            return None
+
+        owner = 'split'
+        try:
+            coins = self.reserve(owner, needed)
+        except InsufficientCoins:
+            # Taken by a tx in the meantime
+            return None
+
+        try:
+            script_hash = self.wallet.GetStandardAddress()
+            outputs = [TransactionOutput(AssetId=Blockchain.SystemCoin().Hash,
+                                         Value=self.split_value,
+                                         script_hash=script_hash)
+                       for _i in range(self.split_count)]
+
+            tx = self.relay(ContractTransaction(outputs=outputs), Fixed8.Zero(), coins)
+
+        except Exception as e:
+            logger.error("Coin split failed: %s", e)
+            self.release(owner)
+            return None
+
+        logger.info("Splitting coins into %s x %s GAS in tx %s", self.split_count,
+                    self.split_value.ToString(), tx.Hash.ToString())
+        self.assign(owner, tx)
+        return tx
+
+    def relay(self, tx, fee, coins):
+        """
+        Complete tx with exactly the given coins as GAS inputs, sign and relay
+        it. This is InvokeContract with the coin selection done by us.
+        """
+        use_vins = None
+        if coins:
+            use_vins = [[coin.Reference for coin in coins], Blockchain.SystemCoin().Hash]
+
+        wallet_tx = self.wallet.MakeTransaction(tx=tx, fee=fee, use_standard=True, use_vins_for_asset=use_vins)
+        if not wallet_tx:
+            raise InsufficientCoins("Could not build the transaction with the reserved coins")
+
+        context = ContractParametersContext(wallet_tx)
+        self.wallet.Sign(context)
+
+        if not context.Completed:
+            raise Exception("Could not sign the transaction")
+
+        wallet_tx.scripts = context.GetScripts()
+
+        if not NodeLeader.Instance().Relay(wallet_tx):
+            raise Exception("Relaying the transaction failed")
+
+        self.wallet.SaveTransaction(wallet_tx)
+        return wallet_tx
+
@@ -0,0 +1,150 @@
+import binascii
+import threading
+import time
+
+from logzero import logger
+
+
+# Mirrors the DAPP SETTINGS of smartcontract/milestone.py
+MIN_TIME = 86400
+MAX_TIME = 31536000
+TIME_MARGIN = 3600
+
+
+class ValidationError(Exception):
+    pass
+
+
+def key_from_arg(value):
+    """ The milestone_key as passed to the contract is the hexlified key """
+    return binascii.unhexlify(value).decode('utf-8')
+
+
+def key_from_event(value):
+    """ Events carry the raw key, ScriptBuilder.push already unhexlified the arg """
+    return value.decode('utf-8')
+
+
+class CommandValidator:
+    """
+    Checks milestone, review and refund commands against the rules of the
+    Milestone, Review and Refund methods of the smart contract, before they
+    take a slot in the invoke queue.
+
+    Known milestone keys and their status are kept in memory. They are
+    learned from accepted commands and from the contract events of every
+    persisted block. A key the validator has never seen is left to the
+    contract to judge, so only commands that would certainly fail are
+    rejected.
+
+    The customer and agreement of the milestones created through this
+    middleware are kept as well, so their reviews and refunds are scheduled
+    in the lane of the customer.
+    """
+    statuses = None  # milestone_key -> 'pending', 'initialized', 'reviewed' or 'refunded'
+    owners = None  # milestone_key -> (customer, agreement)
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.statuses = {}
+        self.owners = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _int(params, name):
+        try:
+            return int(params[name])
+        except (TypeError, ValueError):
+            raise ValidationError("%s must be an integer" % name)
+
+    def check_milestone(self, params):
+        """ Validate a milestone command and claim its key, raises ValidationError """
+        milestone_key = params['milestone_key']
+        if not milestone_key:
+            raise ValidationError("milestone_key is empty")
+
+        timestamp = self._int(params, 'timestamp')
+        self._int(params, 'utc_offset')
+        pay_out = self._int(params, 'pay_out')
+        self._int(params, 'threshold')
+
+        # The contract compares timezone adjusted times, the utc_offset cancels out
+        now = self.clock()
+        if timestamp < now + MIN_TIME - TIME_MARGIN:
+            raise ValidationError("Datetime must be $MIN_TIME seconds ahead")
+
+        if timestamp > now + MAX_TIME + TIME_MARGIN:
+            raise ValidationError("Datetime must be $MAX_TIME seconds ahead")
+
+        if pay_out <= 0:
+            raise ValidationError("Pay_out is zero or negative")
+
+        self.claim(milestone_key)
+
+    def claim(self, milestone_key):
+        """ Claim the key of a milestone that is about to be created, raises ValidationError """
+        with self._lock:
+            if milestone_key in self.statuses:
+                raise ValidationError("milestone_key not unique, please use another")
+            self.statuses[milestone_key] = 'pending'
+
+    def set_owner(self, milestone_key, customer, agreement):
+        with self._lock:
+            self.owners[milestone_key] = (customer, agreement)
+
+    def owner(self, milestone_key):
+        """ The (customer, agreement) of a milestone, (None, None) when unknown """
+        return self.owners.get(milestone_key, (None, None))
+
+    def check_review(self, params):
+        """ Validate a review command, raises ValidationError """
+        self._int(params, 'score')
+
+        status = self.statuses.get(params['milestone_key'])
+        if status == 'refunded':
+            raise ValidationError("Contract is already refunded")
+
+        if status == 'reviewed':
+            raise ValidationError("Contract has incorrect status to do a review")
+
+    def check_refund(self, params):
+        """ Validate a refund command, raises ValidationError """
+        if self.statuses.get(params['milestone_key']) == 'refunded':
+            raise ValidationError("A refund already took place")
+
+    def forget(self, milestone_key):
+        """ A claimed milestone was never created, its key is free again """
+        with self._lock:
+            if self.statuses.get(milestone_key) == 'pending':
+                del self.statuses[milestone_key]
+                self.owners.pop(milestone_key, None)
+
+    def on_event(self, event_payload):
+        """
+        Track milestone status from the contract events (name, milestone_key, ...).
+        Returns the milestone_key whose status changed, if any.
+        """
+        if len(event_payload) < 2:
+            return None
+
+        try:
+            name = event_payload[0].decode('utf-8')
+            milestone_key = key_from_event(event_payload[1])
+        except (AttributeError, ValueError):
+            return None
+
+        with self._lock:
+            if name == 'milestone':
+                self.statuses[milestone_key] = 'initialized'
+            elif name == 'review':
+                self.statuses[milestone_key] = 'reviewed'
+            elif name == 'refund':
+                self.statuses[milestone_key] = 'refunded'
+            elif name == 'delete':
+                self.statuses.pop(milestone_key, None)
+                self.owners.pop(milestone_key, None)
+            else:
+                return None
+
+        logger.debug("milestone %s: %s event", milestone_key, name)
+        return milestone_key
@@ -0,0 +1,100 @@
+import threading
+import time
+
+from logzero import logger
+from twisted.internet import task
+
+from neo.Implementations.Wallets.peewee.UserWallet import UserWallet
+
+
+class WalletSession:
+    """
+    Keeps one wallet open for the lifetime of the invoke thread.
+
+    The wallet is opened once and kept in sync by a background ProcessBlocks
+    loop. When something goes wrong (an invoke fails or the sync loop dies)
+    the session is marked stale and reopened on the next `ensure_open` call.
+
+    Every sync step notifies `wait_for_height` callers, so an invoke wakes up
+    as soon as the wallet has caught up instead of sleeping a fixed time.
+    """
+    wallet_path = None
+    wallet_pass = None
+
+    wallet = None
+    _walletdb_loop = None
+    _stale = False
+
+    def __init__(self, wallet_path, wallet_pass):
+        self.wallet_path = wallet_path
+        self.wallet_pass = wallet_pass
+        self._synced = threading.Condition()
+
+    def open(self):
+        """ Open the wallet and start syncing it in the background """
+        assert self.wallet is None
+        logger.info("Opening wallet %s", self.wallet_path)
+        self.wallet = UserWallet.Open(self.wallet_path, self.wallet_pass)
+        self._walletdb_loop = task.LoopingCall(self._process_blocks)
+        self._walletdb_loop.start(1).addErrback(self._on_loop_error)
+        self._stale = False
+
+    def close(self):
+        if self._walletdb_loop and self._walletdb_loop.running:
+            self._walletdb_loop.stop()
+        self._walletdb_loop = None
+        self.wallet = None
+
+    def reopen(self):
+        logger.info("Reopening wallet %s", self.wallet_path)
+        self.close()
+        self.open()
+
+    def invalidate(self):
+        """ Mark the session as broken, it will be reopened before the next use """
+        self._stale = True
+
+    def ensure_open(self):
+        """ Return the open wallet, (re)opening it only if needed """
+        if self.wallet is None:
+            self.open()
+        elif self._stale:
+            self.reopen()
+        return self.wallet
+
+    def synced_height(self):
+        if self.wallet is None:
+            return 0
+        return self.wallet._current_height
+
+    def wait_for_height(self, height, timeout):
+        """
+        Block until the wallet has processed blocks up to `height`.
+
+        Returns the number of seconds spent waiting, raises an Exception
+        when the wallet did not catch up within `timeout` seconds.
+        """
+        start = time.time()
+        deadline = start + timeout
+
+        with self._synced:
+            while self.synced_height() < height:
+                remaining = deadline - time.time()
+                if remaining <= 0 or self._stale:
+                    raise Exception("Wallet not synced to height %s after %ss (at %s)" % (
+                        height, timeout, self.synced_height()))
+                self._synced.wait(remaining)
+
+        return time.time() - start
+
+    def _process_blocks(self):
+        self.wallet.ProcessBlocks()
+        with self._synced:
+            self._synced.notify_all()
+
+    def _on_loop_error(self, failure):
+        logger.error("Wallet sync loop stopped: %s", failure.getErrorMessage())
+        self._walletdb_loop = None
+        self.invalidate()
+        with self._synced:
+            self._synced.notify_all()
@@ -0,0 +1,454 @@
+import threading
+import time
+
+from queue import Queue, Empty
+from logzero import logger
+
+from neo.Prompt.Commands.Invoke import TestInvokeContract, test_invoke
+from neo.Core.Blockchain import Blockchain
+from neocore.Fixed8 import Fixed8
+
+from multicall import build_multicall_script
+from utxo import UtxoManager, InsufficientCoins
+from wallet import WalletSession
+
+
+class BatchRejected(Exception):
+    """ A coalesced invoke failed its test invoke or went over budget """
+    pass
+
+
+class InvokeRejected(Exception):
+    """ The test invoke of a single call faulted or the contract returned false """
+    pass
+
+
+class PreparedTx:
+    """ A test invoked tx and the tasks it invokes, waiting for relay or confirmation """
+    tx = None
+    fee = None
+    tasks = None
+    outcomes = None  # one dict per task, completed on confirmation
+
+    def __init__(self, tx, fee, tasks, outcomes):
+        self.tx = tx
+        self.fee = fee
+        self.tasks = tasks
+        self.outcomes = outcomes
+
+
+class InvokeWorker(threading.Thread):
+    """
+    Invokes smart contract methods with its own wallet.
+
+    The MilestoneSmartContract dispatcher assigns tasks to the inbox of the
+    least loaded worker that still has GAS. A worker drains up to
+    max_batch_calls tasks from its inbox and invokes them in one
+    transaction. Outcomes and failures are reported back to the dispatcher.
+
+    Every transaction spends GAS coins reserved for it by the UtxoManager,
+    so up to max_in_flight transactions can wait for confirmation at the
+    same time.
+
+    Invokes run as a pipeline of three threads: this thread test invokes
+    tasks as soon as they arrive, a relay thread relays the prepared txs
+    when a slot frees up, and a confirm thread completes the tasks of
+    confirmed txs. Calls the contract rejects fail right away instead of
+    waiting behind the transactions that are still confirming.
+    """
+    contract = None  # the MilestoneSmartContract dispatcher
+    wallet_session = None
+    utxos = None
+    inbox = None
+
+    prepared = None  # Queue of PreparedTx waiting for a relay slot
+    in_flight = None  # tx hash -> relayed PreparedTx
+
+    maintain_interval = 30  # seconds between checks of the coin split
+
+    gas_balance = None  # last synced GAS balance, None until known
+    gas_spent = None
+    tx_count = 0
+
+    def __init__(self, name, contract, wallet_path, wallet_pass):
+        super(InvokeWorker, self).__init__(name=name)
+        self.daemon = True
+
+        self.contract = contract
+        self.wallet_session = WalletSession(wallet_path, wallet_pass)
+        self.utxos = UtxoManager(self.wallet_session, contract.min_coins,
+                                 contract.split_count, contract.split_value)
+        self.inbox = Queue()
+
+        self.prepared = Queue(maxsize=contract.max_prepared)
+        self.in_flight = {}
+        self._in_flight_changed = threading.Condition()
+        self._confirmations = Queue()
+
+        self.gas_balance = None
+        self.gas_spent = Fixed8.Zero()
+        self.tx_count = 0
+        self._processing = []  # tasks taken from the inbox and being test invoked
+        self._maintained_at = 0
+
+    @property
+    def wallet(self):
+        return self.wallet_session.wallet
+
+    def assign(self, task):
+        self.inbox.put(task)
+
+    def load(self):
+        """ Number of calls assigned to this worker and not taken up yet """
+        return self.inbox.qsize() + len(self._processing)
+
+    def in_flight_calls(self):
+        with self._in_flight_changed:
+            return sum(len(tx.tasks) for tx in self.in_flight.values())
+
+    def pending_tasks(self):
+        """ Tasks in the inbox, being test invoked, waiting for a relay slot or for confirmation """
+        with self.inbox.mutex:
+            tasks = list(self.inbox.queue)
+        tasks.extend(self._processing)
+
+        with self.prepared.mutex:
+            for prepared in self.prepared.queue:
+                tasks.extend(prepared.tasks)
+
+        with self._in_flight_changed:
+            for tx in self.in_flight.values():
+                tasks.extend(tx.tasks)
+
+        return tasks
+
+    def has_gas(self):
+        return self.gas_balance is None or self.gas_balance > 0
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'load': self.load(),
+            'prepared_txs': self.prepared.qsize(),
+            'in_flight_txs': len(self.in_flight),
+            'in_flight_calls': self.in_flight_calls(),
+            'gas_balance': self.gas_balance,
+            'gas_spent': self.gas_spent.ToString(),
+            'tx_count': self.tx_count,
+            'utxos': self.utxos.stats()
+        }
+
+    def run(self):
+        # Open the wallet once, it stays open and synced between invokes
+        self.wallet_session.open()
+
+        for target, stage in ((self._relay_loop, 'relay'), (self._confirm_loop, 'confirm')):
+            thread = threading.Thread(target=target, name="%s-%s" % (self.name, stage))
+            thread.daemon = True
+            thread.start()
+
+        while True:
+            try:
+                tasks = self._take_tasks()
+            except Empty:
+                # Nothing to do, make sure there are enough coins for the next burst
+                self._maintain_coins()
+                continue
+
+            self._processing = tasks
+            logger.info("%s tasks: %s", self.name, str(tasks))
+
+            try:
+                self._process(tasks)
+
+            finally:
+                self._processing = []
+                for _task in tasks:
+                    self.inbox.task_done()
+                self.contract.worker_freed()
+
+            # The inbox is never idle under sustained load, when split coins are needed most
+            if time.time() - self._maintained_at >= self.maintain_interval:
+                self._maintain_coins()
+
+    def _take_tasks(self):
+        """ Wait for a task, then drain up to max_batch_calls tasks from the inbox """
+        tasks = [self.inbox.get(timeout=self.maintain_interval)]
+
+        while len(tasks) < self.contract.max_batch_calls:
+            try:
+                tasks.append(self.inbox.get_nowait())
+            except Empty:
+                break
+
+        return tasks
+
+    def _process(self, tasks):
+        """ Test invoke tasks and queue the tx for the relay thread """
+        if len(tasks) == 1:
+            self._process_single(tasks[0])
+            return
+
+        try:
+            prepared = self.test_invoke_batch(tasks)
+
+        except BatchRejected as e:
+            # Split the batch to isolate the call that fails or to fit the budget
+            logger.info("Batch of %s calls rejected (%s), splitting it", len(tasks), e)
+            half = len(tasks) // 2
+            self._process(tasks[:half])
+            self._process(tasks[half:])
+            return
+
+        except Exception as e:
+            logger.exception(e)
+            self.wallet_session.invalidate()
+            for task in tasks:
+                self.contract.retry(task, e)
+            return
+
+        # Blocks while max_prepared txs are already waiting for a slot
+        self.prepared.put(prepared)
+
+    def _process_single(self, task):
+        logger.info("- method_name: %s, args: %s", task.method_name, task.args)
+
+        try:
+            prepared = self.test_invoke_method(task)
+
+        except InvokeRejected as e:
+            self.contract.rejected(task, e)
+            return
+
+        except Exception as e:
+            logger.exception(e)
+
+            # Reopen the wallet before the next invoke
+            self.wallet_session.invalidate()
+
+            self.contract.retry(task, e)
+            return
+
+        self.prepared.put(prepared)
+
+    def _relay_loop(self):
+        """ Relay prepared txs as soon as a slot and coins are available """
+        while True:
+            prepared = self.prepared.get()
+
+            try:
+                self._relay(prepared)
+
+            except Exception as e:
+                logger.exception(e)
+                self.wallet_session.invalidate()
+                for task in prepared.tasks:
+                    self.contract.retry(task, e)
+
+            finally:
+                self.contract.worker_freed()
+
+    def wallet_has_gas(self):
+        # Make sure no tx is in progress and we have GAS
+        self.gas_balance = 0
+
+        synced_balances = self.wallet.GetSyncedBalances()
+        for balance in synced_balances:
+            asset, amount = balance
+            logger.info("- %s balance %s: %s", self.name, asset, amount)
+            if asset == "NEOGas":
+                self.gas_balance = amount
+
+        return self.gas_balance > 0
+
+    def _maintain_coins(self):
+        self._maintained_at = time.time()
+        if self.wallet_session.wallet is None:
+            return
+        try:
+            split_tx = self.utxos.maintain()
+        except Exception as e:
+            logger.error("%s coin maintenance failed: %s", self.name, e)
+            return
+
+        # The split coins are released by the confirm thread like any other tx
+        if split_tx:
+            tx_hash = split_tx.Hash.ToString()
+            with self._in_flight_changed:
+                self.in_flight[tx_hash] = PreparedTx(split_tx, Fixed8.Zero(), [], [])
+            self._watch(tx_hash)
+
+    def _watch(self, tx_hash, max_seconds=300):
+        """ Queue the confirmation of tx_hash, or its timeout, for the confirm thread """
+        confirmation = self.contract.tx_tracker.watch(tx_hash)
+        timer = threading.Timer(max_seconds, self.contract.tx_tracker.forget, [tx_hash])
+        timer.daemon = True
+        timer.start()
+
+        # Callbacks run on the reactor thread, keep them short
+        confirmation.add_done_callback(lambda future: self._confirmations.put((tx_hash, future, timer)))
+
+    def _confirm_loop(self):
+        """ Finish in-flight transactions as their confirmations come in """
+        while True:
+            tx_hash, future, timer = self._confirmations.get()
+            timer.cancel()
+
+            height = None if future.cancelled() else future.result()
+            if height is not None:
+                logger.info("✅ tx %s included in block %s", tx_hash, height)
+            else:
+                logger.error("Transaction %s was relayed but never accepted by consensus node", tx_hash)
+
+            with self._in_flight_changed:
+                tx = self.in_flight.pop(tx_hash, None)
+                self.utxos.release(tx_hash)
+                self._in_flight_changed.notify_all()
+
+            if tx is not None:
+                for task, outcome in zip(tx.tasks, tx.outcomes):
+                    outcome.update({
+                        'tx_hash': tx_hash,
+                        'confirmed': height is not None,
+                        'height': height
+                    })
+                    self.contract.complete(task, outcome)
+
+            self.contract.worker_freed()
+
+    @staticmethod
+    def _stack_item_value(item):
+        """ Convert a VM stack item from a test invoke to a JSON friendly value """
+        item_type = type(item).__name__
+        if item_type == 'Boolean':
+            return item.GetBoolean()
+        if item_type == 'Integer':
+            return item.GetBigInteger()
+        return item.GetByteArray().hex()
+
+    def _prepare_wallet(self):
+        """ Make sure the wallet is open, synced and has GAS """
+
+        self.wallet_session.ensure_open()
+
+        if not self.wallet:
+            raise Exception("Open a wallet before invoking a smart contract method.")
+
+        # Wait until the wallet has caught up with the blockchain
+        waited = self.wallet_session.wait_for_height(Blockchain.Default().Height, self.contract.sync_timeout)
+        logger.info("%s wallet synced after waiting %.3f seconds. checking if gas is available...", self.name, waited)
+
+        if not self.wallet_has_gas():
+            raise Exception("Wallet has no gas.")
+
+    def _reserve_coins(self, owner, amount):
+        """
+        Reserve GAS coins for a new tx. Waits for in-flight txs to free
+        their coins while there are not enough, up to max_in_flight txs.
+        """
+        with self._in_flight_changed:
+            while True:
+                if len(self.in_flight) < self.contract.max_in_flight:
+                    try:
+                        return self.utxos.reserve(owner, amount)
+                    except InsufficientCoins:
+                        if not self.in_flight:
+                            raise
+
+                self._in_flight_changed.wait(1)
+
+    def _relay(self, prepared):
+        """
+        Relay a test invoked tx with its own coins. The tasks are completed
+        by the confirm thread once the tx is confirmed or timed out.
+        """
+        tx, fee = prepared.tx, prepared.fee
+        owner = object()
+        coins = self._reserve_coins(owner, tx.Gas + fee)
+
+        try:
+            sent_tx = self.utxos.relay(tx, fee, coins)
+
+        except Exception:
+            self.utxos.release(owner)
+            raise
+
+        tx_hash = sent_tx.Hash.ToString()
+        logger.info("InvokeContract success, transaction underway: %s" % tx_hash)
+
+        with self._in_flight_changed:
+            self.utxos.assign(owner, sent_tx)
+            self.in_flight[tx_hash] = prepared
+        self.tx_count += 1
+        self.gas_spent += fee + tx.Gas
+
+        self._watch(tx_hash)
+        return tx_hash
+
+    @staticmethod
+    def _accepted(item):
+        """ The contract returns false for calls it rejects """
+        try:
+            return item.GetBoolean()
+        except Exception:
+            return True
+
+    def test_invoke_method(self, task):
+        """
+        Test invoke the method of task. Returns a PreparedTx for the relay
+        thread, raises InvokeRejected when the contract rejects the call.
+        """
+
+        logger.info("test_invoke_method: method_name=%s, args=%s", task.method_name, task.args)
+        logger.info("Block %s / %s" % (str(Blockchain.Default().Height), str(Blockchain.Default().HeaderHeight)))
+
+        self._prepare_wallet()
+
+        _args = [self.contract.contract_hash, task.method_name, str(list(task.args))]
+        logger.info("TestInvokeContract args: %s", _args)
+        tx, fee, results, num_ops = TestInvokeContract(self.wallet, _args)
+        if not tx:
+            raise InvokeRejected("TestInvokeContract failed")
+
+        if results and not self._accepted(results[0]):
+            raise InvokeRejected("%s returned false" % task.method_name)
+
+        logger.info("TestInvokeContract done, queueing the tx for relay...")
+        outcome = {'result': [self._stack_item_value(item) for item in results]}
+        return PreparedTx(tx, fee, [task], [outcome])
+
+    def test_invoke_batch(self, tasks):
+        """
+        Test invoke the calls of several tasks as one transaction. Returns a
+        PreparedTx, every task gets the result of its own call once the tx
+        is confirmed.
+
+        Raises BatchRejected when the combined test invoke fails, one of the
+        calls is rejected or it consumes more than max_batch_gas, so the
+        caller can split the batch.
+        """
+
+        logger.info("test_invoke_batch: %s calls", len(tasks))
+        logger.info("Block %s / %s" % (str(Blockchain.Default().Height), str(Blockchain.Default().HeaderHeight)))
+
+        self._prepare_wallet()
+
+        calls = [(task.method_name, task.args) for task in tasks]
+        script = build_multicall_script(self.contract.contract_hash, calls, self.wallet)
+
+        tx, fee, results, num_ops = test_invoke(script, self.wallet, [])
+        if not tx:
+            raise BatchRejected("test invoke failed")
+
+        if len(results) != len(tasks):
+            raise BatchRejected("expected %s results, got %s" % (len(tasks), len(results)))
+
+        if not all(self._accepted(item) for item in results):
+            raise BatchRejected("a call returned false")
+
+        if tx.Gas > Fixed8.FromDecimal(self.contract.max_batch_gas):
+            raise BatchRejected("consumes %s GAS" % tx.Gas.ToString())
+
+        logger.info("test invoke of batch done, queueing the tx for relay...")
+        outcomes = [{'result': [self._stack_item_value(item)]} for item in results]
+        return PreparedTx(tx, fee, tasks, outcomes)
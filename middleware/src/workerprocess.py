@@ -0,0 +1,303 @@
+"""
+Invoke workers that run in their own process, one per wallet.
+
+neo-python binds the wallet database models to one process-wide peewee
+proxy that every UserWallet.Open re-initializes, so two wallets opened in
+one process write their coins and transactions to the same database. Each
+wallet therefore gets a worker process with its own wallet and its own
+copy of the chain, LevelDB allows one process per chain directory.
+
+The MilestoneSmartContract dispatcher talks to a WorkerProcess, which has
+the interface of an InvokeWorker and forwards the tasks assigned to it to
+the process over a socket pair. The process runs a plain InvokeWorker and
+reports outcomes, failures and its load back.
+"""
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from multiprocessing.connection import Connection
+from queue import Queue
+
+from logzero import logger
+
+
+# Messages from a worker process, (kind, task_id, value) or ('state', None, state)
+COMPLETE = 'complete'
+FAIL = 'fail'
+RETRY = 'retry'
+REJECTED = 'rejected'
+STATE = 'state'
+
+# The contract settings a worker needs, sent to the process when it connects
+CONFIG = ('contract_hash', 'sync_timeout', 'max_batch_calls', 'max_batch_gas', 'max_in_flight',
+          'max_prepared', 'min_coins', 'split_count', 'split_value')
+
+
+class RemoteTask:
+    """ The copy of an InvokeTask in the worker process """
+    task_id = None
+    method_name = None
+    args = None
+
+    def __init__(self, task_id, method_name, args):
+        self.task_id = task_id
+        self.method_name = method_name
+        self.args = args
+
+    def __repr__(self):
+        return "InvokeTask(%s, %s)" % (self.method_name, str(self.args))
+
+
+class WorkerProcess:
+    """
+    Runs an InvokeWorker with its own wallet in a child process.
+
+    Tasks are tracked here until the process reports them done, so the
+    dispatcher sees them in `pending_tasks`. When the process dies its
+    unfinished tasks are retried and a new process is started.
+    """
+    name = None
+    contract = None  # the MilestoneSmartContract dispatcher
+    wallet_path = None
+    wallet_pass = None
+    chain_path = None
+
+    command = None  # the worker process, defaults to running this module
+    restart_delay = 5  # seconds before a dead worker process is started again
+
+    def __init__(self, name, contract, wallet_path, wallet_pass, chain_path):
+        self.name = name
+        self.contract = contract
+        self.wallet_path = wallet_path
+        self.wallet_pass = wallet_pass
+        self.chain_path = chain_path
+        self.command = [sys.executable, os.path.abspath(__file__)]
+
+        self.process = None
+        self._outbox = Queue()  # tasks waiting to be sent to the process
+        self._assigned = {}  # task_id -> task sent and not reported done
+        self._task_ids = iter(range(1, sys.maxsize))
+        self._lock = threading.Lock()
+
+        self._sent = 0  # tasks assigned since the process was started
+        self._state = {'received': 0, 'load': 0, 'has_gas': True, 'stats': {}}
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name=self.name)
+        thread.daemon = True
+        thread.start()
+
+    def assign(self, task):
+        with self._lock:
+            task_id = next(self._task_ids)
+            self._assigned[task_id] = task
+            self._sent += 1
+        self._outbox.put((task_id, task.method_name, task.args))
+
+    def load(self):
+        """ Calls assigned to the worker and not taken up yet, including those still in transit """
+        with self._lock:
+            return self._state['load'] + self._sent - self._state['received']
+
+    def has_gas(self):
+        return self._state['has_gas']
+
+    def pending_tasks(self):
+        with self._lock:
+            return list(self._assigned.values())
+
+    def stats(self):
+        stats = dict(self._state['stats'], name=self.name, load=self.load())
+        stats['pid'] = self.process.pid if self.process else None
+        return stats
+
+    def _run(self):
+        while True:
+            try:
+                self._serve()
+            except Exception as e:
+                logger.exception("%s failed: %s", self.name, e)
+
+            self._retry_assigned("worker process %s exited" % self.name)
+            time.sleep(self.restart_delay)
+
+    def _serve(self):
+        """ Start the process and relay messages until it exits """
+        parent_sock, child_sock = socket.socketpair()
+        conn = Connection(parent_sock.detach())
+
+        env = dict(os.environ, INVOKE_WORKER_FD=str(child_sock.fileno()))
+        logger.info("Starting %s for wallet %s", self.name, self.wallet_path)
+        try:
+            self.process = subprocess.Popen(self.command, env=env, pass_fds=[child_sock.fileno()])
+        finally:
+            # Only the process holds the other end, its exit is seen as EOF
+            child_sock.close()
+
+        config = dict((name, getattr(self.contract, name)) for name in CONFIG)
+        config.update(name=self.name, wallet_path=self.wallet_path, wallet_pass=self.wallet_pass,
+                      chain_path=self.chain_path)
+        conn.send(config)
+
+        # Tasks assigned while no process was running are sent first
+        with self._lock:
+            self._sent = self._outbox.qsize()
+            self._state = dict(self._state, received=0, load=0)
+
+        sender = threading.Thread(target=self._send_loop, args=(conn,), name="%s-send" % self.name)
+        sender.daemon = True
+        sender.start()
+
+        try:
+            while True:
+                kind, task_id, value = conn.recv()
+                self._on_message(kind, task_id, value)
+        except (EOFError, OSError):
+            logger.error("%s exited with %s", self.name, self.process.wait())
+        finally:
+            self._outbox.put(None)
+            conn.close()
+            sender.join()
+
+    def _send_loop(self, conn):
+        while True:
+            message = self._outbox.get()
+            if message is None:
+                return
+            try:
+                conn.send(message)
+            except (OSError, EOFError):
+                # The task stays assigned and is retried once the process is gone
+                return
+
+    def _on_message(self, kind, task_id, value):
+        if kind == STATE:
+            with self._lock:
+                self._state = value
+            self.contract.worker_freed()
+            return
+
+        with self._lock:
+            task = self._assigned.pop(task_id, None)
+        if task is None:
+            return
+
+        if kind == COMPLETE:
+            self.contract.complete(task, value)
+        elif kind == FAIL:
+            self.contract.fail(task, value)
+        elif kind == RETRY:
+            self.contract.retry(task, value)
+        elif kind == REJECTED:
+            self.contract.rejected(task, value)
+
+    def _retry_assigned(self, error):
+        """ Retry the tasks of a dead process, a new process gets the queued ones """
+        with self._lock:
+            tasks = list(self._assigned.values())
+            self._assigned.clear()
+
+        # Tasks still in the outbox were never sent, they are retried as well
+        while not self._outbox.empty():
+            self._outbox.get_nowait()
+
+        for task in tasks:
+            logger.warning("Retrying %s, %s", task, error)
+            self.contract.retry(task, error)
+
+
+class RemoteContract:
+    """
+    The dispatcher as seen by the InvokeWorker in a worker process, reports
+    back over the connection to the WorkerProcess.
+    """
+    worker = None
+    tx_tracker = None
+
+    def __init__(self, conn, config, tx_tracker):
+        self.conn = conn
+        self.tx_tracker = tx_tracker
+        for name in CONFIG:
+            setattr(self, name, config[name])
+
+        self.received = 0
+        self._lock = threading.Lock()
+
+    def _send(self, kind, task_id=None, value=None):
+        with self._lock:
+            self.conn.send((kind, task_id, value))
+
+    def complete(self, task, outcome):
+        self._send(COMPLETE, task.task_id, outcome)
+
+    def fail(self, task, error):
+        self._send(FAIL, task.task_id, str(error))
+
+    def retry(self, task, error):
+        self._send(RETRY, task.task_id, str(error))
+
+    def rejected(self, task, error):
+        self._send(REJECTED, task.task_id, str(error))
+
+    def worker_freed(self):
+        self._send(STATE, value={
+            'received': self.received,
+            'load': self.worker.load(),
+            'has_gas': self.worker.has_gas(),
+            'stats': self.worker.stats()
+        })
+
+
+def main():
+    """ Entry point of a worker process, started by WorkerProcess """
+    from twisted.internet import reactor, task
+
+    from neo.Network.NodeLeader import NodeLeader
+    from neo.Core.Blockchain import Blockchain
+    from neo.Implementations.Blockchains.LevelDB.LevelDBBlockchain import LevelDBBlockchain
+    from neo.Settings import settings
+
+    from txtracker import TxConfirmationTracker
+    from worker import InvokeWorker
+
+    conn = Connection(int(os.environ['INVOKE_WORKER_FD']))
+    config = conn.recv()
+
+    # Same network as run.py, with a chain directory of its own
+    settings.setup_privnet()
+    blockchain = LevelDBBlockchain(config['chain_path'])
+    Blockchain.RegisterBlockchain(blockchain)
+    dbloop = task.LoopingCall(Blockchain.Default().PersistBlocks)
+    dbloop.start(.1)
+    NodeLeader.Instance().Start()
+
+    contract = RemoteContract(conn, config, TxConfirmationTracker())
+    contract.tx_tracker.attach()
+    worker = InvokeWorker(config['name'], contract, config['wallet_path'], config['wallet_pass'])
+    contract.worker = worker
+    worker.start()
+
+    def receive():
+        try:
+            while True:
+                task_id, method_name, args = conn.recv()
+                contract.received += 1
+                worker.assign(RemoteTask(task_id, method_name, args))
+        except EOFError:
+            logger.error("%s lost its dispatcher, exiting", config['name'])
+            reactor.callFromThread(reactor.stop)
+
+    thread = threading.Thread(target=receive, name="%s-receive" % config['name'])
+    thread.daemon = True
+    thread.start()
+
+    logger.info("%s running with wallet %s", config['name'], config['wallet_path'])
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
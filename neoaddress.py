@@ -0,0 +1,62 @@
+"""
+Local NEO address handling.
+
+A NEO address is the base58check encoding of a version byte followed by the
+20 byte script hash. Decoding it locally gives the same script hash as the
+get_account RPC call without the round trip.
+"""
+from functools import lru_cache
+from hashlib import sha256
+
+
+B58_ALPHABET = '123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz'
+B58_INDEX = dict((char, index) for index, char in enumerate(B58_ALPHABET))
+
+ADDRESS_VERSION = 23
+
+# Number of decoded addresses kept in memory
+CACHE_SIZE = 4096
+
+
+def b58decode(value):
+
+    number = 0
+    for char in value:
+        try:
+            number = number * 58 + B58_INDEX[char]
+        except KeyError:
+            raise ValueError("Invalid base58 character %r" % char)
+
+    body = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    padding = len(value) - len(value.lstrip('1'))
+
+    return b'\x00' * padding + body
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def address_to_script_hash(address):
+    """
+    Decode an address to its script hash in the notation of the RPC
+    get_account result ('0x' followed by the big endian hex hash).
+    Raises ValueError for invalid addresses.
+    """
+    data = b58decode(address)
+
+    if len(data) != 25 or data[0] != ADDRESS_VERSION:
+        raise ValueError("Invalid address %s" % address)
+
+    checksum = sha256(sha256(data[:21]).digest()).digest()[:4]
+    if checksum != data[21:]:
+        raise ValueError("Invalid address checksum %s" % address)
+
+    return '0x' + data[1:21][::-1].hex()
+
+
+def is_valid_address(address):
+
+    try:
+        address_to_script_hash(address)
+    except (ValueError, TypeError):
+        return False
+
+    return True
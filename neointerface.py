@@ -1,53 +1,254 @@
 import os
+import logging
 import time
 import uuid
-import json
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from distutils.util import strtobool
-from neorpc.Client import RPCClient, RPCEnpoint
 from neorpc.Settings import SettingsHolder
-from redis import Redis
+
+from balancecache import BalanceCache
+from blockfeed import BlockFeed
+from eventlog import EventLog
+from neoaddress import address_to_script_hash, is_valid_address
+from rpccache import CachingRPCClient
+from redisclient import get_redis, run_forever
+from rpcpool import RPCPool
+from txindex import TransactionIndex
+from wireformat import encode_command, response_from_entry
+
+
+logger = logging.getLogger(__name__)
+
+
+class ChainCache:
+    """
+    A BlockFeed with the payment index and the balance cache it keeps up to
+    date. The feed replays the block stream when it starts, so there is one
+    per process and Redis server, shared by every NEOInterface.
+    """
+    block_feed = None
+    tx_index = None
+    balance_cache = None
+
+    def __init__(self, rds, history):
+        self.tx_index = TransactionIndex(retention=history)
+        self.balance_cache = BalanceCache()
+
+        self.block_feed = BlockFeed(rds, history=history)
+        self.block_feed.subscribe(self.tx_index)
+        self.block_feed.subscribe(self.balance_cache)
+        self.block_feed.start()
+
+
+class ReplyListener:
+    """
+    Resolves the futures of the commands sent from this process. The
+    middleware replies on one stream per process, read by one thread that
+    is started with the first command.
+    """
+    rds = None
+    reply_stream = None
+
+    def __init__(self, rds):
+        self.rds = rds
+        self.reply_stream = 'neo-response:%s' % uuid.uuid4()
+        self._pending = {}  # cmd_id -> Future
+        self._lock = threading.Lock()
+        self._thread = None
+        self._last_id = '0'
+
+    def expect(self, cmd_id):
+        """ Return the Future for the reply to cmd_id """
+        future = Future()
+        future.cmd_id = cmd_id
+
+        with self._lock:
+            self._pending[cmd_id] = future
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name='NEOInterface reply listener')
+                self._thread.daemon = True
+                self._thread.start()
+
+        return future
+
+    def _listen(self):
+        run_forever(self._read_replies, 'NEOInterface reply listener')
+
+    def _read_replies(self):
+        result = self.rds.xread({self.reply_stream: self._last_id}, block=5000)
+
+        for _stream, entries in result or []:
+            for entry_id, fields in entries:
+                self._last_id = entry_id
+                try:
+                    response = response_from_entry(fields)
+                except (KeyError, ValueError) as e:
+                    logger.error("Skipping malformed reply %s: %s", entry_id, e)
+                    continue
+
+                with self._lock:
+                    future = self._pending.pop(response['cmd_id'], None)
+
+                if future is not None and not future.done():
+                    future.set_result(response)
+
+            if entries:
+                self.rds.xdel(self.reply_stream, *[entry_id for entry_id, _fields in entries])
+
+
+_chain_caches = {}
+_reply_listeners = {}
+_shared_lock = threading.Lock()
+
+
+def _shared(registry, rds, create):
+    """ The object of registry for this process and the pool of rds, created on first use """
+    key = (os.getpid(), id(rds.connection_pool))
+
+    with _shared_lock:
+        shared = registry.get(key)
+        if shared is None:
+            shared = create()
+            registry[key] = shared
+        return shared
+
+
+def get_chain_cache(rds, history):
+    return _shared(_chain_caches, rds, lambda: ChainCache(rds, history))
+
+
+def get_reply_listener(rds):
+    return _shared(_reply_listeners, rds, lambda: ReplyListener(rds))
 
 
 class NEOInterface():
 
-    def __init__(self, use_privnet=True):
+    # Approximate number of commands kept in the neo-cmd stream
+    cmd_stream_maxlen = 100000
+
+    # Maximum number of commands in one batch stream entry
+    batch_size = 100
+
+    # Blocks the payment index covers, check_transaction finds payments up to this deep
+    block_history = 100000
+
+    def __init__(self, use_privnet=True, use_block_feed=True, rpc_endpoints=None, fetch_concurrency=10):
 
         settings = SettingsHolder()
 
-        if use_privnet:
+        if rpc_endpoints:
+
+            addr_list = rpc_endpoints
+
+        elif use_privnet:
 
             addr_list = [
                 "http://private_net:20332"
             ]
 
-            settings.setup(addr_list)
-
         else:
             settings.setup_mainnet()
+            addr_list = settings.RPC_LIST
 
-        self.neo_rpc_client = RPCClient(settings)
-        self.rds = Redis(host='redis', port=6379, db=0)
+        # Calls are spread over a pool of endpoints with failover, confirmed
+        # blocks and transactions are served from a cache
+        self.neo_rpc_client = CachingRPCClient(RPCPool(addr_list),
+                                               path=os.environ.get('NEO_RPC_CACHE_PATH', None))
+        self.rds = get_redis()
         self.nm_auth_token = os.environ.get('NM_AUTH_TOKEN', None)
 
-    def check_funds(self, address, amount, asset):
+        # The middleware replies to the commands of this process on one stream
+        self.reply_listener = get_reply_listener(self.rds)
+        self.reply_stream = self.reply_listener.reply_stream
+
+        # Fetches of many accounts at once, apart from the executor the RPCPool hedges on
+        self._fetch_executor = ThreadPoolExecutor(max_workers=fetch_concurrency)
+
+        # Payments and balances are kept in local caches fed by the middleware,
+        # shared by the instances in this process
+        self.block_feed = None
+        self.tx_index = None
+        self.balance_cache = None
+
+        if use_block_feed:
+            chain_cache = get_chain_cache(self.rds, self.block_history)
+            self.block_feed = chain_cache.block_feed
+            self.tx_index = chain_cache.tx_index
+            self.balance_cache = chain_cache.balance_cache
+
+    def _get_account(self, address):
 
         account = None
 
         while not account:
             account = self.neo_rpc_client.get_account(address)
 
-        balances = account['balances']
+        return account
+
+    def _get_balances(self, address):
+
+        # Without the block feed nothing would invalidate cached balances
+        if self.block_feed is None:
+            account = self._get_account(address)
+            return dict((i['asset'], i['value']) for i in account['balances'])
+
+        return self.balance_cache.get(address, self._get_account)
+
+    def _get_balances_many(self, addresses):
+
+        if self.block_feed is None:
+            unique = list(set(addresses))
+            accounts = self._fetch_executor.map(self._get_account, unique)
+            return dict((address, dict((i['asset'], i['value']) for i in account['balances']))
+                        for address, account in zip(unique, accounts))
+
+        return self.balance_cache.get_many(addresses, self._fetch_executor, self._get_account)
+
+    @staticmethod
+    def _has_funds(balances, amount, asset):
 
-        for i in balances:
-            if i['asset'] == asset:
-                if int(i['value']) >= amount:
-                    return True
+        if asset in balances:
+            if int(balances[asset]) >= amount:
+                return True
 
         return False
 
+    def check_funds(self, address, amount, asset):
+
+        return self._has_funds(self._get_balances(address), amount, asset)
+
+    def check_funds_many(self, addresses, asset, amount):
+        """
+        Check the funds of many addresses in one pass. The balances missing
+        from the cache are fetched concurrently, then every address is
+        answered from them. Returns a dict of address -> bool.
+        """
+        balances = self._get_balances_many(addresses)
+
+        return dict((address, self._has_funds(balances[address], amount, asset)) for address in addresses)
+
     def check_transaction(self, sender, receiver, amount, asset, min_conf):
 
+        # Until the block feed has caught up the index may miss payments
+        if self.block_feed is None or not self.block_feed.caught_up.is_set():
+            return self._check_transaction_rpc(sender, receiver, amount, asset, min_conf)
+
+        payment = self.tx_index.find_payment(sender, receiver, amount, asset)
+
+        if payment is None:
+            return False
+
+        txid, height = payment
+        confirmations = self.block_feed.height - height + 1
+
+        return confirmations >= int(min_conf)
+
+    def _check_transaction_rpc(self, sender, receiver, amount, asset, min_conf):
+        """ Look for the payment in the latest block over RPC """
+
         height = None
 
         while not height:
@@ -69,10 +270,10 @@ class NEOInterface():
             if i['type'] == 'ContractTransaction':
                 txid = i['txid']
                 transaction = self.neo_rpc_client.get_transaction(txid)
-                if transaction['vout'][0]['address'] == 'receiver':
-                    if transaction['vout'][1]['address'] == 'sender':
+                if transaction['vout'][0]['address'] == receiver:
+                    if transaction['vout'][1]['address'] == sender:
                         if int(transaction['vout'][0]['value']) == int(amount):
-                            if transaction['vout'][0] == asset:
+                            if transaction['vout'][0]['asset'] == asset:
                                 if confirmations >= int(min_conf):
                                     return True
 
@@ -80,71 +281,172 @@ class NEOInterface():
 
     def validate_addr(self, address):
 
-        result = None
-
-        while not result:
-            result = self.neo_rpc_client.validate_addr(address)
-
-        return result
+        # Same result layout as the validateaddress RPC call
+        return {'address': address, 'isvalid': is_valid_address(address)}
 
     def address_to_hash(self, address):
 
-        account = self.neo_rpc_client.get_account(address)
-        script_hash = account['script_hash']
-
-        return script_hash
+        # Decoded locally (and cached) instead of a get_account RPC call
+        return address_to_script_hash(address)
 
     def add_milestone(self, dapp_script_hash, milestone_key, agreement,
                       neo_address_customer, neo_address_assignee, platform,
                       timestamp, utc_offset, neo_address_oracle, pay_out,
                       asset, threshold):
 
+        params = self._milestone_params(
+            self.address_to_hash, milestone_key, agreement, neo_address_customer,
+            neo_address_assignee, platform, timestamp, utc_offset,
+            neo_address_oracle, pay_out, asset, threshold)
+
+        return self._send_command('milestone', params)
+
+    def add_milestones(self, dapp_script_hash, milestones):
+        """
+        Add many milestones with one write to the middleware.
+
+        milestones is a list of dicts with the keyword arguments of
+        add_milestone (without dapp_script_hash). Every address is resolved
+        once for the whole batch. Returns a list of Futures in the same order,
+        each with a cmd_id attribute.
+        """
+        addresses = set()
+        for milestone in milestones:
+            addresses.add(milestone['neo_address_customer'])
+            addresses.add(milestone['neo_address_assignee'])
+            addresses.add(milestone['neo_address_oracle'])
+
+        hashes = dict((address, self.address_to_hash(address)) for address in addresses)
+
+        commands = []
+        for milestone in milestones:
+            params = self._milestone_params(hashes.get, **milestone)
+            commands.append(('milestone', params))
+
+        return self._send_batch(commands)
+
+    def _milestone_params(self, resolve, milestone_key, agreement,
+                          neo_address_customer, neo_address_assignee, platform,
+                          timestamp, utc_offset, neo_address_oracle, pay_out,
+                          asset, threshold):
+
         params = {}
         params['milestone_key'] = milestone_key
         params['agreement'] = agreement
-        customer_hash = self.address_to_hash(neo_address_customer)
+        customer_hash = resolve(neo_address_customer)
         params['customer'] = customer_hash
-        assignee_hash = self.address_to_hash(neo_address_assignee)
+        assignee_hash = resolve(neo_address_assignee)
         params['assignee'] = assignee_hash
         params['platform'] = platform
         params['timestamp'] = timestamp
         params['utc_offset'] = utc_offset
-        oracle_hash = self.address_to_hash(neo_address_oracle)
+        oracle_hash = resolve(neo_address_oracle)
         params['oracle'] = oracle_hash
         params['pay_out'] = pay_out
         params['asset'] = asset
         params['threshold'] = threshold
 
-        cmd_id = uuid.uuid4()
-        operation = 'milestone'
+        return params
 
-        data = {
-            'auth_token': self.nm_auth_token,
-            'cmd_id': cmd_id,
-            'operation': operation,
-            'params': params
-        }
+    def review_milestone(self, dapp_script_hash, milestone_key, score):
+
+        params = {}
+        params['milestone_key'] = milestone_key
+        params['score'] = score
 
-        data = json.dumps(data)
+        return self._send_command('review', params)
 
-        self.rds.publish('neo-cmd', data)
+    def review_milestones(self, dapp_script_hash, reviews):
+        """
+        Review many milestones with one write to the middleware.
 
-    def review_milestone(self, dapp_script_hash, milestone_key, score):
+        reviews is a list of (milestone_key, score) tuples. Returns a list of
+        Futures in the same order, each with a cmd_id attribute.
+        """
+        commands = []
+        for milestone_key, score in reviews:
+            params = {}
+            params['milestone_key'] = milestone_key
+            params['score'] = score
+            commands.append(('review', params))
+
+        return self._send_batch(commands)
+
+    def refund_milestone(self, dapp_script_hash, milestone_key, fee_refund=False):
 
         params = {}
         params['milestone_key'] = milestone_key
-        params['score'] = score
+        params['fee_refund'] = fee_refund
+
+        return self._send_command('refund', params)
 
-        cmd_id = uuid.uuid4()
-        operation = 'review'
+    def follow_events(self, subscriber, from_height=0, after_id=None):
+        """
+        Replay the contract events from a block height, or after an event
+        id, and keep following new ones. subscriber.on_event(event) is
+        called for every event. Returns the started EventLog, its last_id
+        is where to resume later.
+        """
+        event_log = EventLog(self.rds, from_height, after_id)
+        event_log.subscribe(subscriber)
+        event_log.start()
 
-        data = {
-            'auth_token': self.nm_auth_token,
+        return event_log
+
+    def _new_command(self, operation, params):
+        """ Build a command and register the Future for its reply """
+        cmd_id = str(uuid.uuid4())
+        future = self.reply_listener.expect(cmd_id)
+
+        command = {
             'cmd_id': cmd_id,
             'operation': operation,
             'params': params
         }
 
-        data = json.dumps(data)
+        return command, future
+
+    def _envelope(self, command):
+        return {'msg': encode_command(command['cmd_id'], command['operation'], command['params'],
+                                      self.nm_auth_token, self.reply_stream)}
+
+    def _send_command(self, operation, params):
+        """
+        Append a command to the neo-cmd stream.
+
+        Returns a Future that resolves with the middleware response, a dict
+        with the cmd_id, status ('confirmed', 'unconfirmed' or 'failed'),
+        tx_hash, result and height.
+        """
+        command, future = self._new_command(operation, params)
+
+        self.rds.xadd('neo-cmd', self._envelope(command), maxlen=self.cmd_stream_maxlen)
+
+        return future
+
+    def _send_batch(self, commands):
+        """
+        Append (operation, params) commands to the neo-cmd stream as batch
+        commands of at most batch_size items, all in one pipelined write.
+        Returns a list of Futures in the same order.
+        """
+        futures = []
+        pipe = self.rds.pipeline(transaction=False)
+
+        for start in range(0, len(commands), self.batch_size):
+            items = []
+            for operation, params in commands[start:start + self.batch_size]:
+                command, future = self._new_command(operation, params)
+                items.append(command)
+                futures.append(future)
+
+            batch = {
+                'cmd_id': str(uuid.uuid4()),
+                'operation': 'batch',
+                'params': {'commands': items}
+            }
+            pipe.xadd('neo-cmd', self._envelope(batch), maxlen=self.cmd_stream_maxlen)
+
+        pipe.execute()
 
-        self.rds.publish('neo-cmd', data)
+        return futures
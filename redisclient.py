@@ -0,0 +1,298 @@
+import os
+import time
+import asyncio
+import logging
+import threading
+
+from queue import Queue, Empty
+
+from redis import ConnectionPool, Redis
+from redis.connection import Connection
+from redis.exceptions import ConnectionError, TimeoutError
+
+
+logger = logging.getLogger(__name__)
+
+
+class RedisMetrics:
+    """ Process-wide connection counters of all pools created here """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            'connects': 0,
+            'connect_errors': 0,
+            'disconnects': 0,
+            'reconnects': 0,  # listeners that recovered from a lost connection
+            'published': 0,
+            'publish_batches': 0,
+            'publish_errors': 0
+        }
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+
+metrics = RedisMetrics()
+
+
+class MeteredConnection(Connection):
+    """ A redis-py connection that reports connects and disconnects to `metrics` """
+
+    def connect(self):
+        if self._sock:
+            return
+        try:
+            super(MeteredConnection, self).connect()
+        except ConnectionError:
+            metrics.count('connect_errors')
+            raise
+        metrics.count('connects')
+
+    def disconnect(self, *args, **kwargs):
+        # redis-py passes the error and failure count of a failed connect
+        if self._sock is not None:
+            metrics.count('disconnects')
+        super(MeteredConnection, self).disconnect(*args, **kwargs)
+
+
+_pools = {}
+_publishers = {}
+_lock = threading.Lock()
+
+
+def _address(host=None, port=None, db=None):
+    """ The Redis server to use, from the arguments or the environment """
+    host = host or os.environ.get('REDIS_HOST', 'redis')
+    port = int(port or os.environ.get('REDIS_PORT', 6379))
+    db = int(db or os.environ.get('REDIS_DB', 0))
+    return host, port, db
+
+
+def get_pool(host=None, port=None, db=None):
+    """ The process-wide connection pool for a Redis server, created on first use """
+    host, port, db = _address(host, port, db)
+
+    with _lock:
+        pool = _pools.get((host, port, db))
+        if pool is None:
+            pool = ConnectionPool(host=host, port=port, db=db,
+                                  connection_class=MeteredConnection,
+                                  max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)))
+            _pools[(host, port, db)] = pool
+        return pool
+
+
+def get_redis(host=None, port=None, db=None):
+    """ A Redis client on the shared pool, clients are cheap and thread safe """
+    return Redis(connection_pool=get_pool(host, port, db))
+
+
+def get_async_redis(host=None, port=None, db=None):
+    """
+    An asyncio client for the server of get_redis. asyncio connections are
+    bound to the event loop they were made on, so each client has a pool of
+    its own, create one per event loop and close it with `aclose`.
+    """
+    from redis.asyncio import Redis as AsyncRedis
+
+    host, port, db = _address(host, port, db)
+    return AsyncRedis(host=host, port=port, db=db, socket_timeout=None,
+                      max_connections=int(os.environ.get('REDIS_MAX_CONNECTIONS', 50)))
+
+
+def get_publisher(rds):
+    """ The process-wide BatchPublisher for the pool of rds, started on first use """
+    pool = rds.connection_pool
+    with _lock:
+        publisher = _publishers.get(id(pool))
+        if publisher is None:
+            publisher = BatchPublisher(rds)
+            publisher.start()
+            _publishers[id(pool)] = publisher
+        return publisher
+
+
+def stats():
+    """ Connection counters and the state of every pool """
+    pools = []
+    with _lock:
+        for (host, port, db), pool in _pools.items():
+            pools.append({
+                'address': '%s:%s/%s' % (host, port, db),
+                'created': pool._created_connections,
+                'in_use': len(pool._in_use_connections),
+                'available': len(pool._available_connections),
+                'max': pool.max_connections
+            })
+        queued = sum(publisher.queue.qsize() for publisher in _publishers.values())
+
+    result = metrics.snapshot()
+    result['pools'] = pools
+    result['publish_queue'] = queued
+    return result
+
+
+def retry_on_disconnect(step, name, max_backoff=30):
+    """
+    Call step() until it succeeds and return its result. While the
+    connection to Redis is lost it is retried with an exponential backoff.
+    """
+    backoff = 0
+
+    while True:
+        try:
+            result = step()
+
+        except (ConnectionError, TimeoutError) as e:
+            backoff = min(backoff * 2 or 1, max_backoff)
+            logger.warning("%s lost its Redis connection (%s), retrying in %s seconds", name, e, backoff)
+            time.sleep(backoff)
+            continue
+
+        if backoff:
+            logger.info("%s reconnected to Redis", name)
+            metrics.count('reconnects')
+        return result
+
+
+def run_forever(step, name, setup=None, max_backoff=30):
+    """
+    Call step() in a loop, e.g. one blocking XREAD and the handling of its
+    result, reconnecting whenever Redis goes away. Listeners survive Redis
+    restarts this way. step keeps its own position, like a last id.
+
+    setup() runs before the first step and again after every failure, e.g.
+    to recreate a consumer group that is gone after Redis lost its data.
+    Errors other than a lost connection are logged and retried with the
+    same backoff, they never end the loop.
+    """
+    backoff = 0
+    ready = setup is None
+
+    while True:
+        try:
+            if not ready:
+                setup()
+                ready = True
+            step()
+
+        except (ConnectionError, TimeoutError) as e:
+            backoff = min(backoff * 2 or 1, max_backoff)
+            logger.warning("%s lost its Redis connection (%s), retrying in %s seconds", name, e, backoff)
+
+        except Exception as e:
+            backoff = min(backoff * 2 or 1, max_backoff)
+            logger.exception("%s failed (%s), retrying in %s seconds", name, e, backoff)
+
+        else:
+            if backoff:
+                logger.info("%s recovered", name)
+                metrics.count('reconnects')
+                backoff = 0
+            continue
+
+        ready = setup is None
+        time.sleep(backoff)
+
+
+async def run_forever_async(step, name, max_backoff=30):
+    """ run_forever for an asyncio listener, step is a coroutine function """
+    backoff = 0
+
+    while True:
+        try:
+            await step()
+
+        except asyncio.CancelledError:
+            raise
+
+        except (ConnectionError, TimeoutError) as e:
+            backoff = min(backoff * 2 or 1, max_backoff)
+            logger.warning("%s lost its Redis connection (%s), retrying in %s seconds", name, e, backoff)
+
+        except Exception as e:
+            backoff = min(backoff * 2 or 1, max_backoff)
+            logger.exception("%s failed (%s), retrying in %s seconds", name, e, backoff)
+
+        else:
+            if backoff:
+                logger.info("%s recovered", name)
+                metrics.count('reconnects')
+                backoff = 0
+            continue
+
+        await asyncio.sleep(backoff)
+
+
+class BatchPublisher(threading.Thread):
+    """
+    Sends PUBLISH and XADD writes of many threads in pipelines.
+
+    Writes are queued and sent by this thread, in order. Whatever has been
+    queued while the previous pipeline was in flight goes out in the next
+    one, so writes are batched under load without delaying a lone write.
+    Callers never block on Redis, a lost connection is retried with a
+    backoff and no writes are dropped for it. Only writes that cannot be
+    sent at all, e.g. of values redis-py cannot encode, are logged and
+    dropped.
+    """
+    max_batch = None
+
+    def __init__(self, rds, max_batch=500):
+        super(BatchPublisher, self).__init__(name='redis-publisher')
+        self.daemon = True
+
+        self.rds = rds
+        self.max_batch = max_batch
+        self.queue = Queue()
+
+    def publish(self, channel, message):
+        self.queue.put(('publish', (channel, message), {}))
+
+    def xadd(self, stream, fields, maxlen=None, ttl=None, entry_id='*'):
+        """ Append to a stream, refresh its expiry when ttl is given """
+        self.queue.put(('xadd', (stream, fields), {'id': entry_id, 'maxlen': maxlen}))
+        if ttl:
+            self.queue.put(('expire', (stream, ttl), {}))
+
+    def run(self):
+        while True:
+            ops = [self.queue.get()]
+            while len(ops) < self.max_batch:
+                try:
+                    ops.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            try:
+                retry_on_disconnect(lambda: self._send(ops), self.name)
+            except Exception:
+                # Not a lost connection, send the writes one by one and drop the bad ones
+                for op in ops:
+                    try:
+                        retry_on_disconnect(lambda: self._send([op]), self.name)
+                    except Exception as e:
+                        logger.error("Dropping a %s that could not be sent: %s", op[0], e)
+                        metrics.count('publish_errors')
+
+    def _send(self, ops):
+        pipe = self.rds.pipeline(transaction=False)
+        for method, args, kwargs in ops:
+            getattr(pipe, method)(*args, **kwargs)
+
+        results = pipe.execute(raise_on_error=False)
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        for error in errors:
+            logger.error("Publishing to Redis failed: %s", error)
+
+        metrics.count('published', len(ops))
+        metrics.count('publish_batches')
+        metrics.count('publish_errors', len(errors))
+
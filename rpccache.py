@@ -0,0 +1,139 @@
+import copy
+import shelve
+import threading
+
+from collections import OrderedDict
+
+
+class CachingRPCClient:
+    """
+    Read-through cache for block and transaction fetches.
+
+    Persisted blocks and confirmed transactions never change, only their
+    number of confirmations does. They are kept in an in-memory LRU and,
+    when `path` is given, in an on-disk shelve so the cache survives a
+    restart. Confirmations are recomputed from the latest known height on
+    every hit. All other calls go straight to the wrapped client.
+    """
+
+    def __init__(self, client, max_entries=10000, path=None):
+        self.client = client
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._lru = OrderedDict()  # key -> (item without confirmations, block index)
+        self._lock = threading.Lock()
+        self._block_count = 0
+        self._disk = shelve.open(path) if path else None
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'entries': len(self._lru)
+        }
+
+    def close(self):
+        if self._disk is not None:
+            with self._lock:
+                self._disk.close()
+                self._disk = None
+
+    def get_height(self):
+        count = self.client.get_height()
+        if isinstance(count, int):
+            self._seen_block_count(count)
+        return count
+
+    def get_block(self, height_or_hash):
+        key = 'block:%s' % height_or_hash
+
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        block = self.client.get_block(height_or_hash)
+        if not block or 'error' in block:
+            return block
+
+        # Blocks are reachable by height and by hash
+        self._store(key, block, block['index'])
+        self._store('block:%s' % block['hash'], block, block['index'])
+        return block
+
+    def get_transaction(self, txid):
+        key = 'tx:%s' % txid
+
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+
+        transaction = self.client.get_transaction(txid)
+        if not transaction or 'error' in transaction:
+            return transaction
+
+        # Unconfirmed transactions are not in a block yet and may still change
+        if not transaction.get('blockhash') or not transaction.get('confirmations'):
+            return transaction
+
+        # The last seen block count may be stale, take the index from the (cached) block
+        block = self.get_block(transaction['blockhash'])
+        if not block or 'error' in block:
+            return transaction
+
+        self._seen_block_count(block['index'] + int(transaction['confirmations']))
+        self._store(key, transaction, block['index'])
+        return transaction
+
+    def _seen_block_count(self, count):
+        with self._lock:
+            self._block_count = max(self._block_count, count)
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+                self.hits += 1
+
+            elif self._disk is not None and key in self._disk:
+                entry = self._disk[key]
+                self._remember(key, entry)
+                self.disk_hits += 1
+
+            else:
+                self.misses += 1
+                return None
+
+            item, block_index = entry
+            block_count = self._block_count
+
+        item = copy.deepcopy(item)
+        item['confirmations'] = max(block_count - block_index, 1)
+        return item
+
+    def _store(self, key, item, block_index):
+        if 'confirmations' in item and 'index' in item:
+            self._seen_block_count(item['index'] + int(item['confirmations']))
+
+        item = dict(item)
+        item.pop('confirmations', None)
+        entry = (item, block_index)
+
+        with self._lock:
+            self._remember(key, entry)
+            if self._disk is not None:
+                self._disk[key] = entry
+
+    def _remember(self, key, entry):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
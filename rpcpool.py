@@ -0,0 +1,193 @@
+import time
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+logger = logging.getLogger(__name__)
+
+
+class RPCError(Exception):
+    pass
+
+
+class RPCEndpoint:
+    """ One RPC node with a keep-alive connection pool and health stats """
+    failure_penalty = 1.0  # seconds added to the score per consecutive failure
+
+    def __init__(self, url, pool_size):
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.latency = None  # exponentially weighted moving average in seconds
+        self.failures = 0  # consecutive failures
+        self.ejected_until = 0
+        self.calls = 0
+        self.errors = 0
+
+    def is_ejected(self, now):
+        return self.ejected_until > now
+
+    def score(self):
+        """ Lower is better, unmeasured endpoints get tried early unless they failed """
+        latency = self.latency if self.latency is not None else 0
+        # A node that never answered has no latency, rank it by its failures alone
+        return latency * (1 + self.failures) + self.failures * self.failure_penalty
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'latency': self.latency,
+            'failures': self.failures,
+            'ejected': self.is_ejected(time.time()),
+            'calls': self.calls,
+            'errors': self.errors
+        }
+
+
+class RPCPool:
+    """
+    Pool of NEO RPC endpoints with the RPCClient methods used by NEOInterface.
+
+    Endpoints are ranked by their average latency. A call fails over to the
+    next endpoint when one does not answer. Read calls are hedged: when the
+    best endpoint has not answered within `hedge_delay` seconds the same
+    call is sent to the next best one and the first answer wins. Endpoints
+    that fail `max_failures` times in a row are ejected for `eject_seconds`
+    and re-admitted afterwards, a single success restores them fully.
+    """
+    alpha = 0.2  # weight of the latest latency sample
+
+    def __init__(self, urls, timeout=5, hedge_delay=0.25, max_failures=3,
+                 eject_seconds=30, pool_size=10):
+        assert urls
+        self.endpoints = [RPCEndpoint(url, pool_size) for url in urls]
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=pool_size * len(urls))
+        self._request_id = 0
+
+    def ranked(self):
+        """ Healthy endpoints best first, ejected endpoints last """
+        now = time.time()
+        with self._lock:
+            healthy = [e for e in self.endpoints if not e.is_ejected(now)]
+            ejected = [e for e in self.endpoints if e.is_ejected(now)]
+        healthy.sort(key=lambda e: e.score())
+        ejected.sort(key=lambda e: e.ejected_until)
+        return healthy + ejected
+
+    def stats(self):
+        return [endpoint.stats() for endpoint in self.endpoints]
+
+    def call(self, method, params, hedge=True):
+        """
+        Call an RPC method. Returns the result, or the JSON-RPC response when
+        the node answered with an error. Raises RPCError when no endpoint
+        answered.
+        """
+        endpoints = self.ranked()
+
+        if not hedge or len(endpoints) == 1:
+            for endpoint in endpoints:
+                try:
+                    return self._call_endpoint(endpoint, method, params)
+                except RPCError:
+                    continue
+            raise RPCError("%s failed on all endpoints" % method)
+
+        return self._call_hedged(endpoints, method, params)
+
+    def _call_hedged(self, endpoints, method, params):
+        remaining = list(endpoints)
+        running = set()
+
+        while remaining or running:
+            if remaining:
+                endpoint = remaining.pop(0)
+                running.add(self._executor.submit(self._call_endpoint, endpoint, method, params))
+
+            # Give the running calls a head start before hedging to the next endpoint
+            timeout = self.hedge_delay if remaining else None
+            done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+
+        raise RPCError("%s failed on all endpoints" % method)
+
+    def _call_endpoint(self, endpoint, method, params):
+        with self._lock:
+            self._request_id += 1
+            payload = {
+                'jsonrpc': '2.0',
+                'id': self._request_id,
+                'method': method,
+                'params': params
+            }
+
+        start = time.time()
+        try:
+            response = endpoint.session.post(endpoint.url, json=payload, timeout=self.timeout)
+            response.raise_for_status()
+            body = response.json()
+
+        except (requests.RequestException, ValueError) as e:
+            self._record_failure(endpoint)
+            raise RPCError("%s on %s failed: %s" % (method, endpoint.url, e))
+
+        self._record_success(endpoint, time.time() - start)
+
+        if 'error' in body:
+            return body
+
+        return body['result']
+
+    def _record_success(self, endpoint, latency):
+        with self._lock:
+            endpoint.calls += 1
+            endpoint.failures = 0
+            endpoint.ejected_until = 0
+            if endpoint.latency is None:
+                endpoint.latency = latency
+            else:
+                endpoint.latency = (1 - self.alpha) * endpoint.latency + self.alpha * latency
+
+    def _record_failure(self, endpoint):
+        with self._lock:
+            endpoint.calls += 1
+            endpoint.errors += 1
+            endpoint.failures += 1
+            if endpoint.failures >= self.max_failures:
+                if not endpoint.is_ejected(time.time()):
+                    logger.warning("Ejecting RPC endpoint %s after %s failures", endpoint.url, endpoint.failures)
+                endpoint.ejected_until = time.time() + self.eject_seconds
+
+    # RPCClient compatible methods
+
+    def get_height(self):
+        return self.call('getblockcount', [])
+
+    def get_block(self, height_or_hash):
+        return self.call('getblock', [height_or_hash, 1])
+
+    def get_transaction(self, txid):
+        return self.call('getrawtransaction', [txid, 1])
+
+    def get_account(self, address):
+        return self.call('getaccountstate', [address])
+
+    def validate_addr(self, address):
+        return self.call('validateaddress', [address])
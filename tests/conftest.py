@@ -0,0 +1,60 @@
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'middleware', 'src'))
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(scope='session')
+def redis_port():
+    """ A throwaway redis-server, from $REDIS_SERVER or the PATH """
+    executable = os.environ.get('REDIS_SERVER') or shutil.which('redis-server')
+    if not executable:
+        pytest.skip("redis-server not found, set REDIS_SERVER to run the Redis tests")
+
+    from redis import Redis
+    from redis.exceptions import ConnectionError
+
+    port = _free_port()
+    server = subprocess.Popen([executable, '--port', str(port), '--save', '', '--appendonly', 'no'],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        client = Redis(port=port)
+        for _i in range(100):
+            try:
+                client.ping()
+                break
+            except ConnectionError:
+                time.sleep(0.05)
+        else:
+            pytest.skip("redis-server did not start")
+
+        yield port
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+@pytest.fixture
+def rds(redis_port):
+    from redis import Redis
+
+    client = Redis(port=redis_port)
+    client.flushall()
+    yield client
+    client.close()
@@ -0,0 +1,108 @@
+import asyncio
+import json
+import socket
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from aioneointerface import AsyncNEOInterface, RPCError
+from wireformat import decode_command, encode_response
+
+
+ADDRESS = 'AK2nJJpJr6o664CWJKi1QRXjqeic2zRp8y'
+NEO = '0xc56f33fc6ecfcd0c225c4ab356fee59390af8560be0e930faebe74a6daff7c9b'
+
+
+class StubNode:
+    """ A JSON-RPC node on localhost answering from a dict of method -> result """
+
+    def __init__(self, results):
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                body = json.dumps({'jsonrpc': '2.0', 'id': request['id'],
+                                   'result': results[request['method']]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def node():
+    node = StubNode({'getaccountstate': {'balances': [{'asset': NEO, 'value': '10'}]}})
+    yield node
+    node.close()
+
+
+@pytest.fixture
+def redis_env(redis_port, rds, monkeypatch):
+    monkeypatch.setenv('REDIS_HOST', '127.0.0.1')
+    monkeypatch.setenv('REDIS_PORT', str(redis_port))
+    return rds
+
+
+def dead_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%s' % sock.getsockname()[1]
+
+
+def run(neo, coroutine):
+    async def main():
+        await neo.start()
+        try:
+            return await coroutine()
+        finally:
+            await neo.close()
+
+    return asyncio.run(main())
+
+
+def test_rpc_fails_over_to_the_next_endpoint(node, redis_env):
+    neo = AsyncNEOInterface(rpc_endpoints=[dead_url(), node.url])
+
+    assert run(neo, lambda: neo.check_funds(ADDRESS, 10, NEO))
+    assert not run(neo, lambda: neo.check_funds(ADDRESS, 11, NEO))
+
+
+def test_rpc_retries_are_bounded(redis_env):
+    neo = AsyncNEOInterface(rpc_endpoints=[dead_url()], rpc_retries=2)
+
+    with pytest.raises(RPCError):
+        run(neo, lambda: neo.check_funds(ADDRESS, 10, NEO))
+
+
+def test_command_reply(redis_env):
+    rds = redis_env
+    neo = AsyncNEOInterface()
+
+    async def review():
+        future = await neo.review_milestone(None, 'key-1', 80)
+
+        # Answer like the middleware does
+        [(_stream, [(_entry_id, fields)])] = rds.xread({'neo-cmd': '0'})
+        command = decode_command(fields[b'msg'])
+        assert command['params'] == {'milestone_key': 'key-1', 'score': 80}
+        rds.xadd(command['reply_to'], {'msg': encode_response(command['cmd_id'], 'confirmed', {'height': 5})})
+
+        return await asyncio.wait_for(future, 5)
+
+    response = run(neo, review)
+    assert response['status'] == 'confirmed'
+    assert response['height'] == 5
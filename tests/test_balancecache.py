@@ -0,0 +1,94 @@
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from balancecache import BalanceCache
+
+
+def account(value):
+    return {'balances': [{'asset': 'NEO', 'value': value}]}
+
+
+def block(*addresses):
+    return {'height': 1, 'txs': [{'senders': [], 'vout': [{'address': address} for address in addresses]}]}
+
+
+class Accounts:
+
+    def __init__(self):
+        self.values = {}
+        self.fetches = 0
+        self.during_fetch = None
+
+    def fetch(self, address):
+        self.fetches += 1
+        if self.during_fetch:
+            self.during_fetch()
+        return account(self.values.get(address, '0'))
+
+
+def test_balances_are_cached_until_a_block_touches_them():
+    accounts = Accounts()
+    cache = BalanceCache(accounts.fetch)
+    accounts.values['alice'] = '10'
+
+    assert cache.get('alice') == {'NEO': '10'}
+    assert cache.get('alice') == {'NEO': '10'}
+    assert accounts.fetches == 1
+
+    accounts.values['alice'] = '20'
+    cache.on_block(block('bob'))
+    assert cache.get('alice') == {'NEO': '10'}
+
+    cache.on_block(block('alice'))
+    assert cache.get('alice') == {'NEO': '20'}
+    assert accounts.fetches == 2
+
+
+def test_balance_changed_during_the_fetch_is_not_cached():
+    accounts = Accounts()
+    cache = BalanceCache(accounts.fetch)
+    accounts.during_fetch = lambda: cache.on_block(block('alice'))
+
+    cache.get('alice')
+    accounts.during_fetch = None
+    cache.get('alice')
+
+    assert accounts.fetches == 2
+
+
+def test_untracked_addresses_leave_no_state():
+    cache = BalanceCache(Accounts().fetch)
+    for i in range(1000):
+        cache.on_block(block('address-%d' % i))
+    cache.invalidate('other')
+
+    assert cache._fetching == {}
+    assert cache._balances == {}
+
+
+def test_get_many_fetches_the_misses_together():
+    accounts = Accounts()
+    cache = BalanceCache(accounts.fetch)
+    accounts.values.update(alice='10', bob='5')
+    cache.get('alice')
+
+    # Both misses have to be in flight at the same time to pass the barrier
+    barrier = threading.Barrier(2, timeout=5)
+    accounts.during_fetch = barrier.wait
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        balances = cache.get_many(['alice', 'bob', 'carol', 'bob'], executor)
+
+    assert balances == {'alice': {'NEO': '10'}, 'bob': {'NEO': '5'}, 'carol': {'NEO': '0'}}
+    assert accounts.fetches == 3
+
+
+def test_fetch_can_be_given_with_each_call():
+    accounts = Accounts()
+    cache = BalanceCache()
+    accounts.values['alice'] = '10'
+
+    assert cache.get('alice', accounts.fetch) == {'NEO': '10'}
+    assert cache.get_many(['alice', 'bob'], fetch=accounts.fetch) == {'alice': {'NEO': '10'}, 'bob': {'NEO': '0'}}
+    assert accounts.fetches == 2
@@ -0,0 +1,54 @@
+import json
+import time
+
+from blockfeed import BlockFeed
+
+
+class Heights:
+
+    def __init__(self):
+        self.seen = []
+
+    def on_block(self, block):
+        self.seen.append(block['height'])
+
+
+def publish_blocks(rds, heights):
+    for height in heights:
+        rds.xadd('neo-blocks', {'data': json.dumps({'height': height, 'txs': []})}, id='%d-1' % height)
+
+
+def start_feed(rds, **kwargs):
+    heights = Heights()
+    feed = BlockFeed(rds, **kwargs)
+    feed.subscribe(heights)
+    feed.start()
+    assert feed.caught_up.wait(5)
+    return feed, heights
+
+
+def wait_for_height(feed, height):
+    for _i in range(100):
+        if feed.height == height:
+            return
+        time.sleep(0.05)
+
+
+def test_feed_replays_the_stream_and_follows_it(rds):
+    publish_blocks(rds, range(1, 6))
+    feed, heights = start_feed(rds)
+    assert heights.seen == [1, 2, 3, 4, 5]
+
+    publish_blocks(rds, [6])
+    wait_for_height(feed, 6)
+    assert heights.seen == [1, 2, 3, 4, 5, 6]
+
+
+def test_feed_with_a_history_starts_behind_the_newest_block(rds):
+    publish_blocks(rds, range(1, 11))
+    feed, heights = start_feed(rds, history=3)
+    assert heights.seen == [8, 9, 10]
+
+    publish_blocks(rds, [11])
+    wait_for_height(feed, 11)
+    assert heights.seen == [8, 9, 10, 11]
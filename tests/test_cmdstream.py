@@ -0,0 +1,128 @@
+from cmdstream import CommandStream, next_entry_id
+
+
+def add_commands(rds, count, stream='neo-cmd'):
+    return [rds.xadd(stream, {'msg': b'command %d' % i}) for i in range(count)]
+
+
+def new_stream(rds, consumer, **kwargs):
+    command_stream = CommandStream(rds, consumer, **kwargs)
+    command_stream.setup()
+    return command_stream
+
+
+def pending_ids(rds, consumer=None):
+    pending = rds.xpending_range('neo-cmd', 'middleware', '-', '+', 1000, consumername=consumer)
+    return [p['message_id'] for p in pending]
+
+
+def test_next_entry_id():
+    assert next_entry_id(b'1526919030474-55') == '1526919030474-56'
+    assert next_entry_id('5-0') == '5-1'
+
+
+def test_setup_twice(rds):
+    command_stream = new_stream(rds, 'node-1')
+    command_stream.setup()
+
+    assert rds.xinfo_groups('neo-cmd')[0]['name'] == b'middleware'
+
+
+def test_read_and_ack(rds):
+    command_stream = new_stream(rds, 'node-1')
+    ids = add_commands(rds, 3)
+
+    entries = command_stream.read(count=10, block=100)
+    assert [entry_id for entry_id, _fields in entries] == ids
+    assert entries[0][1] == {b'msg': b'command 0'}
+
+    for entry_id in ids:
+        command_stream.ack(entry_id)
+
+    assert pending_ids(rds) == []
+    assert command_stream.read(count=10, block=100) == []
+
+
+def test_batch_entry_is_acked_after_its_last_command(rds):
+    command_stream = new_stream(rds, 'node-1')
+    entry_id, = add_commands(rds, 1)
+    command_stream.read(block=100)
+
+    command_stream.expect(entry_id, 2)
+    command_stream.ack(entry_id)
+    assert pending_ids(rds) == [entry_id]
+
+    command_stream.ack(entry_id)
+    assert pending_ids(rds) == []
+
+
+def test_restart_recovers_unacked_entries(rds):
+    ids = add_commands(rds, 3)
+    before = new_stream(rds, 'node-1')
+    before.read(block=100)
+    before.ack(ids[1])
+
+    after = new_stream(rds, 'node-1')
+    recovered = after.read(block=100)
+    assert [entry_id for entry_id, _fields in recovered] == [ids[0], ids[2]]
+
+    # New entries follow once the pending ones are handed out
+    new_id, = add_commands(rds, 1)
+    assert [entry_id for entry_id, _fields in after.read(block=100)] == [new_id]
+
+
+def test_reclaim_entries_of_a_dead_node(rds):
+    ids = add_commands(rds, 2)
+    new_stream(rds, 'dead').read(block=100)
+
+    live = new_stream(rds, 'live', claim_idle=0)
+    entries = live.reclaim(10)
+
+    assert [entry_id for entry_id, _fields in entries] == ids
+    assert pending_ids(rds, 'live') == ids
+
+
+def test_reclaim_leaves_fresh_entries(rds):
+    add_commands(rds, 2)
+    new_stream(rds, 'busy').read(block=100)
+
+    assert new_stream(rds, 'live', claim_idle=900).reclaim(10) == []
+
+
+def test_reclaim_pages_past_own_entries(rds):
+    live = new_stream(rds, 'live', claim_idle=0)
+    add_commands(rds, 250)
+    assert len(live.read(count=250, block=100)) == 250
+
+    dead_ids = add_commands(rds, 5)
+    new_stream(rds, 'dead').read(count=10, block=100)
+
+    entries = live.reclaim(10)
+    assert [entry_id for entry_id, _fields in entries] == dead_ids
+
+
+def test_released_entry_is_reclaimed_by_the_same_node(rds):
+    command_stream = new_stream(rds, 'node-1', claim_idle=0)
+    entry_id, = add_commands(rds, 1)
+    command_stream.read(block=100)
+
+    assert command_stream.reclaim(10) == []
+
+    command_stream.release(entry_id)
+    assert [eid for eid, _fields in command_stream.reclaim(10)] == [entry_id]
+
+
+def test_partly_dispatched_batch_waits_for_its_queued_commands(rds):
+    command_stream = new_stream(rds, 'node-1', claim_idle=0)
+    entry_id, = add_commands(rds, 1)
+    command_stream.read(block=100)
+
+    # One of three commands was queued before the dispatch failed
+    command_stream.expect(entry_id, 3)
+    command_stream.release(entry_id, 2)
+    assert command_stream.reclaim(10) == []
+
+    # The queued command is done, the entry is delivered again instead of acked
+    command_stream.ack(entry_id)
+    assert pending_ids(rds) == [entry_id]
+    assert [eid for eid, _fields in command_stream.reclaim(10)] == [entry_id]
@@ -0,0 +1,40 @@
+from dedup import CommandDedup
+
+
+def test_new_command_is_claimed(rds):
+    dedup = CommandDedup(rds)
+
+    assert not dedup.check('cmd-1', 'review', {'milestone_key': 'key-1'}, None, b'1-0')
+    assert rds.exists('neo-cmd-dedup:cmd:cmd-1')
+
+
+def test_redelivered_entry_is_not_a_duplicate(rds):
+    dedup = CommandDedup(rds)
+    dedup.check('cmd-1', 'review', {}, None, b'1-0')
+
+    assert not dedup.check('cmd-1', 'review', {}, None, b'1-0')
+    assert dedup.check('cmd-1', 'review', {}, None, b'2-0')
+    assert dedup.duplicates == 1
+
+
+def test_milestone_key_is_claimed_once(rds):
+    dedup = CommandDedup(rds)
+    dedup.check('cmd-1', 'milestone', {'milestone_key': 'key-1'}, None, b'1-0')
+
+    assert dedup.check('cmd-2', 'milestone', {'milestone_key': 'key-1'}, None, b'2-0')
+    assert not rds.exists('neo-cmd-dedup:cmd:cmd-2')
+
+
+def test_failed_milestone_releases_its_key(rds):
+    dedup = CommandDedup(rds)
+    dedup.check('cmd-1', 'milestone', {'milestone_key': 'key-1'}, None, b'1-0')
+    dedup.complete('cmd-1', 'failed', {'error': 'rejected'})
+
+    assert not dedup.check('cmd-2', 'milestone', {'milestone_key': 'key-1'}, None, b'2-0')
+
+
+def test_complete_needs_a_claim(rds):
+    dedup = CommandDedup(rds)
+    dedup.complete('never-claimed', 'failed', {'error': 'Unauthorized'})
+
+    assert rds.keys('neo-cmd-dedup:*') == []
@@ -0,0 +1,95 @@
+import binascii
+import time
+
+from handler import CommandHandler
+from validator import MIN_TIME, CommandValidator
+from wireformat import script_hash_bytes
+
+
+CUSTOMER = '0x23ba2703c53263e8d6e522dc32203339dcd8eee9'
+
+
+def milestone(**params):
+    command = {
+        'milestone_key': 'key-1',
+        'agreement': 'agreement-1',
+        'customer': CUSTOMER,
+        'assignee': CUSTOMER,
+        'platform': 'platform',
+        'timestamp': int(time.time()) + MIN_TIME,
+        'utc_offset': 1,
+        'oracle': CUSTOMER,
+        'pay_out': 10,
+        'asset': 'NEO',
+        'threshold': 50
+    }
+    command.update(params)
+    return command
+
+
+class SmartContract:
+
+    def __init__(self):
+        self.validator = CommandValidator()
+        self.invoked = []
+        self.rejected = []
+
+    def add_invoke(self, method_name, *args, **kwargs):
+        self.invoked.append((method_name, args, kwargs))
+
+    def reject(self, cmd_id, reply_to, entry_id, error, milestone_key=None):
+        if milestone_key is not None:
+            self.validator.forget(milestone_key)
+        self.rejected.append((cmd_id, error))
+
+
+def test_invalid_params_leave_the_key_unclaimed():
+    contract = SmartContract()
+
+    CommandHandler(contract, 'cmd-1', 'milestone', milestone(customer='0x1234'))
+    assert contract.rejected == [('cmd-1', 'Invalid milestone params')]
+    assert 'key-1' not in contract.validator.statuses
+
+    # The corrected command gets the key
+    CommandHandler(contract, 'cmd-2', 'milestone', milestone())
+    assert [method_name for method_name, _args, _kwargs in contract.invoked] == ['milestone']
+    assert contract.validator.statuses['key-1'] == 'pending'
+
+
+def test_queueing_failure_frees_the_key():
+    contract = SmartContract()
+
+    def add_invoke(*args, **kwargs):
+        raise RuntimeError("queue closed")
+
+    contract.add_invoke = add_invoke
+    CommandHandler(contract, 'cmd-1', 'milestone', milestone())
+
+    assert contract.rejected == [('cmd-1', 'Could not queue the milestone')]
+    assert 'key-1' not in contract.validator.statuses
+
+
+def test_invalid_command_in_a_batch_is_rejected_on_its_own():
+    contract = SmartContract()
+    commands = [
+        ['not', 'a', 'command'],
+        {'cmd_id': 'cmd-2', 'operation': 'review', 'params': {'milestone_key': 'key-1', 'score': 80}},
+    ]
+
+    contract.expect = lambda entry_id, count: None
+    CommandHandler(contract, 'batch-1', 'batch', {'commands': commands})
+
+    assert contract.rejected == [(None, 'Invalid command')]
+    assert [method_name for method_name, _args, _kwargs in contract.invoked] == ['review']
+
+
+def test_payouts_are_scheduled_in_the_lane_of_the_customer():
+    contract = SmartContract()
+    CommandHandler(contract, 'cmd-1', 'milestone', milestone())
+    CommandHandler(contract, 'cmd-2', 'review', {'milestone_key': 'key-1', 'score': 80})
+    CommandHandler(contract, 'cmd-3', 'refund', {'milestone_key': 'key-1', 'fee_refund': True})
+    CommandHandler(contract, 'cmd-4', 'review', {'milestone_key': 'unknown', 'score': 80})
+
+    lanes = [(kwargs['customer'], kwargs['agreement']) for _method_name, _args, kwargs in contract.invoked]
+    customer = binascii.hexlify(script_hash_bytes(CUSTOMER))
+    assert lanes == [(customer, 'agreement-1')] * 3 + [(None, None)]
@@ -0,0 +1,36 @@
+import pytest
+
+import neointerface
+
+from neointerface import NEOInterface
+
+
+@pytest.fixture
+def redis_env(redis_port, rds, monkeypatch):
+    monkeypatch.setenv('REDIS_HOST', '127.0.0.1')
+    monkeypatch.setenv('REDIS_PORT', str(redis_port))
+    monkeypatch.setattr(neointerface, '_chain_caches', {})
+    monkeypatch.setattr(neointerface, '_reply_listeners', {})
+    return rds
+
+
+def test_instances_share_the_block_feed_and_reply_stream(redis_env, monkeypatch):
+    monkeypatch.setattr(NEOInterface, 'block_history', 4)
+
+    first = NEOInterface(rpc_endpoints=['http://127.0.0.1:1'])
+    second = NEOInterface(rpc_endpoints=['http://127.0.0.1:1'])
+
+    assert second.block_feed is first.block_feed
+    assert second.tx_index is first.tx_index
+    assert second.balance_cache is first.balance_cache
+    assert second.reply_stream == first.reply_stream
+
+    assert first.block_feed.history == 4
+    assert first.tx_index.retention == 4
+
+
+def test_block_feed_is_opt_out(redis_env):
+    neo = NEOInterface(use_block_feed=False, rpc_endpoints=['http://127.0.0.1:1'])
+
+    assert neo.block_feed is None
+    assert neointerface._chain_caches == {}
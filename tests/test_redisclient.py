@@ -0,0 +1,65 @@
+import socket
+import time
+
+import pytest
+
+from redis.exceptions import ConnectionError
+
+import redisclient
+from redisclient import BatchPublisher, get_redis, metrics, retry_on_disconnect
+
+
+def refused_port():
+    """ A local port nothing listens on """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_refused_connection_raises_connection_error():
+    rds = get_redis('127.0.0.1', refused_port())
+    errors = metrics.snapshot()['connect_errors']
+
+    with pytest.raises(ConnectionError):
+        rds.ping()
+    assert metrics.snapshot()['connect_errors'] > errors
+
+
+def test_retry_on_disconnect_retries_a_refused_port(monkeypatch):
+    monkeypatch.setattr(redisclient.time, 'sleep', lambda seconds: None)
+    rds = get_redis('127.0.0.1', refused_port())
+    calls = []
+
+    def step():
+        calls.append(1)
+        if len(calls) < 3:
+            return rds.ping()
+        return 'ok'
+
+    assert retry_on_disconnect(step, 'test') == 'ok'
+    assert len(calls) == 3
+
+
+def test_publisher_outlives_a_refused_port():
+    publisher = BatchPublisher(get_redis('127.0.0.1', refused_port()))
+    publisher.start()
+    publisher.publish('channel', 'message')
+
+    time.sleep(0.2)
+    assert publisher.is_alive()
+
+
+def test_publisher_drops_writes_that_cannot_be_sent(rds):
+    publisher = BatchPublisher(rds)
+    publisher.start()
+
+    publisher.xadd('stream', {'field': object()})
+    publisher.xadd('stream', {'field': 'value'})
+
+    for _i in range(100):
+        if rds.xlen('stream'):
+            break
+        time.sleep(0.01)
+
+    assert rds.xlen('stream') == 1
+    assert publisher.is_alive()
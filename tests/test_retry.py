@@ -0,0 +1,39 @@
+import queue
+
+from retry import RetryScheduler
+
+
+class Task:
+    attempts = 0
+
+
+def test_backoff_doubles_up_to_the_max():
+    retry = RetryScheduler(None, base_delay=5, max_delay=30)
+    assert [retry.backoff(attempts) for attempts in range(1, 6)] == [5, 10, 20, 30, 30]
+
+
+def test_dead_letter_after_max_attempts():
+    retry = RetryScheduler(None, max_attempts=3, base_delay=60)
+    task = Task()
+
+    assert retry.schedule(task)
+    assert retry.pending() == [task]
+    assert retry.schedule(task)
+
+    assert not retry.schedule(task)
+    assert retry.dead_letters() == [task]
+
+    assert retry.take_dead_letters() == [task]
+    assert retry.dead_letters() == []
+
+
+def test_due_tasks_are_requeued():
+    requeued = queue.Queue()
+    retry = RetryScheduler(requeued.put, base_delay=0.01)
+    retry.start()
+
+    task = Task()
+    retry.schedule(task)
+
+    assert requeued.get(timeout=1) is task
+    assert retry.pending() == []
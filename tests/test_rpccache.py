@@ -0,0 +1,56 @@
+from rpccache import CachingRPCClient
+
+
+class Node:
+    """ A chain of `count` blocks with one transaction in block 190 """
+
+    def __init__(self, count):
+        self.count = count
+        self.calls = []
+
+    def get_height(self):
+        self.calls.append('get_height')
+        return self.count
+
+    def get_block(self, height_or_hash):
+        self.calls.append('get_block')
+        index = 190 if height_or_hash == '0xblock190' else int(height_or_hash)
+        return {'index': index, 'hash': '0xblock%s' % index, 'confirmations': self.count - index}
+
+    def get_transaction(self, txid):
+        self.calls.append('get_transaction')
+        return {'txid': txid, 'blockhash': '0xblock190', 'confirmations': self.count - 190}
+
+
+def test_confirmations_do_not_depend_on_a_stale_height():
+    node = Node(100)
+    cache = CachingRPCClient(node)
+    cache.get_height()
+
+    node.count = 200
+    assert cache.get_transaction('0xtx')['confirmations'] == 10
+    assert cache.get_transaction('0xtx')['confirmations'] == 10
+
+    node.count = 205
+    cache.get_height()
+    assert cache.get_transaction('0xtx')['confirmations'] == 15
+    assert node.calls.count('get_transaction') == 1
+
+
+def test_blocks_are_cached_by_height_and_hash():
+    node = Node(200)
+    cache = CachingRPCClient(node)
+
+    assert cache.get_block(190)['confirmations'] == 10
+    assert cache.get_block('0xblock190')['index'] == 190
+    assert node.calls == ['get_block']
+
+
+def test_unconfirmed_transactions_are_not_cached():
+    node = Node(200)
+    node.get_transaction = lambda txid: {'txid': txid}
+    cache = CachingRPCClient(node)
+
+    cache.get_transaction('0xtx')
+    cache.get_transaction('0xtx')
+    assert cache.stats()['misses'] == 2
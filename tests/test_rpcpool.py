@@ -0,0 +1,157 @@
+import json
+import socket
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from rpcpool import RPCError, RPCPool
+
+
+class StubNode:
+    """ A JSON-RPC node on localhost that answers every call with its name """
+
+    def __init__(self, name, delay=0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                node.calls += 1
+                time.sleep(node.delay)
+
+                if node.fail:
+                    self.send_error(500)
+                    return
+
+                body = json.dumps({'jsonrpc': '2.0', 'id': request['id'], 'result': node.name}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def nodes():
+    started = []
+
+    def start(name, **kwargs):
+        node = StubNode(name, **kwargs)
+        started.append(node)
+        return node
+
+    yield start
+
+    for node in started:
+        node.close()
+
+
+def dead_url():
+    """ A local port nothing listens on """
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return 'http://127.0.0.1:%s' % sock.getsockname()[1]
+
+
+def endpoint(pool, url):
+    return next(e for e in pool.endpoints if e.url == url)
+
+
+def test_fails_over_to_the_next_endpoint(nodes):
+    good = nodes('good')
+    pool = RPCPool([dead_url(), good.url], timeout=1)
+
+    assert pool.call('getblockcount', [], hedge=False) == 'good'
+    assert pool.stats()[0]['failures'] == 1
+
+
+def test_failed_endpoint_ranks_behind_a_healthy_one(nodes):
+    good = nodes('good')
+    dead = dead_url()
+    pool = RPCPool([dead, good.url], timeout=1)
+    pool.call('getblockcount', [], hedge=False)
+
+    assert pool.ranked()[0].url == good.url
+
+    # Without answers the dead node is not tried first on the next call either
+    pool.call('getblockcount', [], hedge=False)
+    assert endpoint(pool, dead).failures == 1
+
+
+def test_raises_when_no_endpoint_answers():
+    pool = RPCPool([dead_url(), dead_url()], timeout=1)
+
+    with pytest.raises(RPCError):
+        pool.call('getblockcount', [], hedge=False)
+    with pytest.raises(RPCError):
+        pool.call('getblockcount', [])
+
+
+def test_slow_endpoint_is_hedged(nodes):
+    slow = nodes('slow', delay=1)
+    fast = nodes('fast')
+    pool = RPCPool([slow.url, fast.url], hedge_delay=0.05)
+
+    start = time.time()
+    assert pool.call('getblockcount', []) == 'fast'
+    assert time.time() - start < 0.5
+    assert slow.calls == 1
+
+
+def test_hedging_waits_for_a_quick_answer(nodes):
+    first = nodes('first', delay=0.01)
+    second = nodes('second')
+    pool = RPCPool([first.url, second.url], hedge_delay=1)
+
+    assert pool.call('getblockcount', []) == 'first'
+    assert second.calls == 0
+
+
+def test_ejection_and_readmission(nodes):
+    flaky = nodes('flaky', fail=True)
+    good = nodes('good')
+    pool = RPCPool([flaky.url, good.url], max_failures=2, eject_seconds=0.2)
+    flaky_endpoint = endpoint(pool, flaky.url)
+
+    for _i in range(2):
+        with pytest.raises(RPCError):
+            pool._call_endpoint(flaky_endpoint, 'getblockcount', [])
+
+    assert flaky_endpoint.is_ejected(time.time())
+    assert [e.url for e in pool.ranked()] == [good.url, flaky.url]
+
+    # Re-admitted after eject_seconds, one success restores it fully
+    time.sleep(0.25)
+    flaky.fail = False
+    assert not flaky_endpoint.is_ejected(time.time())
+    assert pool._call_endpoint(flaky_endpoint, 'getblockcount', []) == 'flaky'
+    assert flaky_endpoint.failures == 0
+
+
+def test_helpers_call_through_the_pool(nodes):
+    node = nodes('node')
+    pool = RPCPool([node.url])
+
+    assert pool.get_height() == 'node'
+    assert pool.stats()[0]['calls'] == 1
@@ -0,0 +1,84 @@
+import threading
+
+from scheduler import InvokeScheduler, priority_class
+
+
+class Task:
+
+    def __init__(self, method_name, customer=None, agreement=None):
+        self.method_name = method_name
+        self.customer = customer
+        self.agreement = agreement
+
+
+def drain(scheduler):
+    return [scheduler.get() for _i in range(scheduler.qsize())]
+
+
+def test_priority_class():
+    assert priority_class('review') == 'payout'
+    assert priority_class('refund') == 'payout'
+    assert priority_class('milestone') == 'creation'
+    assert priority_class('unknown') == 'creation'
+
+
+def test_payouts_go_first():
+    scheduler = InvokeScheduler()
+    milestone = Task('milestone')
+    review = Task('review')
+    scheduler.put(milestone)
+    scheduler.put(review)
+
+    assert drain(scheduler) == [review, milestone]
+
+
+def test_lower_class_gets_a_turn_after_a_burst():
+    scheduler = InvokeScheduler(burst=2)
+    milestone = Task('milestone')
+    scheduler.put(milestone)
+    reviews = [Task('review') for _i in range(4)]
+    for review in reviews:
+        scheduler.put(review)
+
+    assert drain(scheduler) == reviews[:2] + [milestone] + reviews[2:]
+
+
+def test_customers_and_agreements_take_turns():
+    scheduler = InvokeScheduler()
+    bulk = [Task('milestone', 'bulk', 'a%d' % (i % 2)) for i in range(4)]
+    other = Task('milestone', 'other', 'b')
+    for task in bulk + [other]:
+        scheduler.put(task)
+
+    assert drain(scheduler) == [bulk[0], other, bulk[1], bulk[2], bulk[3]]
+
+
+def test_tasks_and_stats():
+    scheduler = InvokeScheduler()
+    tasks = [Task('milestone'), Task('review')]
+    for task in tasks:
+        scheduler.put(task)
+
+    assert sorted(scheduler.tasks(), key=id) == sorted(tasks, key=id)
+
+    scheduler.get()
+    stats = scheduler.stats()
+    assert stats['payout']['dequeued'] == 1
+    assert stats['creation']['depth'] == 1
+
+
+def test_wait_for_space_blocks_until_a_task_is_taken():
+    scheduler = InvokeScheduler()
+    scheduler.put(Task('milestone'))
+    assert scheduler.wait_for_space(2) < 0.1
+
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(scheduler.wait_for_space(1)))
+    waiter.start()
+    waiter.join(0.1)
+    assert waiter.is_alive()
+
+    scheduler.get()
+    waiter.join(1)
+    assert not waiter.is_alive()
+    assert waited[0] >= 0.1
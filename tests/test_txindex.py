@@ -0,0 +1,63 @@
+from txindex import TransactionIndex
+
+
+NEO = '0xc56f33fc6ecfcd0c225c4ab356fee59390af8560be0e930faebe74a6daff7c9b'
+
+
+def block(height, *txs):
+    return {'height': height, 'txs': list(txs)}
+
+
+def payment(txid, sender, receiver, value, tx_type='ContractTransaction'):
+    return {
+        'txid': txid,
+        'type': tx_type,
+        'senders': [sender],
+        'vout': [
+            {'n': 0, 'address': receiver, 'asset': NEO, 'value': value},
+            {'n': 1, 'address': sender, 'asset': NEO, 'value': '90'},
+        ]
+    }
+
+
+def test_find_payment():
+    index = TransactionIndex()
+    index.on_block(block(10, payment('tx1', 'alice', 'bob', '10')))
+    index.on_block(block(11, payment('tx2', 'alice', 'bob', '5')))
+
+    assert index.find_payment('alice', 'bob', 5, NEO) == ('tx2', 11)
+    assert index.find_payment('alice', 'bob', '10', NEO) == ('tx1', 10)
+    assert index.find_payment('alice', 'bob', 7, NEO) is None
+    assert index.find_payment('bob', 'alice', 10, NEO) is None
+
+
+def test_change_is_not_a_payment():
+    index = TransactionIndex()
+    index.on_block(block(10, payment('tx1', 'alice', 'bob', '10')))
+
+    assert index.find_payment('alice', 'alice', 90, NEO) is None
+
+
+def test_only_contract_transactions_are_indexed():
+    index = TransactionIndex()
+    index.on_block(block(10, payment('tx1', 'alice', 'bob', '10', tx_type='InvocationTransaction')))
+
+    assert index.find_payment('alice', 'bob', 10, NEO) is None
+
+
+def test_payments_older_than_the_retention_are_forgotten():
+    index = TransactionIndex(retention=3)
+    index.on_block(block(10, payment('tx1', 'alice', 'bob', '10')))
+    index.on_block(block(11, payment('tx2', 'alice', 'bob', '5')))
+    index.on_block(block(12))
+
+    assert index.find_payment('alice', 'bob', 10, NEO) == ('tx1', 10)
+
+    index.on_block(block(13, payment('tx3', 'carol', 'bob', '1')))
+    assert index.find_payment('alice', 'bob', 10, NEO) is None
+    assert index.find_payment('alice', 'bob', 5, NEO) == ('tx2', 11)
+
+    index.on_block(block(14))
+    assert index.find_payment('alice', 'bob', 5, NEO) is None
+    assert index.find_payment('carol', 'bob', 1, NEO) == ('tx3', 13)
+    assert set(index._payments) == {('bob', 'carol', NEO)}
@@ -0,0 +1,96 @@
+import binascii
+
+import pytest
+
+from validator import MIN_TIME, CommandValidator, ValidationError, key_from_arg, key_from_event
+
+
+NOW = 1500000000
+
+
+def milestone(**params):
+    command = {
+        'milestone_key': 'key-1',
+        'timestamp': NOW + MIN_TIME,
+        'utc_offset': 1,
+        'pay_out': 10,
+        'threshold': 50
+    }
+    command.update(params)
+    return command
+
+
+@pytest.fixture
+def validator():
+    return CommandValidator(clock=lambda: NOW)
+
+
+def test_keys():
+    assert key_from_arg(binascii.hexlify(b'key-1')) == 'key-1'
+    assert key_from_event(b'key-1') == 'key-1'
+
+
+def test_milestone_claims_its_key(validator):
+    validator.check_milestone(milestone())
+    assert validator.statuses['key-1'] == 'pending'
+
+    with pytest.raises(ValidationError):
+        validator.check_milestone(milestone())
+
+
+@pytest.mark.parametrize('params', [
+    {'milestone_key': ''},
+    {'timestamp': NOW},
+    {'timestamp': NOW + 10 * 365 * 86400},
+    {'pay_out': 0},
+    {'threshold': 'high'},
+])
+def test_invalid_milestones(validator, params):
+    with pytest.raises(ValidationError):
+        validator.check_milestone(milestone(**params))
+    assert 'key-1' not in validator.statuses
+
+
+def test_forget_releases_only_pending_keys(validator):
+    validator.check_milestone(milestone())
+    validator.set_owner('key-1', 'customer', 'agreement')
+    validator.forget('key-1')
+    assert 'key-1' not in validator.statuses
+    assert validator.owner('key-1') == (None, None)
+
+    validator.check_milestone(milestone())
+    validator.on_event([b'milestone', b'key-1'])
+    validator.forget('key-1')
+    assert validator.statuses['key-1'] == 'initialized'
+
+
+def test_events_track_the_status(validator):
+    assert validator.on_event([b'milestone', b'key-1']) == 'key-1'
+    validator.check_review({'milestone_key': 'key-1', 'score': 80})
+
+    validator.on_event([b'review', b'key-1', b'\x50'])
+    with pytest.raises(ValidationError):
+        validator.check_review({'milestone_key': 'key-1', 'score': 80})
+
+    validator.on_event([b'refund', b'key-1'])
+    with pytest.raises(ValidationError):
+        validator.check_refund({'milestone_key': 'key-1'})
+
+    validator.set_owner('key-1', 'customer', 'agreement')
+    validator.on_event([b'delete', b'key-1'])
+    assert 'key-1' not in validator.statuses
+    assert 'key-1' not in validator.owners
+
+
+def test_other_events_are_ignored(validator):
+    assert validator.on_event([b'transfer', b'\x01' * 20, b'\x02' * 20, b'\x05']) is None
+    assert validator.on_event([b'Milestone added!']) is None
+    assert validator.statuses == {}
+
+
+def test_unknown_keys_are_left_to_the_contract(validator):
+    validator.check_review({'milestone_key': 'unknown', 'score': 1})
+    validator.check_refund({'milestone_key': 'unknown'})
+
+    with pytest.raises(ValidationError):
+        validator.check_review({'milestone_key': 'unknown', 'score': 'x'})
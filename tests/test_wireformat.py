@@ -0,0 +1,108 @@
+import json
+import uuid
+
+import pytest
+
+from wireformat import (command_from_entry, decode_command, decode_event, decode_response,
+                        encode_command, encode_event, encode_response, event_from_entry,
+                        response_from_entry, script_hash_bytes, script_hash_str)
+
+
+CUSTOMER = '0x23ba2703c53263e8d6e522dc32203339dcd8eee9'
+
+MILESTONE = {
+    'milestone_key': 'key-1',
+    'agreement': 'agreement-1',
+    'customer': CUSTOMER,
+    'assignee': CUSTOMER,
+    'platform': 'platform',
+    'timestamp': 1546300800,
+    'utc_offset': 1,
+    'oracle': CUSTOMER,
+    'pay_out': 100000000,
+    'asset': 'NEO',
+    'threshold': 75
+}
+
+
+def test_script_hash():
+    raw = script_hash_bytes(CUSTOMER)
+    assert len(raw) == 20
+    assert raw[0] == 0xe9
+    assert script_hash_str(raw) == CUSTOMER
+    assert script_hash_bytes(raw) == raw
+
+    with pytest.raises(ValueError):
+        script_hash_bytes('0x1234')
+
+
+def test_command_round_trip():
+    cmd_id = str(uuid.uuid4())
+    command = decode_command(encode_command(cmd_id, 'milestone', MILESTONE, 'token', 'neo-response:1'))
+
+    assert command['cmd_id'] == cmd_id
+    assert command['operation'] == 'milestone'
+    assert command['auth_token'] == 'token'
+    assert command['reply_to'] == 'neo-response:1'
+    assert command['params']['customer'] == script_hash_bytes(CUSTOMER)
+    assert command['params']['pay_out'] == 100000000
+    assert command['params']['milestone_key'] == 'key-1'
+
+
+def test_batch_round_trip():
+    commands = [
+        {'cmd_id': 'plain-id', 'operation': 'review', 'params': {'milestone_key': 'key-1', 'score': 80}},
+        {'cmd_id': str(uuid.uuid4()), 'operation': 'refund',
+         'params': {'milestone_key': 'key-2', 'fee_refund': True}},
+    ]
+    command = decode_command(encode_command('batch-id', 'batch', {'commands': commands}))
+
+    assert command['params']['commands'] == commands
+
+
+def test_command_ids():
+    cmd_id = uuid.uuid4()
+    for value in (str(cmd_id), str(cmd_id).upper(), cmd_id.hex, '{%s}' % cmd_id):
+        assert decode_command(encode_command(value, 'review', {'milestone_key': 'key-1', 'score': 1}))['cmd_id'] \
+            == str(cmd_id)
+
+    not_hex = 'zzzzzzzz-0000-0000-0000-000000000000'
+    assert decode_command(encode_command(not_hex, 'review', {'milestone_key': 'key-1', 'score': 1}))['cmd_id'] \
+        == not_hex
+
+
+def test_invalid_commands():
+    with pytest.raises(ValueError):
+        decode_command(b'not msgpack \xc1')
+
+    with pytest.raises(ValueError):
+        decode_command(encode_response('id', 'failed', {}))
+
+    with pytest.raises(KeyError):
+        encode_command('id', 'review', {'milestone_key': 'key-1'})
+
+
+def test_response_round_trip():
+    cmd_id = str(uuid.uuid4())
+    response = decode_response(encode_response(cmd_id, 'confirmed', {'result': [True, 2 ** 70], 'height': 5}))
+
+    assert response == {'cmd_id': cmd_id, 'status': 'confirmed', 'result': [True, str(2 ** 70)], 'height': 5}
+
+
+def test_event_round_trip():
+    record = {'event': 'transfer', 'from': CUSTOMER, 'to': CUSTOMER, 'amount': 2 ** 65, 'height': 7}
+    assert decode_event(encode_event(record)) == dict(record, amount=str(2 ** 65))
+
+
+def test_stream_entries_in_either_format():
+    command = {'cmd_id': 'id', 'operation': 'review', 'params': {'milestone_key': 'key-1', 'score': 80},
+               'auth_token': None, 'reply_to': None}
+
+    assert command_from_entry({b'data': json.dumps(command).encode()}) == command
+    assert command_from_entry({b'msg': encode_command('id', 'review', command['params'])}) == command
+
+    response = {'cmd_id': 'id', 'status': 'failed', 'error': 'nope'}
+    assert response_from_entry({b'data': json.dumps(response).encode()}) == response
+    assert response_from_entry({b'msg': encode_response('id', 'failed', {'error': 'nope'})}) == response
+
+    assert event_from_entry({b'msg': encode_event({'event': 'fee', 'fee': 2})}) == {'event': 'fee', 'fee': 2}
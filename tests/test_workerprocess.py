@@ -0,0 +1,101 @@
+import queue
+import sys
+import textwrap
+
+from workerprocess import CONFIG, WorkerProcess
+
+
+# Stands in for an InvokeWorker process, answers every task by its method name
+STUB_WORKER = textwrap.dedent('''
+    import os
+    from multiprocessing.connection import Connection
+
+    conn = Connection(int(os.environ['INVOKE_WORKER_FD']))
+    config = conn.recv()
+    received = 0
+
+    while True:
+        task_id, method_name, args = conn.recv()
+        received += 1
+        if method_name == 'crash':
+            os._exit(1)
+
+        conn.send(('state', None, {'received': received, 'load': 0, 'has_gas': True,
+                                   'stats': {'wallet': config['wallet_path']}}))
+        if method_name == 'review':
+            conn.send(('complete', task_id, {'result': list(args), 'confirmed': True}))
+        elif method_name == 'refund':
+            conn.send(('rejected', task_id, 'refund returned false'))
+''')
+
+
+class Task:
+
+    def __init__(self, method_name, *args):
+        self.method_name = method_name
+        self.args = args
+
+
+class Contract:
+
+    def __init__(self):
+        for name in CONFIG:
+            setattr(self, name, 1)
+        self.outcomes = queue.Queue()
+
+    def complete(self, task, outcome):
+        self.outcomes.put(('complete', task, outcome))
+
+    def fail(self, task, error):
+        self.outcomes.put(('fail', task, error))
+
+    def retry(self, task, error):
+        self.outcomes.put(('retry', task, error))
+
+    def rejected(self, task, error):
+        self.outcomes.put(('rejected', task, error))
+
+    def worker_freed(self):
+        pass
+
+
+def start_worker(tmp_path):
+    stub = tmp_path / 'stub_worker.py'
+    stub.write_text(STUB_WORKER)
+
+    contract = Contract()
+    worker = WorkerProcess('worker-1', contract, 'wallet-1', 'secret', str(tmp_path / 'chain'))
+    worker.command = [sys.executable, str(stub)]
+    worker.restart_delay = 0.01
+    worker.start()
+    return worker, contract
+
+
+def test_outcomes_are_reported_for_the_original_tasks(tmp_path):
+    worker, contract = start_worker(tmp_path)
+
+    review = Task('review', b'6b6579', 80)
+    refund = Task('refund', b'6b6579', 1)
+    worker.assign(review)
+    worker.assign(refund)
+
+    assert contract.outcomes.get(timeout=5) == ('complete', review, {'result': [b'6b6579', 80], 'confirmed': True})
+    assert contract.outcomes.get(timeout=5) == ('rejected', refund, 'refund returned false')
+    assert worker.pending_tasks() == []
+    assert worker.load() == 0
+    assert worker.stats()['wallet'] == 'wallet-1'
+
+
+def test_tasks_of_a_dead_process_are_retried(tmp_path):
+    worker, contract = start_worker(tmp_path)
+
+    crash = Task('crash')
+    worker.assign(crash)
+
+    kind, task, _error = contract.outcomes.get(timeout=5)
+    assert (kind, task) == ('retry', crash)
+
+    # A new process takes the next tasks
+    review = Task('review', b'6b6579', 80)
+    worker.assign(review)
+    assert contract.outcomes.get(timeout=5)[:2] == ('complete', review)
@@ -0,0 +1,69 @@
+import threading
+
+from collections import deque
+from decimal import Decimal
+
+
+class TransactionIndex:
+    """
+    Index of ContractTransaction payments, fed from the BlockFeed.
+
+    Payments are keyed by (receiver, sender, asset), so looking up whether a
+    sender paid a receiver costs a dict lookup no matter how deep in the
+    chain the payment is. With a `retention` only the payments of that many
+    latest blocks are kept, older ones are forgotten as new blocks come in.
+    """
+
+    def __init__(self, retention=None):
+        self.retention = retention
+        self._payments = {}  # (receiver, sender, asset) -> list of (value, txid, height)
+        self._blocks = deque()  # (height, keys of the payments in the block), oldest first
+        self._lock = threading.Lock()
+
+    def on_block(self, block):
+        height = block['height']
+        keys = []
+
+        with self._lock:
+            for tx in block['txs']:
+                if tx['type'] != 'ContractTransaction':
+                    continue
+
+                for output in tx['vout']:
+                    for sender in tx['senders']:
+                        # Change going back to the sender is not a payment
+                        if sender == output['address']:
+                            continue
+
+                        key = (output['address'], sender, output['asset'])
+                        payment = (Decimal(output['value']), tx['txid'], height)
+                        self._payments.setdefault(key, []).append(payment)
+                        keys.append(key)
+
+            if self.retention is not None:
+                if keys:
+                    self._blocks.append((height, keys))
+                self._prune(height - self.retention)
+
+    def _prune(self, cutoff):
+        """ Forget the payments of blocks at or below the cutoff height """
+        while self._blocks and self._blocks[0][0] <= cutoff:
+            _height, keys = self._blocks.popleft()
+            for key in keys:
+                payments = self._payments[key]
+                # Blocks come in order, so the oldest payment of a key is first
+                payments.pop(0)
+                if not payments:
+                    del self._payments[key]
+
+    def find_payment(self, sender, receiver, amount, asset):
+        """ Return (txid, height) of the first matching payment or None """
+        with self._lock:
+            payments = list(self._payments.get((receiver, sender, asset), []))
+
+        amount = Decimal(amount)
+        for value, txid, height in payments:
+            if value == amount:
+                return txid, height
+
+        return None
@@ -0,0 +1,244 @@
+"""
+Binary wire format of the messages between NEOInterface and the middleware.
+
+Messages are msgpack arrays that start with the format version and the
+message kind. Command parameters are encoded positionally following the
+schema of their operation, with native types: ints for numbers and the
+raw 20 bytes of script hashes. Stream entries carry the encoded message
+in the `msg` field, the JSON encoded `data` field is still understood.
+"""
+import json
+import uuid
+
+from functools import lru_cache
+
+import msgpack
+
+
+VERSION = 1
+
+COMMAND = 0
+RESPONSE = 1
+EVENT = 2
+
+STR = 'str'
+INT = 'int'
+BOOL = 'bool'
+HASH = 'hash'  # UInt160 script hash, '0x' prefixed big-endian hex in Python, raw bytes on the wire
+
+SCHEMAS = {
+    'milestone': (
+        ('milestone_key', STR),
+        ('agreement', STR),
+        ('customer', HASH),
+        ('assignee', HASH),
+        ('platform', STR),
+        ('timestamp', INT),
+        ('utc_offset', INT),
+        ('oracle', HASH),
+        ('pay_out', INT),
+        ('asset', STR),
+        ('threshold', INT),
+    ),
+    'review': (
+        ('milestone_key', STR),
+        ('score', INT),
+    ),
+    'refund': (
+        ('milestone_key', STR),
+        ('fee_refund', BOOL),
+    ),
+}
+
+OPERATIONS = ('milestone', 'review', 'refund', 'batch')
+STATUSES = ('confirmed', 'unconfirmed', 'failed')
+
+
+def script_hash_bytes(value):
+    """ The 20 raw bytes of a script hash given as bytes or as '0x' prefixed hex """
+    if isinstance(value, (bytes, bytearray)):
+        if len(value) != 20:
+            raise ValueError("script hash must be 20 bytes")
+        return bytes(value)
+    return _hex_script_hash(value)
+
+
+@lru_cache(maxsize=4096)
+def _hex_script_hash(value):
+    """ The same customers, assignees and oracles recur, cache their conversion """
+    value = value[2:] if value.startswith('0x') else value
+    raw = bytes.fromhex(value)[::-1]
+    if len(raw) != 20:
+        raise ValueError("script hash must be 20 bytes")
+    return raw
+
+
+def script_hash_str(raw):
+    return '0x' + bytes(raw[::-1]).hex()
+
+
+_ENCODERS = {
+    STR: str,
+    INT: int,
+    BOOL: bool,
+    HASH: script_hash_bytes,
+}
+
+
+# Encoder per param, in schema order
+_PARAM_ENCODERS = dict((operation, tuple((name, _ENCODERS[kind]) for name, kind in schema))
+                       for operation, schema in SCHEMAS.items())
+
+
+def _encode_id(cmd_id):
+    """ UUIDs go on the wire as 16 bytes, other ids as they are """
+    if isinstance(cmd_id, str) and len(cmd_id) == 36 and cmd_id[8] == cmd_id[13] == cmd_id[18] == cmd_id[23] == '-':
+        # Fast path for the canonical form, uuid.UUID parsing dominates the encoding otherwise
+        try:
+            raw = bytes.fromhex(cmd_id.replace('-', ''))
+            if len(raw) == 16:
+                return raw
+        except ValueError:
+            pass
+    try:
+        return uuid.UUID(cmd_id).bytes
+    except (TypeError, ValueError, AttributeError):
+        return cmd_id
+
+
+def _decode_id(value):
+    if isinstance(value, bytes) and len(value) == 16:
+        h = value.hex()
+        return '%s-%s-%s-%s-%s' % (h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+    return value
+
+
+def _encode_params(operation, params):
+    if operation == 'batch':
+        return [[_encode_id(command['cmd_id']), OPERATIONS.index(command['operation']),
+                 _encode_params(command['operation'], command['params'])]
+                for command in params['commands']]
+
+    return [encode(params[name]) for name, encode in _PARAM_ENCODERS[operation]]
+
+
+def _decode_params(operation, values):
+    if operation == 'batch':
+        return {'commands': [{
+            'cmd_id': _decode_id(cmd_id),
+            'operation': OPERATIONS[op],
+            'params': _decode_params(OPERATIONS[op], params)
+        } for cmd_id, op, params in values]}
+
+    schema = SCHEMAS[operation]
+    if len(values) != len(schema):
+        raise ValueError("%s expects %s params, got %s" % (operation, len(schema), len(values)))
+    return dict((name, value) for (name, _kind), value in zip(schema, values))
+
+
+def _unpack(raw, kind):
+    try:
+        message = msgpack.unpackb(raw, raw=False)
+    except Exception as e:
+        raise ValueError("invalid message: %s" % e)
+
+    if not isinstance(message, list) or len(message) < 2:
+        raise ValueError("invalid message")
+    if message[0] != VERSION:
+        raise ValueError("unsupported message version %s" % message[0])
+    if message[1] != kind:
+        raise ValueError("unexpected message kind %s" % message[1])
+    return message[2:]
+
+
+def encode_command(cmd_id, operation, params, auth_token=None, reply_to=None):
+    return msgpack.packb([VERSION, COMMAND, _encode_id(cmd_id), OPERATIONS.index(operation),
+                          _encode_params(operation, params), auth_token, reply_to],
+                         use_bin_type=True)
+
+
+def decode_command(raw):
+    """ Decode a command to the dict layout of the JSON format, raises ValueError """
+    try:
+        cmd_id, op, params, auth_token, reply_to = _unpack(raw, COMMAND)
+        operation = OPERATIONS[op]
+        return {
+            'cmd_id': _decode_id(cmd_id),
+            'operation': operation,
+            'params': _decode_params(operation, params),
+            'auth_token': auth_token,
+            'reply_to': reply_to
+        }
+    except (IndexError, KeyError, TypeError) as e:
+        raise ValueError("invalid command: %s" % e)
+
+
+def _big_ints_to_str(value):
+    """ msgpack ints are at most 64 bits, larger contract results are sent as strings """
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 64:
+        return str(value)
+    if isinstance(value, (list, tuple)):
+        return [_big_ints_to_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _big_ints_to_str(item)) for key, item in value.items())
+    return value
+
+
+def encode_response(cmd_id, status, fields):
+    message = [VERSION, RESPONSE, _encode_id(cmd_id), STATUSES.index(status), fields]
+    try:
+        return msgpack.packb(message, use_bin_type=True)
+    except OverflowError:
+        message[4] = _big_ints_to_str(fields)
+        return msgpack.packb(message, use_bin_type=True)
+
+
+def decode_response(raw):
+    """ Decode a response to a dict with cmd_id, status and the other fields """
+    try:
+        cmd_id, status, fields = _unpack(raw, RESPONSE)
+        response = dict(fields)
+        response['cmd_id'] = _decode_id(cmd_id)
+        response['status'] = STATUSES[status]
+        return response
+    except (IndexError, TypeError) as e:
+        raise ValueError("invalid response: %s" % e)
+
+
+def encode_event(record):
+    """ A contract event record, as published by the middleware """
+    message = [VERSION, EVENT, record]
+    try:
+        return msgpack.packb(message, use_bin_type=True)
+    except OverflowError:
+        message[2] = _big_ints_to_str(record)
+        return msgpack.packb(message, use_bin_type=True)
+
+
+def decode_event(raw):
+    try:
+        record, = _unpack(raw, EVENT)
+        return dict(record)
+    except (TypeError, ValueError) as e:
+        raise ValueError("invalid event: %s" % e)
+
+
+def command_from_entry(fields):
+    """ The command dict of a neo-cmd stream entry in either format """
+    if b'msg' in fields:
+        return decode_command(fields[b'msg'])
+    return json.loads(fields[b'data'].decode('utf-8'))
+
+
+def response_from_entry(fields):
+    """ The response dict of a reply stream entry in either format """
+    if b'msg' in fields:
+        return decode_response(fields[b'msg'])
+    return json.loads(fields[b'data'].decode('utf-8'))
+
+
+def event_from_entry(fields):
+    """ The event record of a neo-events stream entry """
+    return decode_event(fields[b'msg'])